@@ -0,0 +1,67 @@
+""" Compare pooled keep-alive uploads with a new connection per upload.
+
+Uploads go to a local stand-in for the Keen IO API, from several threads as the upload
+workers would make them. The stand-in waits ``handshake_ms`` on each new connection, as a
+TLS handshake with the real API would. The pool is also run with gzipped request bodies.
+Run with ``python -m benchmarks.bench_http [requests] [threads] [handshake_ms] [batch]``.
+"""
+
+import sys
+import threading
+import time
+
+import keen
+
+from keenmqtt.compression import GzipCompressor
+from keenmqtt.pool import HTTPPool
+
+from .keen_server import FakeKeenServer
+
+
+def run_uploads(client, count, threads, batch):
+	per_thread = count // threads
+	events = [{'sequence': i, 'topic': 'bench/sensor/{}'.format(i % 10), 'value': i * 0.5} for i in range(batch)]
+
+	def upload():
+		for i in range(per_thread):
+			client.add_events({'bench': events})
+
+	workers = [threading.Thread(target=upload) for _ in range(threads)]
+	start = time.time()
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	return per_thread * threads, time.time() - start
+
+
+def bench(server, count, threads, batch, pooled, compressed=False):
+	client = keen.KeenClient(project_id='bench', write_key='bench', base_url=server.base_url)
+	pool = None
+	if pooled:
+		pool = HTTPPool(pool_size=threads, compressor=GzipCompressor() if compressed else None)
+		pool.attach(client)
+	else:
+		# Ask the server to close each connection, as a client without keep-alive would.
+		client.api.session.headers['Connection'] = 'close'
+	connections, body_bytes = server.connections, server.body_bytes
+	sent, elapsed = run_uploads(client, count, threads, batch)
+	if pool:
+		pool.close()
+	return sent / elapsed, server.connections - connections, (server.body_bytes - body_bytes) / float(sent)
+
+
+def main(count=2000, threads=4, handshake_ms=20, batch=100):
+	server = FakeKeenServer(handshake_latency=handshake_ms / 1000.0).start()
+	try:
+		print("{} uploads of {} events from {} threads, {}ms per handshake".format(count, batch, threads, handshake_ms))
+		for name, pooled, compressed in (('new connection', False, False), ('keep-alive pool', True, False),
+				('pool with gzip', True, True)):
+			rate, connections, size = bench(server, count, threads, batch, pooled, compressed)
+			print("{:16} {:10.0f} uploads/s {:8} connections {:8.0f} bytes/upload".format(name, rate, connections, size))
+	finally:
+		server.stop()
+
+
+if __name__ == '__main__':
+	main(*[int(arg) for arg in sys.argv[1:]])
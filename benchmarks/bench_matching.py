@@ -0,0 +1,65 @@
+""" Compare the topic trie with a linear scan of topic_matches_sub.
+
+Run with ``python -m benchmarks.bench_matching [mappings] [topics]``.
+"""
+
+import random
+import sys
+import timeit
+
+import paho.mqtt.client as mqtt
+
+from keenmqtt.matching import TopicTrie
+
+
+def make_mappings(count, rng):
+	mappings = []
+	for i in range(count):
+		site = 'site{}'.format(i // 10)
+		kind = rng.choice(['exact', 'plus', 'hash'])
+		if kind == 'exact':
+			sub = '{}/sensor{}/value'.format(site, i)
+		elif kind == 'plus':
+			sub = '{}/+/reading{}'.format(site, i)
+		else:
+			sub = '{}/group{}/#'.format(site, i)
+		mappings.append((sub, 'collection{}'.format(i)))
+	return mappings
+
+
+def make_topics(mappings, count, rng):
+	topics = []
+	for _ in range(count):
+		sub = rng.choice(mappings)[0]
+		topics.append(sub.replace('+', 'device').replace('#', 'a/b'))
+	return topics
+
+
+def linear(mappings, topic):
+	for sub, collection in mappings:
+		if mqtt.topic_matches_sub(sub, topic):
+			return collection
+	return False
+
+
+def main(mapping_count=500, topic_count=2000):
+	rng = random.Random(0)
+	mappings = make_mappings(mapping_count, rng)
+	topics = make_topics(mappings, topic_count, rng)
+	trie = TopicTrie()
+	for sub, collection in mappings:
+		trie.add(sub, collection)
+
+	for topic in topics:
+		assert trie.match(topic, False) == linear(mappings, topic)
+
+	linear_time = min(timeit.repeat(lambda: [linear(mappings, t) for t in topics], number=1, repeat=3))
+	trie_time = min(timeit.repeat(lambda: [trie.match(t, False) for t in topics], number=1, repeat=3))
+	print("{} mappings, {} topics".format(mapping_count, topic_count))
+	print("linear scan: {:10.2f} us/lookup".format(linear_time / topic_count * 1e6))
+	print("topic trie:  {:10.2f} us/lookup".format(trie_time / topic_count * 1e6))
+	print("speedup:     {:10.1f}x".format(linear_time / trie_time))
+
+
+if __name__ == '__main__':
+	main(*[int(arg) for arg in sys.argv[1:]])
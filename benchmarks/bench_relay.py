@@ -0,0 +1,214 @@
+""" End-to-end throughput and latency benchmark for KeenMQTT.
+
+Runs entirely offline. By default synthetic messages are fed straight into
+``on_mqtt_message``, or with ``--replay`` the messages of a traffic recording; with ``--broker`` they travel through an in-process MQTT broker
+stand-in (or a real local broker with ``--broker-host``) first. Uploads go to a fake
+Keen IO client with a configurable latency.
+
+Run with ``python -m benchmarks.bench_relay --help``.
+"""
+
+import argparse
+import json
+import sys
+import threading
+import warnings
+
+import paho.mqtt.client as mqtt
+
+from keenmqtt import KeenMQTT
+
+from .harness import (FakeKeenClient, StageRecorder, make_relay, measure_allocations,
+	measure_message_allocations, perf_counter, recorded_messages, run_direct, summarise, synthetic_messages,
+	format_result)
+
+
+class CopyingRelay(KeenMQTT):
+	"""Overrides ``process_payload`` without changing it, which turns off the fast path
+	that reuses decoded payloads as events."""
+
+	def process_payload(self, event, topic, message):
+		return KeenMQTT.process_payload(self, event, topic, message)
+
+
+def relay_settings(args):
+	settings = {}
+	if args.no_stats:
+		settings['stats'] = {'enabled': False}
+	if args.decoder:
+		settings['default_decoder'] = args.decoder
+	if args.batch:
+		settings['batching'] = {'max_events': args.batch, 'max_age': 0.5}
+	if args.workers:
+		settings['upload_workers'] = {'workers': args.workers}
+	if args.replay:
+		# Recorded topics are not under bench/, so every topic goes to the one collection.
+		settings['collection_mappings'] = {'#': 'bench'}
+	return settings
+
+
+def stop_relay(relay):
+	if relay.batcher:
+		relay.batcher.stop()
+	if relay.uploader:
+		relay.uploader.stop()
+
+
+def bench_direct(args, relay_class=KeenMQTT, messages=None):
+	"""Benchmark ``on_mqtt_message`` without any network.
+
+	Args:
+		args (argparse.Namespace): Parsed command line options.
+		relay_class (class): ``KeenMQTT`` or a subclass to benchmark.
+		messages Optional[list]: Messages to use instead of synthetic ones.
+	Return:
+		dict: See ``harness.summarise``.
+	"""
+	if messages is None:
+		messages = synthetic_messages(args.messages, args.topics)
+	keen_client = FakeKeenClient(args.latency / 1000.0)
+
+	relay = make_relay(relay_class, keen_client, relay_settings(args))
+	elapsed, latencies = run_direct(relay, messages)
+	stop_relay(relay)
+
+	relay = make_relay(relay_class, keen_client, relay_settings(args))
+	recorder = StageRecorder(relay)
+	run_direct(relay, messages)
+	recorder.uninstall()
+	stop_relay(relay)
+
+	allocations = {}
+	message_allocation = None
+	if args.alloc_messages:
+		relay = make_relay(relay_class, keen_client, relay_settings(args))
+		allocations = measure_allocations(relay, messages[:args.alloc_messages])
+		stop_relay(relay)
+		relay = make_relay(relay_class, keen_client, relay_settings(args))
+		message_allocation = measure_message_allocations(relay, messages[:args.alloc_messages])
+		stop_relay(relay)
+
+	return summarise(len(messages), elapsed, latencies, recorder.samples, allocations, message_allocation)
+
+
+def paho_client(client_id):
+	if hasattr(mqtt, 'CallbackAPIVersion'):
+		with warnings.catch_warnings():
+			warnings.simplefilter('ignore', DeprecationWarning)
+			return mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id)
+	return mqtt.Client(client_id)
+
+
+def bench_broker(args, relay_class=KeenMQTT):
+	"""Benchmark the full path from an MQTT publisher, through a broker, to the fake client.
+
+	Latency is measured from each ``publish`` call until ``push_event`` returns.
+
+	Args:
+		args (argparse.Namespace): Parsed command line options.
+		relay_class (class): ``KeenMQTT`` or a subclass to benchmark.
+	Return:
+		dict: See ``harness.summarise``.
+	"""
+	broker = None
+	if args.broker_host:
+		host, _, port = args.broker_host.partition(':')
+		port = int(port or 1883)
+	else:
+		from .broker import Broker
+		broker = Broker()
+		broker.start()
+		host, port = broker.host, broker.port
+
+	messages = synthetic_messages(args.messages, args.topics)
+	sent = [0.0] * len(messages)
+	latencies = []
+	done = threading.Event()
+	keen_client = FakeKeenClient(args.latency / 1000.0)
+
+	client = paho_client('keenmqtt-bench-relay')
+	relay = make_relay(relay_class, keen_client, relay_settings(args), mqtt_client=client)
+	client.on_message = relay.on_mqtt_message
+	client.on_connect = relay.on_mqtt_connect
+	subscribed = threading.Event()
+	client.on_subscribe = lambda *args: subscribed.set()
+	push_event = relay.push_event
+
+	def timed_push(collection, event):
+		push_event(collection, event)
+		latencies.append(perf_counter() - sent[event['sequence']])
+		if len(latencies) == len(messages):
+			done.set()
+	relay.push_event = timed_push
+
+	client.connect(host, port)
+	relay.start()
+	subscribed.wait(5)
+
+	publisher = paho_client('keenmqtt-bench-publisher')
+	publisher.connect(host, port)
+	publisher.loop_start()
+	start = perf_counter()
+	for i, message in enumerate(messages):
+		sent[i] = perf_counter()
+		publisher.publish(message.topic, message.payload)
+	done.wait(args.timeout)
+	elapsed = perf_counter() - start
+
+	publisher.loop_stop()
+	publisher.disconnect()
+	relay.stop()
+	client.disconnect()
+	if broker:
+		broker.stop()
+
+	if len(latencies) < len(messages):
+		sys.stderr.write("warning: only {} of {} messages arrived\n".format(len(latencies), len(messages)))
+	latencies.sort()
+	return summarise(len(latencies), elapsed, latencies)
+
+
+def parser():
+	parse = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+	parse.add_argument('--messages', type=int, default=20000, help="Number of messages to relay.")
+	parse.add_argument('--topics', type=int, default=100, help="Number of distinct topics.")
+	parse.add_argument('--latency', type=float, default=0.0, help="Fake Keen IO latency per request in ms.")
+	parse.add_argument('--batch', type=int, default=0, help="Enable batching with this many events per upload.")
+	parse.add_argument('--workers', type=int, default=0, help="Enable this many upload worker threads.")
+	parse.add_argument('--decoder', help="Name of the payload decoder, such as json or json-stdlib.")
+	parse.add_argument('--no-stats', action='store_true', help="Turn off the relay's stats collection.")
+	parse.add_argument('--copy-events', action='store_true',
+		help="Copy each decoded payload into a new event, as relays overriding the event hooks do.")
+	parse.add_argument('--alloc-messages', type=int, default=2000, help="Messages used to measure allocations, 0 to skip.")
+	parse.add_argument('--replay', metavar='PATH',
+		help="Relay the messages of a traffic recording, see keenmqtt.recording, instead of synthetic ones.")
+	parse.add_argument('--replay-messages', type=int, default=0,
+		help="The most recorded messages to relay, 0 for all of them.")
+	parse.add_argument('--broker', action='store_true', help="Relay through the in-process broker stand-in.")
+	parse.add_argument('--broker-host', help="Relay through an existing broker at HOST[:PORT] instead.")
+	parse.add_argument('--timeout', type=float, default=60.0, help="Seconds to wait for broker delivery.")
+	parse.add_argument('--json', action='store_true', help="Print the results as JSON.")
+	return parse
+
+
+def main(argv=None):
+	parse = parser()
+	args = parse.parse_args(argv)
+	relay_class = CopyingRelay if args.copy_events else KeenMQTT
+	if args.replay and (args.broker or args.broker_host):
+		parse.error("--replay feeds the relay directly, it cannot be used with a broker")
+	if args.broker or args.broker_host:
+		name, result = 'broker', bench_broker(args, relay_class)
+	elif args.replay:
+		name, result = 'replay', bench_direct(args, relay_class, recorded_messages(args.replay, args.replay_messages))
+	else:
+		name, result = 'direct', bench_direct(args, relay_class)
+	if args.json:
+		print(json.dumps({name: result}, indent=2, sort_keys=True))
+	else:
+		print(format_result(name, result))
+	return result
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,102 @@
+""" Process startup benchmark for KeenMQTT.
+
+Starts fresh interpreters which import the package, print the command line help or check a
+config file, and reports the median wall time of each, along with the heavy dependencies
+each one imported. Relays restarted by a supervisor and short backfill jobs pay this on
+every start.
+
+Run with ``python -m benchmarks.bench_startup --help``.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from .harness import perf_counter
+
+# Dependencies which are slow to import, and only imported by the code which needs them.
+HEAVY_MODULES = ('paho', 'keen', 'requests', 'urllib3', 'yaml', 'numpy', 'msgpack', 'cbor2',
+	'multiprocessing', 'http.server', 'ssl', 'asyncio')
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_CONFIG = os.path.join(_ROOT, 'example', 'config.yaml')
+
+_REPORT = """
+import sys
+print(' '.join(sorted(name for name in {modules!r} if name in sys.modules)))
+"""
+
+# Name, and the code run by the interpreter.
+CASES = (
+	('interpreter', 'pass'),
+	('import keenmqtt', 'import keenmqtt'),
+	('import keenmqtt.app', 'import keenmqtt.app'),
+	('keenmqtt --help', "import sys; sys.argv = ['keenmqtt', '--help']\n"
+		"from keenmqtt.app import main\ntry:\n    main()\nexcept SystemExit:\n    pass"),
+	('keenmqtt check-config', "import sys; sys.argv = ['keenmqtt', '-c', {config!r}, 'check-config']\n"
+		"from keenmqtt.app import main\ntry:\n    main()\nexcept SystemExit:\n    pass"),
+)
+
+
+def run_python(code):
+	"""Run code in a fresh interpreter with the repository on its path.
+
+	Return:
+		tuple: The wall time in seconds and the standard output.
+	"""
+	env = dict(os.environ)
+	env['PYTHONPATH'] = os.pathsep.join([_ROOT] + [path for path in [env.get('PYTHONPATH')] if path])
+	start = perf_counter()
+	output = subprocess.check_output([sys.executable, '-c', code], env=env, stderr=subprocess.DEVNULL)
+	return perf_counter() - start, output.decode('utf-8')
+
+
+def heavy_imports(code):
+	"""Return the heavy dependencies imported by running code in a fresh interpreter."""
+	_, output = run_python(code + '\n' + _REPORT.format(modules=HEAVY_MODULES))
+	return output.split('\n')[-2].split()
+
+
+def startup_time(code, runs=5):
+	"""Return the median wall time of running code in a fresh interpreter."""
+	times = sorted(run_python(code)[0] for _ in range(runs))
+	return times[len(times) // 2]
+
+
+def bench(runs=5, config=_CONFIG):
+	"""Measure every case.
+
+	Return:
+		dict: Case name to ``seconds`` and ``heavy_imports``.
+	"""
+	results = {}
+	for name, code in CASES:
+		code = code.format(config=config)
+		results[name] = {'seconds': startup_time(code, runs), 'heavy_imports': heavy_imports(code)}
+	return results
+
+
+def parser():
+	parse = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+	parse.add_argument('--runs', type=int, default=5, help="Interpreters started per case.")
+	parse.add_argument('--config', default=_CONFIG, help="The config file to check.")
+	parse.add_argument('--json', action='store_true', help="Print the results as JSON.")
+	return parse
+
+
+def main(argv=None):
+	args = parser().parse_args(argv)
+	results = bench(args.runs, args.config)
+	if args.json:
+		print(json.dumps(results, indent=2, sort_keys=True))
+	else:
+		for name, _ in CASES:
+			result = results[name]
+			print("{:<24}{:>8.1f} ms  {}".format(name, result['seconds'] * 1000, ' '.join(result['heavy_imports'])))
+	return results
+
+
+if __name__ == '__main__':
+	main()
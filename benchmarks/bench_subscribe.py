@@ -0,0 +1,126 @@
+""" Subscribe benchmark for KeenMQTT.
+
+Connects a relay with many collection mappings to the in-process broker stand-in, or a
+real broker with ``--broker-host``, and times how long it takes from connecting until every
+SUBSCRIBE packet is acknowledged, which a relay pays again after every reconnect. Compares
+one packet per filter, as relays used to send, with multi-topic packets, and with filters
+covered by a broader mapping skipped.
+
+Run with ``python -m benchmarks.bench_subscribe --help``.
+"""
+
+import argparse
+import json
+import threading
+
+from keenmqtt import KeenMQTT
+
+from .bench_relay import paho_client
+from .harness import FakeKeenClient, perf_counter
+
+# Name, and the `subscriptions` settings.
+CASES = (
+	('per-filter', {'max_filters': 1, 'consolidate': False}),
+	('batched', {'consolidate': False}),
+	('consolidated', {}),
+)
+
+
+def make_mappings(count, covered=0.25):
+	"""Return ``count`` collection mappings, a fraction ``covered`` of them under a broader
+	mapping's ``#`` filter."""
+	mappings = {}
+	sites = max(1, count // 50)
+	for site in range(int(sites * covered)):
+		mappings['site{}/#'.format(site)] = 'site{}'.format(site)
+	i = 0
+	while len(mappings) < count:
+		mappings['site{}/device{}/+'.format(i % sites, i)] = 'device{}'.format(i)
+		i += 1
+	return mappings
+
+
+def bench_case(host, port, mappings, subscription_settings, timeout=60.0):
+	"""Time subscribing to the mappings once.
+
+	Return:
+		dict: The ``seconds`` from connecting until the last SUBACK, and the relay's
+		``subscriptions`` stats.
+	"""
+	client = paho_client('keenmqtt-bench-subscribe')
+	relay = KeenMQTT()
+	relay.setup(mqtt_client=client, keen_client=FakeKeenClient(0),
+		settings={'collection_mappings': mappings, 'subscriptions': subscription_settings})
+	done = threading.Event()
+	finished = [0.0]
+
+	def on_subscribe(client, userdata, mid, granted_qos):
+		relay.on_mqtt_subscribe(client, userdata, mid, granted_qos)
+		stats = relay.subscriber.stats()
+		if stats['subscribe_packets'] and not stats['pending'] and stats['acks'] == stats['subscribe_packets']:
+			finished[0] = perf_counter()
+			done.set()
+	client.on_connect = relay.on_mqtt_connect
+	client.on_subscribe = on_subscribe
+
+	start = perf_counter()
+	client.connect(host, port)
+	client.loop_start()
+	done.wait(timeout)
+	client.disconnect()
+	client.loop_stop()
+	result = relay.subscriber.stats()
+	result['seconds'] = finished[0] - start if done.is_set() else float('inf')
+	return result
+
+
+def bench(args):
+	"""Run every case.
+
+	Return:
+		dict: Case name to the result of ``bench_case``.
+	"""
+	broker = None
+	if args.broker_host:
+		host, _, port = args.broker_host.partition(':')
+		port = int(port or 1883)
+	else:
+		from .broker import Broker
+		broker = Broker()
+		broker.start()
+		host, port = broker.host, broker.port
+	mappings = make_mappings(args.mappings, args.covered)
+	try:
+		return dict((name, bench_case(host, port, mappings, settings, args.timeout)) for name, settings in CASES)
+	finally:
+		if broker:
+			broker.stop()
+
+
+def parser():
+	parse = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+	parse.add_argument('--mappings', type=int, default=5000, help="Number of collection mappings.")
+	parse.add_argument('--covered', type=float, default=0.25,
+		help="Fraction of the mappings covered by a broader mapping.")
+	parse.add_argument('--broker-host', help="Subscribe on an existing broker at HOST[:PORT] instead.")
+	parse.add_argument('--timeout', type=float, default=60.0, help="Seconds to wait for the SUBACKs.")
+	parse.add_argument('--json', action='store_true', help="Print the results as JSON.")
+	return parse
+
+
+def main(argv=None):
+	args = parser().parse_args(argv)
+	results = bench(args)
+	if args.json:
+		print(json.dumps(results, indent=2, sort_keys=True))
+	else:
+		for name, _ in CASES:
+			result = results[name]
+			print("{:<14}{:>9.1f} ms  {:>6} filters  {:>5} skipped  {:>6} packets  max round trip {:.1f} ms".format(
+				name, result['seconds'] * 1000, result['filters'], result['skipped'], result['subscribe_packets'],
+				result['round_trip_max'] * 1000))
+	return results
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,52 @@
+""" Compare the per-message cost of timestamping events.
+
+``datetime`` is how ``get_time`` formatted timestamps before ``Timestamper``. The
+``process_time`` rows time the whole hook with the default ``get_time``. Run with
+``python -m benchmarks.bench_time [calls]``.
+"""
+
+import sys
+import timeit
+from datetime import datetime
+
+from keenmqtt import KeenMQTT
+from keenmqtt.timestamps import Timestamper
+
+try:
+	from datetime import timezone
+except ImportError:
+	timezone = None
+
+
+class DatetimeRelay(KeenMQTT):
+	"""The relay with the previous ``get_time``."""
+
+	def get_time(self, topic, message):
+		return datetime.now().isoformat()
+
+
+def per_call(function, calls):
+	return min(timeit.repeat(function, number=calls, repeat=5)) / calls * 1e9
+
+
+def main(calls=200000):
+	timestamper = Timestamper()
+	rows = [('datetime.now().isoformat()', lambda: datetime.now().isoformat())]
+	if timezone is not None:
+		rows.append(('datetime.now(utc).isoformat()', lambda: datetime.now(timezone.utc).isoformat()))
+	rows.append(('Timestamper.now()', timestamper.now))
+
+	message = {'value': 1}
+	receive_relay = KeenMQTT()
+	receive_relay.timestamper = Timestamper('receive')
+	receive_relay.received_at = 1451649600.0
+	for name, relay in (('datetime', DatetimeRelay()), ('Timestamper', KeenMQTT()), ('receive time', receive_relay)):
+		rows.append(('process_time, {}'.format(name), lambda relay=relay: relay.process_time({}, 'a', message)))
+
+	print("{} calls".format(calls))
+	for name, function in rows:
+		print("{:32} {:8.0f} ns/call".format(name, per_call(function, calls)))
+
+
+if __name__ == '__main__':
+	main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,56 @@
+""" Compare a compiled mapping transform with the same rules in an overridden hook.
+
+Run with ``python -m benchmarks.bench_transforms [messages]``.
+"""
+
+import sys
+
+from keenmqtt import KeenMQTT
+
+from .harness import FakeKeenClient, make_relay, run_direct, synthetic_messages
+
+RULES = {
+	'collection': 'bench',
+	'rename': {'sensor_value': 'value'},
+	'coerce': {'value': 'float'},
+	'drop_if': {'value': {'lt': -50}},
+	'exclude': ['sequence'],
+	'topic_fields': {1: 'device'},
+}
+
+
+class SubclassRelay(KeenMQTT):
+	"""The same rules written as a ``process_payload`` override."""
+
+	def process_payload(self, event, topic, message):
+		event.update(message)
+		if 'sensor_value' in event:
+			event['value'] = event.pop('sensor_value')
+		try:
+			if 'value' in event:
+				event['value'] = float(event['value'])
+				if event['value'] < -50:
+					return False
+		except (TypeError, ValueError):
+			return False
+		event.pop('sequence', None)
+		event['device'] = topic.split('/')[1]
+		return True
+
+
+def main(count=50000):
+	messages = synthetic_messages(count)
+	rows = (
+		('subclass', SubclassRelay, {}),
+		('compiled transform', KeenMQTT, {'collection_mappings': {'bench/+': RULES}}),
+	)
+	print("{} messages".format(count))
+	for name, relay_class, settings in rows:
+		settings['stats'] = {'enabled': False}
+		relay = make_relay(relay_class, FakeKeenClient(), settings)
+		elapsed, latencies = run_direct(relay, messages)
+		print("{:20} {:10.0f} msgs/s".format(name, count / elapsed))
+
+
+if __name__ == '__main__':
+	main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,167 @@
+""" A minimal in-process MQTT 3.1.1 broker for offline benchmarks.
+
+Only what the benchmarks need is implemented: CONNECT, SUBSCRIBE, UNSUBSCRIBE, PUBLISH,
+PINGREQ and DISCONNECT. Messages are always delivered at QoS 0 and nothing is retained.
+"""
+
+import socket
+import struct
+import threading
+
+try:
+	import socketserver
+except ImportError:
+	import SocketServer as socketserver
+
+import paho.mqtt.client as mqtt
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+SUBSCRIBE = 0x80
+SUBACK = 0x90
+UNSUBSCRIBE = 0xA0
+UNSUBACK = 0xB0
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+
+def encode_length(length):
+	encoded = bytearray()
+	while True:
+		byte = length % 128
+		length //= 128
+		if length:
+			byte |= 0x80
+		encoded.append(byte)
+		if not length:
+			return bytes(encoded)
+
+
+def packet(header, body):
+	return bytes(bytearray([header])) + encode_length(len(body)) + body
+
+
+def read_string(body, offset):
+	length = struct.unpack_from('>H', body, offset)[0]
+	start = offset + 2
+	return body[start:start + length].decode('utf-8'), start + length
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+	def setup(self):
+		self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.send_lock = threading.Lock()
+		self.subscriptions = set()
+		self.stream = self.request.makefile('rb')
+
+	def send(self, data):
+		with self.send_lock:
+			self.request.sendall(data)
+
+	def handle(self):
+		broker = self.server
+		try:
+			while True:
+				first = self.stream.read(1)
+				if not first:
+					return
+				header = bytearray(first)[0]
+				length = 0
+				multiplier = 1
+				while True:
+					byte = bytearray(self.stream.read(1))[0]
+					length += (byte & 0x7F) * multiplier
+					multiplier *= 128
+					if not byte & 0x80:
+						break
+				body = self.stream.read(length)
+				kind = header & 0xF0
+				if kind == CONNECT:
+					broker.add_client(self)
+					self.send(packet(CONNACK, b'\x00\x00'))
+				elif kind == PUBLISH:
+					qos = (header >> 1) & 0x03
+					topic, offset = read_string(body, 0)
+					if qos:
+						self.send(packet(PUBACK, body[offset:offset + 2]))
+						offset += 2
+					broker.publish(topic, body[offset:])
+				elif kind == SUBSCRIBE:
+					mid = body[:2]
+					offset = 2
+					granted = bytearray()
+					while offset < len(body):
+						sub, offset = read_string(body, offset)
+						offset += 1
+						self.subscriptions.add(sub)
+						granted.append(0)
+					self.send(packet(SUBACK, mid + bytes(granted)))
+				elif kind == UNSUBSCRIBE:
+					offset = 2
+					while offset < len(body):
+						sub, offset = read_string(body, offset)
+						self.subscriptions.discard(sub)
+					self.send(packet(UNSUBACK, body[:2]))
+				elif kind == PINGREQ:
+					self.send(packet(PINGRESP, b''))
+				elif kind == DISCONNECT:
+					return
+		except (IOError, OSError):
+			return
+		finally:
+			broker.remove_client(self)
+
+	def deliver(self, topic, payload):
+		for sub in list(self.subscriptions):
+			if mqtt.topic_matches_sub(sub, topic):
+				encoded = topic.encode('utf-8')
+				try:
+					self.send(packet(PUBLISH, struct.pack('>H', len(encoded)) + encoded + payload))
+				except (IOError, OSError):
+					pass
+				return
+
+
+class Broker(socketserver.ThreadingMixIn, socketserver.TCPServer):
+	"""A broker listening on ``host``:``port``. Port ``0`` picks a free port.
+
+	Use ``start``/``stop``, the bound port is available as ``port`` after construction.
+	"""
+
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, host='127.0.0.1', port=0):
+		socketserver.TCPServer.__init__(self, (host, port), _Handler)
+		self.host, self.port = self.server_address[:2]
+		self._clients = set()
+		self._clients_lock = threading.Lock()
+		self._thread = None
+
+	def add_client(self, handler):
+		with self._clients_lock:
+			self._clients.add(handler)
+
+	def remove_client(self, handler):
+		with self._clients_lock:
+			self._clients.discard(handler)
+
+	def publish(self, topic, payload):
+		with self._clients_lock:
+			clients = list(self._clients)
+		for client in clients:
+			client.deliver(topic, payload)
+
+	def start(self):
+		self._thread = threading.Thread(target=self.serve_forever, name='bench-broker')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+		self._thread.join()
@@ -0,0 +1,299 @@
+""" Offline stand-ins and measurement helpers for benchmarking KeenMQTT """
+
+import json
+import threading
+import time
+
+from keenmqtt.recording import read_log
+
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
+try:
+	perf_counter = time.perf_counter
+except AttributeError:
+	perf_counter = time.time
+
+# Pipeline stages reported by the benchmarks, and the hooks which implement them.
+STAGES = (
+	('decode', 'decode_payload'),
+	('collection', 'process_collection'),
+	('topic', 'process_topic'),
+	('payload', 'process_payload'),
+	('time', 'process_time'),
+	('push', 'push_event'),
+)
+
+
+class FakeKeenClient(object):
+	"""An in-process replacement for ``keen.KeenClient`` which only counts events.
+
+	Args:
+		latency (float): Seconds each ``add_event``/``add_events`` call sleeps, to stand in
+			for the HTTP round trip.
+	"""
+
+	def __init__(self, latency=0.0):
+		self.latency = latency
+		self.events = 0
+		self.requests = 0
+		self._lock = threading.Lock()
+
+	def add_event(self, collection, event):
+		self._record(1)
+
+	def add_events(self, events):
+		self._record(sum(len(batch) for batch in events.values()))
+		return dict((collection, [{'success': True}] * len(batch)) for collection, batch in events.items())
+
+	def _record(self, count):
+		if self.latency:
+			time.sleep(self.latency)
+		with self._lock:
+			self.events += count
+			self.requests += 1
+
+
+class FakeMessage(object):
+	"""The subset of ``paho.mqtt.client.MQTTMessage`` used by ``on_mqtt_message``."""
+
+	__slots__ = ('topic', 'payload', 'qos', 'retain', 'mid', 'timestamp')
+
+	def __init__(self, topic, payload, qos=0, retain=False):
+		self.topic = topic
+		self.payload = payload
+		self.qos = qos
+		self.retain = retain
+		self.mid = 0
+		self.timestamp = 0
+
+
+def synthetic_messages(count, topics=100, prefix='bench'):
+	"""Make a list of JSON sensor readings spread over a number of topics.
+
+	Args:
+		count (int): Number of messages.
+		topics (int): Number of distinct topics, ``<prefix>/sensor<n>``.
+		prefix (str): First topic level, mapped to a collection of the same name.
+	Return:
+		list: Of ``FakeMessage``.
+	"""
+	messages = []
+	for i in range(count):
+		sensor = i % topics
+		payload = json.dumps({
+			'sensor_id': 'sensor{}'.format(sensor),
+			'sensor_value': 20.0 + (i % 50) / 10.0,
+			'type': 'temperature',
+			'sequence': i,
+		}).encode('utf-8')
+		messages.append(FakeMessage('{}/sensor{}'.format(prefix, sensor), payload))
+	return messages
+
+
+def recorded_messages(path, limit=0):
+	"""Load messages recorded by ``keenmqtt.recording.Recorder``, to benchmark real traffic.
+
+	Args:
+		path (str): A directory of segments, or a single segment file.
+		limit (int): The most messages to load, ``0`` for all of them.
+	Return:
+		list: Of ``keenmqtt.recording.RecordedMessage``.
+	"""
+	messages = []
+	for message in read_log(path):
+		messages.append(message)
+		if len(messages) == limit:
+			break
+	return messages
+
+
+def percentile(samples, fraction):
+	"""Return the value below which ``fraction`` of the sorted ``samples`` fall."""
+	if not samples:
+		return 0.0
+	index = min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))
+	return samples[index]
+
+
+class StageRecorder(object):
+	"""Wrap the pipeline hooks of a KeenMQTT instance to record time or memory per stage.
+
+	Args:
+		relay (KeenMQTT): The instance to instrument. The wrappers are instance attributes,
+			so ``uninstall`` restores the class behaviour.
+		memory (bool): Record bytes allocated at peak inside each stage with ``tracemalloc``
+			instead of elapsed time.
+	"""
+
+	def __init__(self, relay, memory=False):
+		self.relay = relay
+		self.memory = memory
+		self.samples = dict((stage, []) for stage, _ in STAGES)
+		for stage, hook in STAGES:
+			setattr(relay, hook, self._wrap(stage, getattr(relay, hook)))
+
+	def uninstall(self):
+		for _, hook in STAGES:
+			self.relay.__dict__.pop(hook, None)
+
+	def _wrap(self, stage, method):
+		samples = self.samples[stage]
+		if self.memory:
+			def wrapper(*args):
+				before = tracemalloc.get_traced_memory()[0]
+				tracemalloc.reset_peak()
+				result = method(*args)
+				samples.append(tracemalloc.get_traced_memory()[1] - before)
+				return result
+		else:
+			def wrapper(*args):
+				start = perf_counter()
+				result = method(*args)
+				samples.append(perf_counter() - start)
+				return result
+		return wrapper
+
+
+def make_relay(relay_class, keen_client, settings=None, mqtt_client=None):
+	"""Create a ready relay with the benchmark collection mapping.
+
+	Args:
+		relay_class (class): ``KeenMQTT`` or a subclass.
+		keen_client (FakeKeenClient): The Keen IO stand-in.
+		settings Optional[dict]: Extra settings merged into the defaults.
+		mqtt_client Optional[object]: An MQTT client, a placeholder is used if omitted.
+	Return:
+		KeenMQTT: The relay.
+	"""
+	config = {'collection_mappings': {'bench/+': 'bench'}}
+	config.update(settings or {})
+	relay = relay_class()
+	relay.setup(mqtt_client=mqtt_client or object(), keen_client=keen_client, settings=config)
+	return relay
+
+
+def run_direct(relay, messages):
+	"""Feed messages straight into ``on_mqtt_message`` and time each one.
+
+	Args:
+		relay (KeenMQTT): A relay from ``make_relay``.
+		messages (iterable): Of objects with ``topic`` and ``payload`` attributes.
+	Return:
+		tuple: Total elapsed seconds and the sorted per-message latencies.
+	"""
+	on_message = relay.on_mqtt_message
+	latencies = []
+	append = latencies.append
+	start = perf_counter()
+	for message in messages:
+		t = perf_counter()
+		on_message(None, None, message)
+		append(perf_counter() - t)
+	elapsed = perf_counter() - start
+	latencies.sort()
+	return elapsed, latencies
+
+
+def measure_allocations(relay, messages):
+	"""Return the mean bytes allocated at peak per message for each stage.
+
+	Args:
+		relay (KeenMQTT): A relay from ``make_relay``.
+		messages (list): The messages to feed through ``on_mqtt_message``.
+	Return:
+		dict: Stage name to bytes per message, empty if ``tracemalloc`` is unavailable.
+	"""
+	if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak'):
+		return {}
+	recorder = StageRecorder(relay, memory=True)
+	tracemalloc.start()
+	try:
+		for message in messages:
+			relay.on_mqtt_message(None, None, message)
+	finally:
+		tracemalloc.stop()
+		recorder.uninstall()
+	return dict((stage, sum(samples) / float(len(messages))) for stage, samples in recorder.samples.items())
+
+
+def measure_message_allocations(relay, messages):
+	"""Return the mean bytes allocated at peak while handling each whole message.
+
+	Unlike ``measure_allocations`` the hooks are not wrapped, so the relay runs as it
+	would in production.
+
+	Args:
+		relay (KeenMQTT): A relay from ``make_relay``.
+		messages (list): The messages to feed through ``on_mqtt_message``.
+	Return:
+		float: Bytes per message, or ``None`` if ``tracemalloc`` is unavailable.
+	"""
+	if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak'):
+		return None
+	total = 0
+	tracemalloc.start()
+	try:
+		for message in messages:
+			before = tracemalloc.get_traced_memory()[0]
+			tracemalloc.reset_peak()
+			relay.on_mqtt_message(None, None, message)
+			total += tracemalloc.get_traced_memory()[1] - before
+	finally:
+		tracemalloc.stop()
+	return total / float(len(messages))
+
+
+def summarise(count, elapsed, latencies, stages=None, allocations=None, message_allocation=None):
+	"""Build the result dictionary printed by the benchmarks.
+
+	Args:
+		count (int): Number of messages processed.
+		elapsed (float): Total seconds taken.
+		latencies (list): Sorted per-message latencies in seconds.
+		stages Optional[dict]: Stage name to a list of per-call durations.
+		allocations Optional[dict]: Stage name to bytes allocated per message.
+		message_allocation Optional[float]: Bytes allocated per whole message.
+	Return:
+		dict: With ``messages``, ``msgs_per_sec``, ``p50_us``, ``p99_us`` and ``stages``, and
+		``alloc_bytes_per_msg`` if ``message_allocation`` is given.
+	"""
+	result = {
+		'messages': count,
+		'msgs_per_sec': count / elapsed if elapsed else 0.0,
+		'p50_us': percentile(latencies, 0.50) * 1e6,
+		'p99_us': percentile(latencies, 0.99) * 1e6,
+		'stages': {},
+	}
+	if message_allocation is not None:
+		result['alloc_bytes_per_msg'] = message_allocation
+	for stage, _ in STAGES:
+		info = {}
+		samples = sorted((stages or {}).get(stage, []))
+		if samples:
+			info['calls'] = len(samples)
+			info['p50_us'] = percentile(samples, 0.50) * 1e6
+			info['p99_us'] = percentile(samples, 0.99) * 1e6
+		if allocations and stage in allocations:
+			info['alloc_bytes_per_msg'] = allocations[stage]
+		result['stages'][stage] = info
+	return result
+
+
+def format_result(name, result):
+	"""Format a result from ``summarise`` as a small text table."""
+	lines = [
+		"{}: {} messages, {:.0f} msgs/s, p50 {:.1f} us, p99 {:.1f} us".format(
+			name, result['messages'], result['msgs_per_sec'], result['p50_us'], result['p99_us']),
+		"  {:<12}{:>10}{:>12}{:>12}{:>16}".format('stage', 'calls', 'p50 us', 'p99 us', 'alloc B/msg'),
+	]
+	if 'alloc_bytes_per_msg' in result:
+		lines[0] += ", {:.0f} B/msg allocated".format(result['alloc_bytes_per_msg'])
+	for stage, _ in STAGES:
+		info = result['stages'].get(stage, {})
+		lines.append("  {:<12}{:>10}{:>12.2f}{:>12.2f}{:>16.0f}".format(
+			stage, info.get('calls', 0), info.get('p50_us', 0.0), info.get('p99_us', 0.0),
+			info.get('alloc_bytes_per_msg', 0.0)))
+	return '\n'.join(lines)
@@ -0,0 +1,126 @@
+""" A local stand-in for the Keen IO event API, for offline tests and benchmarks.
+
+Accepts single and bulk event posts over HTTP/1.1 with keep-alive, optionally with gzip
+request bodies, and records what it received.
+"""
+
+import gzip
+import io
+import json
+import threading
+import time
+
+try:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+except ImportError:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+
+
+class _Handler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	disable_nagle_algorithm = True
+
+	def setup(self):
+		BaseHTTPRequestHandler.setup(self)
+		self.server.record_connection()
+		if self.server.handshake_latency:
+			time.sleep(self.server.handshake_latency)
+
+	def do_POST(self):
+		server = self.server
+		body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+		size = len(body)
+		if self.headers.get('Content-Encoding') == 'gzip':
+			body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+		if server.latency:
+			time.sleep(server.latency)
+		parts = self.path.split('?')[0].strip('/').split('/')
+		# /<version>/projects/<project_id>/events[/<collection>]
+		if len(parts) < 4 or parts[1] != 'projects' or parts[3] != 'events':
+			return self._reply(404, {'message': 'not found'})
+		if server.write_key and self.headers.get('Authorization') != server.write_key:
+			return self._reply(401, {'message': 'bad write key'})
+		if server.fail:
+			return self._reply(500, {'message': 'failing on purpose'})
+		data = json.loads(body.decode('utf-8'))
+		if len(parts) == 5:
+			server.record({parts[4]: [data]}, size)
+			return self._reply(201, {'created': True})
+		server.record(data, size)
+		return self._reply(200, dict((collection, [{'success': True}] * len(events))
+			for collection, events in data.items()))
+
+	def _reply(self, status, data):
+		body = json.dumps(data).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		if self.close_connection:
+			self.send_header('Connection', 'close')
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class FakeKeenServer(ThreadingMixIn, HTTPServer):
+	"""A threaded HTTP server implementing the Keen IO event endpoints.
+
+	Args:
+		host (str): Address to listen on.
+		port (int): Port to listen on, ``0`` picks a free port.
+		latency (float): Seconds to sleep before answering each request.
+		write_key Optional[str]: If set, requests must send it as the ``Authorization`` header.
+		handshake_latency (float): Seconds to sleep before reading from each new connection,
+			standing in for the round trips of a TLS handshake.
+	"""
+
+	daemon_threads = True
+	request_queue_size = 128
+
+	def __init__(self, host='127.0.0.1', port=0, latency=0.0, write_key=None, handshake_latency=0.0):
+		HTTPServer.__init__(self, (host, port), _Handler)
+		self.host, self.port = self.server_address[:2]
+		self.latency = latency
+		self.write_key = write_key
+		self.handshake_latency = handshake_latency
+		self.fail = False
+		self.events = {}
+		self.requests = 0
+		self.connections = 0
+		self.body_bytes = 0
+		self._lock = threading.Lock()
+		self._thread = None
+
+	@property
+	def base_url(self):
+		return 'http://{}:{}'.format(self.host, self.port)
+
+	def event_count(self):
+		with self._lock:
+			return sum(len(events) for events in self.events.values())
+
+	def record(self, events, size):
+		with self._lock:
+			self.requests += 1
+			self.body_bytes += size
+			for collection, batch in events.items():
+				self.events.setdefault(collection, []).extend(batch)
+
+	def record_connection(self):
+		with self._lock:
+			self.connections += 1
+
+	def start(self):
+		self._thread = threading.Thread(target=self.serve_forever, name='fake-keen')
+		self._thread.daemon = True
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+		self._thread.join()
@@ -1,5 +1,5 @@
 
 #from . import keenmqtt
-from .keenmqtt import KeenMQTT, BackgroundRunningException
+from .keenmqtt import KeenMQTT, BackgroundRunningException, UploadError
 
 __version__ = '0.0.11'
\ No newline at end of file
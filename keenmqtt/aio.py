@@ -0,0 +1,541 @@
+""" An asyncio version of the relay, for embedding in asyncio applications.
+
+Requires Python 3.5 or later. The MQTT socket is driven by the event loop and events are
+uploaded to Keen IO with concurrent, non-blocking HTTP requests over a small pool of
+keep-alive connections.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import ssl
+import threading
+from collections import deque
+from urllib.parse import urlsplit
+
+from .budget import BLOCK
+from .compression import GzipCompressor
+from .keenmqtt import KeenMQTT, BackgroundRunningException, UploadError
+
+logger = logging.getLogger('keenmqtt')
+
+KEEN_API_URL = 'https://api.keen.io'
+
+# ``get_event_loop`` is deprecated within coroutines, but is all Python 3.5 and 3.6 have.
+_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+class AsyncHTTPConnection(object):
+	"""A single HTTP/1.1 keep-alive connection, enough to talk to the Keen IO API.
+
+	Args:
+		host (str): Server host name.
+		port (int): Server port.
+		use_ssl (bool): Whether to use TLS.
+	"""
+
+	def __init__(self, host, port, use_ssl=False):
+		self.host = host
+		self.port = port
+		self.use_ssl = use_ssl
+		self.reader = None
+		self.writer = None
+		if (use_ssl and port == 443) or (not use_ssl and port == 80):
+			self.host_header = host
+		else:
+			self.host_header = '{}:{}'.format(host, port)
+
+	@property
+	def connected(self):
+		return self.writer is not None
+
+	async def connect(self):
+		context = ssl.create_default_context() if self.use_ssl else None
+		self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=context)
+
+	async def request(self, method, path, headers, body):
+		"""Send a request and read the whole response.
+
+		Args:
+			method (str): The HTTP method.
+			path (str): The request path.
+			headers (dict): Extra request headers.
+			body (bytes): The request body.
+		Return:
+			tuple: The ``(status, headers, body)`` of the response, with lower case header names.
+		Raises:
+			ConnectionError: When the server closes the connection before answering.
+		"""
+		if self.writer is None:
+			await self.connect()
+		lines = ['{} {} HTTP/1.1'.format(method, path), 'Host: {}'.format(self.host_header),
+			'Content-Length: {}'.format(len(body))]
+		lines.extend('{}: {}'.format(name, value) for name, value in headers.items())
+		self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+		await self.writer.drain()
+
+		status_line = await self.reader.readline()
+		if not status_line:
+			raise ConnectionResetError("Connection closed by server")
+		status = int(status_line.split()[1])
+		response_headers = {}
+		while True:
+			line = await self.reader.readline()
+			if line in (b'\r\n', b'\n', b''):
+				break
+			name, _, value = line.decode('latin-1').partition(':')
+			response_headers[name.strip().lower()] = value.strip()
+
+		if 'content-length' in response_headers:
+			data = await self.reader.readexactly(int(response_headers['content-length']))
+		elif response_headers.get('transfer-encoding', '').lower() == 'chunked':
+			data = await self._read_chunked()
+		else:
+			data = await self.reader.read()
+			self.close()
+		if response_headers.get('connection', '').lower() == 'close':
+			self.close()
+		return status, response_headers, data
+
+	async def _read_chunked(self):
+		chunks = []
+		while True:
+			size = int((await self.reader.readline()).split(b';')[0], 16)
+			if not size:
+				while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+					pass
+				return b''.join(chunks)
+			chunks.append(await self.reader.readexactly(size))
+			await self.reader.readexactly(2)
+
+	def close(self):
+		if self.writer is not None:
+			self.writer.close()
+		self.reader = self.writer = None
+
+
+class AsyncKeenUploader(object):
+	"""Upload events to the Keen IO bulk events API without blocking the event loop.
+
+	Idle connections are kept open and reused, so concurrent uploads open at most as many
+	connections as there are requests in flight.
+
+	Args:
+		project_id (str): The Keen IO project.
+		write_key (str): The project's write key.
+		base_url (str): The API address, overridable for testing.
+		api_version (str): The API version in request paths.
+		max_idle (int): The number of idle connections to keep open.
+		timeout (float): Seconds to wait for each request.
+		compressor Optional[GzipCompressor]: Gzips request bodies, in the event loop's default
+			executor so that the loop is not held up.
+	"""
+
+	def __init__(self, project_id, write_key, base_url=KEEN_API_URL, api_version='3.0', max_idle=8, timeout=305.0,
+			compressor=None):
+		url = urlsplit(base_url)
+		self.use_ssl = url.scheme == 'https'
+		self.host = url.hostname
+		self.port = url.port or (443 if self.use_ssl else 80)
+		self.path = '{}/{}/projects/{}/events'.format(url.path.rstrip('/'), api_version, project_id)
+		self.headers = {'Authorization': write_key, 'Content-Type': 'application/json'}
+		self.gzip_headers = dict(self.headers, **{'Content-Encoding': 'gzip'})
+		self.compressor = compressor
+		self.max_idle = max_idle
+		self.timeout = timeout
+		self.requests = 0
+		self.connections_opened = 0
+		self._idle = deque()
+
+	@classmethod
+	def from_settings(cls, settings, max_idle=8, compressor=None):
+		"""Create an uploader from the `keen` section of a config file.
+
+		The same keys as ``keen.KeenClient`` are used. The project id and write key fall back
+		to the ``KEEN_PROJECT_ID`` and ``KEEN_WRITE_KEY`` environment variables, as they do for
+		the ``keen`` module.
+
+		Args:
+			settings Optional[dict]: Such as the `keen` section of config.yaml.
+			max_idle (int): The number of idle connections to keep open.
+			compressor Optional[GzipCompressor]: See the class documentation.
+		Return:
+			AsyncKeenUploader: The uploader.
+		"""
+		settings = settings or {}
+		return cls(settings.get('project_id') or os.environ.get('KEEN_PROJECT_ID'),
+			settings.get('write_key') or os.environ.get('KEEN_WRITE_KEY'),
+			base_url=settings.get('base_url') or KEEN_API_URL,
+			max_idle=max_idle,
+			timeout=float(settings.get('post_timeout', 305)),
+			compressor=compressor)
+
+	async def add_events(self, events):
+		"""Upload events to several collections in one request.
+
+		Args:
+			events (dict): A dictionary of collection names to lists of events.
+		Return:
+			dict: Keen IO's response, with a list of ``{"success": bool}`` per collection.
+		Raises:
+			UploadError: When Keen IO answers with an error status.
+		"""
+		body = json.dumps(events).encode('utf-8')
+		headers = self.headers
+		if self.compressor is not None and len(body) >= self.compressor.min_size:
+			body = await _running_loop().run_in_executor(None, self.compressor.compress, body)
+			headers = self.gzip_headers
+		status, headers, data = await self._post(body, headers)
+		if status >= 300:
+			raise UploadError(status, data.decode('utf-8', 'replace'))
+		return json.loads(data.decode('utf-8')) if data else {}
+
+	async def _post(self, body, headers):
+		reused = bool(self._idle)
+		connection = self._idle.pop() if reused else self._new_connection()
+		try:
+			try:
+				result = await asyncio.wait_for(
+					connection.request('POST', self.path, headers, body), self.timeout)
+			except asyncio.TimeoutError:
+				raise
+			except (OSError, asyncio.IncompleteReadError):
+				if not reused:
+					raise
+				# The server closed the idle connection, try once more on a fresh one.
+				connection.close()
+				connection = self._new_connection()
+				result = await asyncio.wait_for(
+					connection.request('POST', self.path, headers, body), self.timeout)
+		except BaseException:
+			connection.close()
+			raise
+		self.requests += 1
+		if connection.connected and len(self._idle) < self.max_idle:
+			self._idle.append(connection)
+		else:
+			connection.close()
+		return result
+
+	def _new_connection(self):
+		self.connections_opened += 1
+		return AsyncHTTPConnection(self.host, self.port, self.use_ssl)
+
+	def stats(self):
+		"""Return the number of idle connections kept, requests, new and reused connections."""
+		return {
+			'size': self.max_idle,
+			'requests': self.requests,
+			'connections_opened': self.connections_opened,
+			'connections_reused': max(self.requests - self.connections_opened, 0),
+		}
+
+	def close(self):
+		"""Close the idle connections."""
+		while self._idle:
+			self._idle.pop().close()
+
+
+class AsyncKeenMQTT(KeenMQTT):
+	"""A relay driven by an asyncio event loop.
+
+	The pipeline hooks are the same as ``KeenMQTT``'s. Instead of a network thread, the
+	MQTT socket is watched by the event loop, and instead of blocking Keen IO calls, each
+	event or batch is uploaded in its own task, with at most ``max_in_flight`` requests in
+	flight at once. Failed uploads are spooled if a spool is set up and logged otherwise.
+	The `upload_workers` setting is ignored, the `async` setting may set ``max_in_flight``.
+	With a `memory_budget` using the ``block`` policy, the MQTT socket is not read while the
+	budget is exceeded. ``drop-oldest`` drops the new event, as there is no upload queue.
+
+	Use ``await start()`` and ``await stop()`` from a coroutine instead of ``start``,
+	``stop`` and ``step``.
+
+	Args:
+		max_in_flight (int): The number of concurrent upload requests.
+	"""
+
+	def __init__(self, max_in_flight=8):
+		KeenMQTT.__init__(self)
+		self.max_in_flight = max_in_flight
+		self.loop = None
+		self._loop_thread = None
+		self._semaphore = None
+		self._uploads = set()
+		self._tasks = []
+		self._mqtt_address = None
+		self._socket = None
+		self._writing = False
+		self._reading = False
+		self._connected_once = False
+
+	def setup(self, mqtt_client=None, keen_client=None, settings=None):
+		"""Setup the clients for this instance, see ``KeenMQTT.setup``.
+
+		A Keen client passed in must have a coroutine ``add_events`` method, such as
+		``AsyncKeenUploader``. An MQTT client passed in must already be connected.
+		"""
+		settings = settings or {}
+		async_settings = settings.get('async', {})
+		self.max_in_flight = int(async_settings.get('max_in_flight', self.max_in_flight))
+		KeenMQTT.setup(self, mqtt_client, keen_client, settings)
+
+	def setup_upload_workers(self, worker_settings=None):
+		"""Upload worker threads are not used, uploads already run concurrently."""
+		logger.warning("AsyncKeenMQTT ignores upload_workers, use async.max_in_flight instead")
+
+	def setup_spool(self, spool_settings):
+		"""Keep events which could not be uploaded in an on-disk spool, see ``KeenMQTT.setup_spool``.
+
+		The spool is replayed from its own thread, with the uploads run on the event loop.
+		"""
+		KeenMQTT.setup_spool(self, spool_settings)
+		self.spool_replayer.upload_callback = self._upload_from_thread
+
+	def connect_mqtt_client(self, settings):
+		"""Create the MQTT client. It connects when ``start`` is awaited."""
+		mqtt_settings = settings['mqtt']
+		self.mqtt_client = self.create_mqtt_client(mqtt_settings)
+		self._mqtt_address = (mqtt_settings['host'], mqtt_settings['port'])
+
+	def connect_keen(self, settings):
+		"""Create an ``AsyncKeenUploader`` from the `keen` settings, gzipping uploads if there
+		is a `compression` key."""
+		if 'compression' in settings:
+			self.compressor = GzipCompressor.from_settings(settings['compression'])
+		self.keen_client = AsyncKeenUploader.from_settings(settings.get('keen'), self.max_in_flight, self.compressor)
+
+	async def start(self):
+		"""Connect and start relaying on the running event loop."""
+		self.loop = _running_loop()
+		self._loop_thread = threading.get_ident()
+		self._semaphore = asyncio.Semaphore(self.max_in_flight)
+		self.running = True
+		if self._mqtt_address is None:
+			self._watch_socket()
+		else:
+			await self._connect()
+		self._tasks.append(self.loop.create_task(self._maintain()))
+		if self.batcher and self.batcher.max_age:
+			self._tasks.append(self.loop.create_task(self._flush_batches()))
+
+	async def stop(self):
+		"""Disconnect and wait for every buffered and in-flight event to be uploaded."""
+		self.running = False
+		for task in self._tasks:
+			task.cancel()
+		await asyncio.gather(*self._tasks, return_exceptions=True)
+		self._tasks = []
+		if self._socket is not None:
+			self.mqtt_client.disconnect()
+			self.mqtt_client.loop_write()
+			self._unwatch_socket()
+		self.close_rollups(expired_only=False)
+		if self.batcher:
+			self.batcher.flush()
+		while self._uploads:
+			await asyncio.gather(*list(self._uploads), return_exceptions=True)
+		if self.spool:
+			# The replay thread may be waiting on an upload run by this loop, so it is
+			# joined from another thread.
+			await self.loop.run_in_executor(None, self.spool_replayer.stop)
+			self.spool.close()
+		if hasattr(self.keen_client, 'close'):
+			self.keen_client.close()
+		if self.recorder:
+			self.recorder.close()
+
+	def _wait_for_budget(self):
+		# ``_update_reader`` stops reading from the socket instead of blocking the loop.
+		pass
+
+	def _start_rollup_closer(self):
+		# ``_maintain`` closes expired rollup windows on the event loop instead.
+		pass
+
+	def get_stats(self):
+		"""Return a snapshot of the relay's stats, see ``KeenMQTT.get_stats``."""
+		stats = KeenMQTT.get_stats(self)
+		if isinstance(self.keen_client, AsyncKeenUploader):
+			stats['http_pool'] = self.keen_client.stats()
+		return stats
+
+	def step(self):
+		raise BackgroundRunningException("AsyncKeenMQTT is driven by the event loop, await start() instead")
+
+	async def _connect(self):
+		host, port = self._mqtt_address
+		if self._connected_once:
+			await self.loop.run_in_executor(None, self.mqtt_client.reconnect)
+		else:
+			await self.loop.run_in_executor(None, self.mqtt_client.connect, host, port)
+			self._connected_once = True
+		self._watch_socket()
+
+	def _watch_socket(self):
+		self._socket = self.mqtt_client.socket()
+		self._update_reader()
+		self._update_writer()
+
+	def _unwatch_socket(self):
+		if self._socket is None:
+			return
+		if self._reading:
+			self.loop.remove_reader(self._socket)
+			self._reading = False
+		if self._writing:
+			self.loop.remove_writer(self._socket)
+			self._writing = False
+		self._socket = None
+
+	def _on_readable(self):
+		rc = self.mqtt_client.loop_read(100)
+		if rc or self.mqtt_client.socket() is None:
+			logger.warning("MQTT connection lost (rc={})".format(rc))
+			self._unwatch_socket()
+			return
+		self._update_writer()
+
+	def _update_reader(self):
+		"""Read from the MQTT socket unless a blocking memory budget is exceeded."""
+		if self._socket is None:
+			return
+		budget = self.budget
+		if budget is None or budget.policy != BLOCK or not budget.exceeded():
+			if not self._reading:
+				self.loop.add_reader(self._socket, self._on_readable)
+				self._reading = True
+		elif self._reading:
+			self.loop.remove_reader(self._socket)
+			self._reading = False
+			budget.blocked += 1
+
+	def _on_writable(self):
+		self.mqtt_client.loop_write()
+		self._update_writer()
+
+	def _update_writer(self):
+		if self._socket is None:
+			return
+		if self.mqtt_client.want_write():
+			if not self._writing:
+				self.loop.add_writer(self._socket, self._on_writable)
+				self._writing = True
+		elif self._writing:
+			self.loop.remove_writer(self._socket)
+			self._writing = False
+
+	async def _maintain(self):
+		"""Send keep-alives, close expired rollup windows, and reconnect with a growing delay
+		after the connection drops."""
+		delay = 1.0
+		while self.running:
+			await asyncio.sleep(1.0)
+			if self.rollups:
+				self.close_rollups()
+			if self._socket is not None:
+				self.mqtt_client.loop_misc()
+				if self.mqtt_client.socket() is None:
+					self._unwatch_socket()
+				else:
+					self._update_writer()
+			if self._socket is None and self._mqtt_address is not None:
+				try:
+					await self._connect()
+					delay = 1.0
+				except OSError as e:
+					logger.warning("MQTT reconnect failed: {}".format(e))
+					await asyncio.sleep(delay)
+					delay = min(delay * 2, 60.0)
+
+	async def _flush_batches(self):
+		interval = min(self.batcher.max_age / 2.0, 1.0)
+		while True:
+			await asyncio.sleep(interval)
+			self.batcher.flush_expired()
+
+	def push_event(self, collection, event):
+		"""Upload an event in a new task, or buffer it if batching is enabled.
+
+		Args:
+			collection (str): The collection string to push to
+			event (dict): The complete event to push
+		Returns:
+			None
+		"""
+		assert self.ready == True
+		if logger.isEnabledFor(logging.DEBUG):
+			logger.debug("Saving event to collection {collection}: '{event}'".format(collection=collection, event=event))
+		budget = self.budget
+		if budget is not None:
+			if not budget.acquire(collection, event, block=False):
+				return
+			if self._reading and budget.exceeded():
+				self._update_reader()
+		if self.batcher:
+			self.batcher.add(collection, event)
+		else:
+			self.dispatch_events({collection: [event]})
+
+	def dispatch_events(self, events):
+		"""Start a task uploading a batch of events. Safe to call from other threads.
+
+		Args:
+			events (dict): A dictionary of collection names to lists of events.
+		Returns:
+			None
+		"""
+		if threading.get_ident() == self._loop_thread:
+			self._start_upload(events)
+		else:
+			self.loop.call_soon_threadsafe(self._start_upload, events)
+
+	def _start_upload(self, events):
+		task = self.loop.create_task(self.deliver_events(events))
+		self._uploads.add(task)
+		task.add_done_callback(self._uploads.discard)
+
+	async def deliver_events(self, events):
+		"""Upload a batch of events once a request slot is free, spooling them if the upload fails.
+
+		Args:
+			events (dict): A dictionary of collection names to lists of events.
+		Returns:
+			None
+		"""
+		async with self._semaphore:
+			try:
+				await self.upload_events(events)
+			except Exception:
+				if self.spool is None:
+					logger.exception("Upload failed, dropping events")
+					return
+				logger.warning("Upload failed, spooling events", exc_info=True)
+				self.spool.append(events)
+			finally:
+				if self.budget is not None:
+					self.budget.release(events)
+					if not self._reading:
+						self._update_reader()
+
+	async def upload_events(self, events):
+		"""Upload a batch of events with a single Keen IO bulk request.
+
+		Args:
+			events (dict): A dictionary of collection names to lists of events.
+		Returns:
+			None
+		"""
+		count = sum(len(batch) for batch in events.values())
+		logger.debug("Uploading {count} events to {collections} collections".format(count=count, collections=len(events)))
+		try:
+			results = await self.keen_client.add_events(events)
+		except Exception:
+			self._record_upload_error(events)
+			raise
+		self._record_upload(events, results)
+
+	def _upload_from_thread(self, events):
+		if self.loop is None:
+			raise RuntimeError("AsyncKeenMQTT has not been started")
+		asyncio.run_coroutine_threadsafe(self.upload_events(events), self.loop).result()
@@ -1,34 +1,386 @@
 """ Functions and classes for a command line app version of keenmqtt """
 
 import logging
-import yaml
+import os
+import signal
 import time
 import click
 
 from keenmqtt import KeenMQTT
+from keenmqtt.backfill import Backfill, JSONL, CSV
+from keenmqtt.batching import EventBatcher
+from keenmqtt.budget import MemoryBudget
+from keenmqtt.compression import GzipCompressor
+from keenmqtt.decoders import DecoderSelector
+from keenmqtt.dedup import Deduplicator
+from keenmqtt.downsampling import Downsampler
+from keenmqtt.matching import check_subscription
+from keenmqtt.recording import Replayer
+from keenmqtt.rollups import Rollup
+from keenmqtt.sharding import Supervisor, SHARED, HASH
+from keenmqtt.spool import DROP_OLDEST, DROP_NEWEST
+from keenmqtt.stats import Stats, StatsServer
+from keenmqtt.subscriptions import Subscriber, check_qos
+from keenmqtt.timestamps import Timestamper
+from keenmqtt.transforms import compile_transform
+from keenmqtt.upload import UploadWorkerPool
 
 
-@click.command()
+def start_stats_server(get_stats, config, stats_port):
+	"""Start serving stats over HTTP if a port is configured.
+
+	Args:
+		get_stats (callable): Returns the stats dictionary.
+		config (dict): The settings read from config.yaml.
+		stats_port Optional[int]: Port from the command line, overriding the config file.
+	Return:
+		StatsServer: The running server, or ``None``.
+	"""
+	stats_settings = config.get('stats', {})
+	if stats_port is None:
+		stats_port = stats_settings.get('http_port')
+	if stats_port is None:
+		return None
+	stats_server = StatsServer(get_stats, stats_settings.get('http_host', '127.0.0.1'), stats_port)
+	stats_server.start()
+	return stats_server
+
+
+def load_config(path):
+	"""Read the settings from a YAML config file."""
+	# Imported here so that commands which never read a config file do not pay for it.
+	import yaml
+	with open(path) as configfp:
+		return yaml.safe_load(configfp)
+
+
+def _check_mapping(subscription, mapping):
+	check_subscription(subscription)
+	if isinstance(mapping, dict):
+		check_qos(mapping.get('qos', 0))
+		compile_transform(mapping)
+		Downsampler.from_settings(mapping.get('downsample'))
+		Rollup.from_settings(mapping['collection'], None, mapping.get('rollup'))
+
+
+def _check_spool(settings):
+	settings['directory']
+	if settings.get('drop_policy', DROP_OLDEST) not in (DROP_OLDEST, DROP_NEWEST):
+		raise ValueError("Unknown spool drop policy '{}'".format(settings['drop_policy']))
+	for key in ('segment_size', 'max_bytes', 'replay_max_events'):
+		int(settings.get(key, 0))
+	float(settings.get('replay_interval', 10.0))
+
+
+def _check_recording(settings):
+	settings['directory']
+	int(settings.get('segment_size', 0))
+	int(settings.get('max_segments', 0))
+
+
+def _check_sharding(settings):
+	int(settings.get('workers', 1))
+	if settings.get('mode', SHARED) not in (SHARED, HASH):
+		raise ValueError("Unknown sharding mode '{}'".format(settings['mode']))
+
+
+# How to check each section of the config file, without connecting or touching the disk.
+_SECTION_CHECKS = (
+	('timestamps', Timestamper.from_settings),
+	('decoders', lambda settings: DecoderSelector.from_settings(settings)),
+	('default_decoder', lambda name: DecoderSelector(name)),
+	('dedup', Deduplicator.from_settings),
+	('batching', lambda settings: EventBatcher.from_settings(None, settings)),
+	('upload_workers', lambda settings: UploadWorkerPool.from_settings(None, settings)),
+	('compression', GzipCompressor.from_settings),
+	('memory_budget', MemoryBudget.from_settings),
+	('stats', lambda settings: Stats(settings.get('sample_every', 16))),
+	('collection_cache_size', int),
+	('spool', _check_spool),
+	('recording', _check_recording),
+	('subscriptions', Subscriber.from_settings),
+	('sharding', _check_sharding),
+)
+
+
+def check_config(config):
+	"""Check a config file's settings without connecting to anything.
+
+	Every section is parsed the way ``KeenMQTT.setup`` would, but no clients, threads or
+	directories are created.
+
+	Args:
+		config (dict): The settings read from config.yaml.
+	Return:
+		list: A message for each problem found, empty if there are none.
+	"""
+	if not isinstance(config, dict):
+		return ["The config file must hold a mapping of settings"]
+	problems = []
+
+	def check(name, section_check, *args):
+		try:
+			section_check(*args)
+		except (KeyError, TypeError, ValueError, AttributeError) as e:
+			if isinstance(e, KeyError):
+				e = "missing {}".format(e)
+			problems.append("{}: {}".format(name, e))
+
+	mqtt = config.get('mqtt')
+	check('mqtt', lambda: (mqtt['host'], int(mqtt['port'])))
+	if 'keen' in config:
+		check('keen', lambda: config['keen']['project_id'])
+	for name, section_check in _SECTION_CHECKS:
+		if name in config:
+			check(name, section_check, config[name])
+	for subscription, mapping in (config.get('collection_mappings') or {}).items():
+		check("collection_mappings: '{}'".format(subscription), _check_mapping, subscription, mapping)
+	return problems
+
+
+class ConfigReloader(object):
+	"""Apply changes to the collection mappings of a config file while the relay runs.
+
+	A reload is requested with SIGHUP or, when watching, by the file's modification time or
+	size changing. The file is checked with ``check_config`` first and kept out if it has
+	problems. Changes to other sections are logged, as they need a restart.
+
+	Args:
+		path (str): The config file.
+		config (dict): The settings the relay was started with.
+		apply (callable): Called with the new `collection_mappings`, such as
+			``KeenMQTT.reload_collection_mappings``.
+		watch (bool): Also reload when the file changes.
+	"""
+
+	def __init__(self, path, config, apply, watch=False):
+		self.path = path
+		self.config = config
+		self.apply = apply
+		self.watch = watch
+		self.reloads = 0
+		# A plain flag, as a signal handler must not take the locks of a threading.Event.
+		self._requested = False
+		self._file_state = self._stat()
+
+	def install_signal_handler(self):
+		"""Reload on SIGHUP, where the platform has it. Call from the main thread."""
+		if hasattr(signal, 'SIGHUP'):
+			signal.signal(signal.SIGHUP, lambda signum, frame: self.request())
+
+	def request(self):
+		"""Ask for a reload at the end of the current ``wait``."""
+		self._requested = True
+
+	def wait(self, timeout):
+		"""Sleep for ``timeout`` seconds, then reload if asked to or if the file changed.
+
+		Return:
+			bool: Whether the config was reloaded.
+		"""
+		time.sleep(timeout)
+		requested = self._requested or (self.watch and self._stat() != self._file_state)
+		if not requested:
+			return False
+		self._requested = False
+		return self.reload()
+
+	def reload(self):
+		"""Read the config file and apply its collection mappings.
+
+		Return:
+			bool: Whether the new mappings were applied.
+		"""
+		import yaml
+		self._file_state = self._stat()
+		try:
+			config = load_config(self.path)
+		except (IOError, OSError, yaml.YAMLError) as e:
+			logging.error("Not reloading {}: {}".format(self.path, e))
+			return False
+		problems = check_config(config)
+		if problems:
+			for problem in problems:
+				logging.error("Not reloading {}: {}".format(self.path, problem))
+			return False
+		changed = sorted(name for name in set(config) | set(self.config)
+			if name != 'collection_mappings' and config.get(name) != self.config.get(name))
+		if changed:
+			logging.warning("Restart to apply the changes to {}".format(', '.join(changed)))
+		try:
+			self.apply(config.get('collection_mappings') or {})
+		except (KeyError, TypeError, ValueError):
+			logging.exception("Could not reload the collection mappings of {}".format(self.path))
+			return False
+		self.config = dict(self.config, collection_mappings=config.get('collection_mappings'))
+		self.reloads += 1
+		logging.info("Reloaded {}".format(self.path))
+		return True
+
+	def _stat(self):
+		try:
+			state = os.stat(self.path)
+		except OSError:
+			return None
+		return state.st_mtime, state.st_size
+
+
+@click.group(invoke_without_command=True)
 @click.option('-c', '--config', default="config.yaml", help="Relative path to config file, defaults to config.yaml.")
-def main(config):
+@click.option('--stats-port', type=int, default=None, help="Serve stats over HTTP on this port, overriding the config file.")
+@click.option('-w', '--workers', type=int, default=None, help="Number of relay processes, overriding the config file.")
+@click.option('--shard-mode', type=click.Choice([SHARED, HASH]), default=None,
+	help="How workers split messages: shared subscriptions, or a topic hash for brokers without them.")
+@click.option('--watch-config', is_flag=True, default=False,
+	help="Reload the collection mappings when the config file changes, as on SIGHUP.")
+@click.pass_context
+def main(ctx, config, stats_port, workers, shard_mode, watch_config):
+	"""Relay MQTT messages to Keen IO, or run one of the commands below."""
+	ctx.obj = {'config': config}
+	if ctx.invoked_subcommand is not None:
+		return
 
-	with open(config) as configfp:
-		config = yaml.load(configfp)
+	config_path = config
+	config = load_config(config_path)
 
 	logging.basicConfig(level=logging.DEBUG)
 	logging.getLogger("requests").setLevel(logging.WARNING)
 
+	sharding = config.get('sharding', {})
+	if workers is None:
+		workers = int(sharding.get('workers', 1))
+	if workers > 1:
+		supervisor = Supervisor(config, workers, shard_mode or sharding.get('mode', SHARED),
+			sharding.get('group', 'keenmqtt'))
+		stats_server = start_stats_server(supervisor.get_stats, config, stats_port)
+		reloader = ConfigReloader(config_path, config, supervisor.reload_collection_mappings, watch_config)
+		reloader.install_signal_handler()
+		logging.info("starting {} relay workers".format(workers))
+		supervisor.run(wait=reloader.wait)
+		if stats_server:
+			stats_server.stop()
+		return
+
 	keenmqtt = KeenMQTT()
 	keenmqtt.setup(settings=config)
+	stats_server = start_stats_server(keenmqtt.get_stats, config, stats_port)
+
+	reloader = ConfigReloader(config_path, config, keenmqtt.reload_collection_mappings, watch_config)
+	reloader.install_signal_handler()
+
 	logging.info("starting")
 	keenmqtt.start()
 
 	try:
 		while True:
-			time.sleep(10)
-	except KeyboardInterrupt() as e:
+			reloader.wait(1.0)
+	except KeyboardInterrupt:
 		logging.info("shutting down")
 		keenmqtt.stop()
+		if stats_server:
+			stats_server.stop()
+
+
+@main.command('check-config')
+@click.pass_context
+def check_config_command(ctx):
+	"""Check the config file, without connecting to the broker or Keen IO."""
+	import yaml
+	path = ctx.obj['config']
+	try:
+		config = load_config(path)
+	except (IOError, OSError) as e:
+		ctx.fail("Cannot read {}: {}".format(path, e))
+	except yaml.YAMLError as e:
+		ctx.fail("Cannot parse {}: {}".format(path, e))
+	problems = check_config(config)
+	for problem in problems:
+		click.echo(problem, err=True)
+	if problems:
+		ctx.exit(1)
+	click.echo("{} is valid".format(path))
+
+
+@main.command()
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice([JSONL, CSV]), default=None,
+	help="Format of the dump, detected from the file name by default.")
+@click.option('-d', '--decode-workers', type=int, default=None,
+	help="Number of processes decoding payloads, one less than the number of CPUs by default, "
+	"at least 1 and at most 4.")
+@click.option('--offset', type=int, default=None, help="Byte offset of the first record to read.")
+@click.option('--checkpoint', type=click.Path(dir_okay=False), default=None,
+	help="File recording the offset of the records uploaded so far, resumed from if it exists.")
+@click.option('--chunk-size', type=int, default=1000, help="Records decoded at a time.")
+@click.option('--progress-interval', type=float, default=5.0, help="Seconds between progress reports.")
+@click.pass_context
+def backfill(ctx, path, fmt, decode_workers, offset, checkpoint, chunk_size, progress_interval):
+	"""Upload the MQTT messages recorded in a JSON Lines or CSV file, optionally gzipped.
+
+	The messages go through the same pipeline as live ones, without a broker. See
+	keenmqtt.backfill for the file formats.
+	"""
+	config = load_config(ctx.obj['config'])
+	config.pop('recording', None)
+
+	logging.basicConfig(level=logging.INFO)
+	logging.getLogger("requests").setLevel(logging.WARNING)
+
+	keenmqtt = KeenMQTT()
+	# The MQTT client is never connected, messages come from the file instead.
+	keenmqtt.setup(mqtt_client=keenmqtt.create_mqtt_client(dict(config.get('mqtt') or {})), settings=config)
+
+	def report(progress):
+		click.echo("{records} records, {failed} failed, {percent:.1f}% read, {rate:.0f} records/s".format(**progress))
+
+	if decode_workers is None:
+		# The relay's pipeline runs in this process, so leave it a CPU of its own.
+		import multiprocessing
+		decode_workers = max(1, min(4, multiprocessing.cpu_count() - 1))
+
+	job = Backfill(keenmqtt, path, fmt=fmt, workers=decode_workers, settings=config, chunk_size=chunk_size,
+		checkpoint=checkpoint, progress=report, progress_interval=progress_interval)
+	if offset is None:
+		offset = job.read_checkpoint()
+	if offset:
+		click.echo("resuming from offset {}".format(offset))
+	try:
+		progress = job.run(offset)
+	finally:
+		keenmqtt.stop()
+	if progress['upload_failures']:
+		click.echo("{} uploads failed, run again to upload their records".format(progress['upload_failures']), err=True)
+		ctx.exit(1)
+
+
+@main.command()
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--speed', type=float, default=1.0,
+	help="Multiple of the recorded pace to replay at, 0 for as fast as possible.")
+@click.pass_context
+def replay(ctx, path, speed):
+	"""Relay the MQTT messages of a traffic recording, a segment file or a directory of them.
+
+	The messages go through the same pipeline as live ones, without a broker. See
+	keenmqtt.recording for how traffic is recorded.
+	"""
+	config = load_config(ctx.obj['config'])
+	config.pop('recording', None)
+
+	logging.basicConfig(level=logging.INFO)
+	logging.getLogger("requests").setLevel(logging.WARNING)
+
+	keenmqtt = KeenMQTT()
+	# The MQTT client is never connected, messages come from the recording instead.
+	keenmqtt.setup(mqtt_client=keenmqtt.create_mqtt_client(dict(config.get('mqtt') or {})), settings=config)
+	if keenmqtt.batcher:
+		# Without start, which would run the MQTT client, batches still need to age out.
+		keenmqtt.batcher.start()
+	try:
+		result = Replayer(keenmqtt, path, speed).run()
+	finally:
+		keenmqtt.stop()
+	click.echo("{messages} messages in {seconds:.1f}s, {rate:.0f} messages/s, at most {max_lag:.3f}s behind".format(**result))
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,355 @@
+""" Offline backfill of recorded MQTT messages, bypassing the broker.
+
+Records are read from a JSON Lines or CSV file, optionally gzipped. Each JSON line is an
+object with ``topic`` and ``payload`` keys, where the payload is a string or already decoded
+JSON, and an optional ``time``. A CSV file has a header row naming a ``topic``, a
+``payload`` and an optional ``time`` column. Times are Unix seconds or ISO-8601 strings, and
+are used as the time each message was received, so with ``timestamps: {source: receive}``
+events keep their original timestamps.
+
+Records are read a chunk at a time, decoded by a pool of worker processes when the relay's
+``decode_payload`` is not overridden, and then run through the relay's pipeline and bulk
+upload path in order. Resuming from a checkpoint's byte offset starts at the next record.
+"""
+
+import csv
+import gzip
+import io
+import json
+import logging
+import marshal
+import os
+import time
+from collections import deque
+
+from .decoders import DecoderSelector, decode_json, decode_json_stdlib, fast_loads
+from .keenmqtt import KeenMQTT, _function
+from .stats import clock
+from .timestamps import Timestamper
+
+logger = logging.getLogger('keenmqtt')
+
+JSONL = 'jsonl'
+CSV = 'csv'
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_JSON_DECODERS = (decode_json, decode_json_stdlib)
+_timestamper = Timestamper()
+_replace = getattr(os, 'replace', os.rename)
+
+# The payload decoders of a worker process, see ``_init_worker``.
+_worker_decoders = None
+
+
+def detect_format(path):
+	"""Return ``csv`` for paths ending in ``.csv`` or ``.csv.gz``, and ``jsonl`` otherwise."""
+	name = path[:-3] if path.endswith('.gz') else path
+	return CSV if name.endswith('.csv') else JSONL
+
+
+def open_dump(path):
+	"""Open a dump for reading as bytes, decompressing it if it is gzipped.
+
+	Return:
+		file: The open file, which can seek to an offset in the uncompressed data.
+	"""
+	with open(path, 'rb') as dump:
+		gzipped = dump.read(2) == _GZIP_MAGIC
+	if gzipped:
+		return gzip.open(path, 'rb')
+	return io.open(path, 'rb')
+
+
+def parse_time(value):
+	"""Return the Unix time of a record's ``time``, or ``None`` if it has none."""
+	if value is None or value == '':
+		return None
+	if isinstance(value, (int, float)):
+		return float(value)
+	try:
+		return float(value)
+	except ValueError:
+		return _timestamper.parse(value)
+
+
+def decode_records(fmt, columns, items, decode, decoders=None):
+	"""Parse a chunk of dump records and decode their payloads.
+
+	Args:
+		fmt (str): ``jsonl`` or ``csv``.
+		columns Optional[tuple]: For CSV, the indexes of the topic, payload and time columns.
+		items (list): JSON lines as bytes, or CSV rows.
+		decode (callable): Called with a topic and payload bytes, as ``decode_payload`` is.
+		decoders Optional[DecoderSelector]: Used to find payloads which were recorded as
+			decoded JSON, and can be used as they are.
+	Return:
+		tuple: A list of ``(topic, messages, time, decode_seconds)`` tuples, and the number of
+		records which could not be parsed or decoded.
+	"""
+	decoded = []
+	failed = 0
+	for item in items:
+		try:
+			if fmt == CSV:
+				topic = item[columns[0]]
+				payload = item[columns[1]]
+				received_at = parse_time(item[columns[2]]) if columns[2] is not None else None
+			else:
+				record = fast_loads(item)
+				topic = record['topic']
+				payload = record['payload']
+				received_at = parse_time(record.get('time'))
+			start = clock()
+			if isinstance(payload, bytes):
+				messages = decode(topic, payload)
+			elif not isinstance(payload, (dict, list)):
+				messages = decode(topic, payload.encode('utf-8'))
+			elif decoders is not None and decoders.for_topic(topic) in _JSON_DECODERS:
+				messages = [payload]
+			else:
+				messages = decode(topic, json.dumps(payload).encode('utf-8'))
+			decoded.append((topic, messages, received_at, clock() - start))
+		except (KeyError, IndexError, TypeError, ValueError) as e:
+			logger.debug("Skipping bad backfill record: {}".format(e))
+			failed += 1
+	return decoded, failed
+
+
+def _init_worker(decoder_settings, default_decoder):
+	global _worker_decoders
+	_worker_decoders = DecoderSelector.from_settings(decoder_settings, default_decoder)
+
+
+def _decode_in_worker(fmt, columns, items):
+	decoders = _worker_decoders
+	decoded, failed = decode_records(fmt, columns, items,
+		lambda topic, payload: decoders.for_topic(topic)(topic, payload), decoders)
+	try:
+		# Decoded JSON marshals and unmarshals faster than it pickles, which matters because
+		# the main process loads every chunk. Custom decoders may return other types.
+		return marshal.dumps(decoded), failed
+	except ValueError:
+		return decoded, failed
+
+
+def _load_decoded(result):
+	decoded, failed = result
+	if isinstance(decoded, bytes):
+		decoded = marshal.loads(decoded)
+	return decoded, failed
+
+
+class Backfill(object):
+	"""Run the records of a dump through a relay's pipeline as fast as possible.
+
+	The relay should be set up, but not started. Events are uploaded in bulk, batching is
+	set up with the defaults if the relay has none.
+
+	Args:
+		relay (KeenMQTT): The relay.
+		path (str): The dump file.
+		fmt Optional[str]: ``jsonl`` or ``csv``, detected from the file name by default.
+		workers (int): The number of decode worker processes. ``0`` decodes in this process,
+			as does a relay which overrides ``decode_payload``.
+		settings Optional[dict]: The relay's settings, whose `decoders` and `default_decoder`
+			keys configure the workers' decoders.
+		chunk_size (int): Records read and decoded at a time.
+		checkpoint Optional[str]: A file to record the offset of the records uploaded so far.
+		checkpoint_interval (float): Seconds between checkpoints.
+		progress Optional[callable]: Called with the dictionary returned by ``progress``.
+		progress_interval (float): Seconds between calls to ``progress``.
+	"""
+
+	def __init__(self, relay, path, fmt=None, workers=0, settings=None, chunk_size=1000, checkpoint=None,
+			checkpoint_interval=10.0, progress=None, progress_interval=5.0):
+		self.relay = relay
+		self.path = path
+		self.format = fmt or detect_format(path)
+		if self.format not in (JSONL, CSV):
+			raise ValueError("Unknown backfill format '{}'".format(self.format))
+		self.workers = workers
+		self.settings = settings or {}
+		self.chunk_size = chunk_size
+		self.checkpoint = checkpoint
+		self.checkpoint_interval = checkpoint_interval
+		self.on_progress = progress
+		self.progress_interval = progress_interval
+		self.records = 0
+		self.failed = 0
+		self.upload_failures = 0
+		self.offset = 0
+		# The offset and records processed before the chunk which opened each open rollup
+		# window, keyed by mapping, topic and window.
+		self._window_starts = {}
+		self.started = None
+		self._size = os.path.getsize(path)
+		self._stream = None
+
+	def read_checkpoint(self):
+		"""Return the offset recorded in the checkpoint file, or ``0`` if there is none."""
+		if not self.checkpoint or not os.path.exists(self.checkpoint):
+			return 0
+		with open(self.checkpoint) as checkpoint:
+			return int(json.load(checkpoint)['offset'])
+
+	def run(self, offset=0):
+		"""Backfill every record from ``offset`` to the end of the file.
+
+		Args:
+			offset (int): Byte offset, in the uncompressed data, of the first record to read.
+		Return:
+			dict: The final progress, see ``progress``.
+		"""
+		relay = self.relay
+		if relay.batcher is None:
+			relay.setup_batching()
+		pool = None
+		if self.workers > 0 and self._default_decoder():
+			import multiprocessing
+			pool = multiprocessing.Pool(self.workers, _init_worker,
+				(self.settings.get('decoders'), self.settings.get('default_decoder', 'json')))
+		self.started = time.time()
+		self.offset = offset
+		last_progress = last_checkpoint = self.started
+		pending = deque()
+		self._stream = open_dump(self.path)
+		try:
+			for columns, items, end in self._read(offset):
+				if pool is not None:
+					pending.append((pool.apply_async(_decode_in_worker, (self.format, columns, items)), end))
+					if len(pending) <= 2 * self.workers:
+						continue
+					result, end = pending.popleft()
+					self._process(_load_decoded(result.get()), end)
+				else:
+					self._process(decode_records(self.format, columns, items, relay.decode_payload), end)
+				now = time.time()
+				if self.checkpoint and now - last_checkpoint >= self.checkpoint_interval:
+					self.write_checkpoint()
+					last_checkpoint = now
+				if self.on_progress and now - last_progress >= self.progress_interval:
+					self.on_progress(self.progress())
+					last_progress = now
+			while pending:
+				result, end = pending.popleft()
+				self._process(_load_decoded(result.get()), end)
+		finally:
+			if pool is not None:
+				pool.terminate()
+				pool.join()
+			self._stream.close()
+		relay.close_rollups(expired_only=False)
+		self._window_starts = {}
+		if self.checkpoint:
+			self.write_checkpoint()
+		else:
+			self.upload_failures += relay.drain()
+		progress = self.progress()
+		if self.on_progress:
+			self.on_progress(progress)
+		return progress
+
+	def write_checkpoint(self):
+		"""Wait for the events pushed so far to be uploaded, then record the offset reached.
+
+		Rollup windows are left open, so each window gives one event however often the
+		checkpoint is written, and the offset recorded is that of the chunk which opened the
+		oldest open window, so resuming rolls its records up again. Once an upload has failed
+		and its events were dropped, the checkpoint is left where it was for the rest of the
+		run, so resuming uploads those records again.
+
+		Return:
+			bool: Whether the checkpoint was written.
+		"""
+		failures = self.relay.drain()
+		if failures and not self.upload_failures:
+			logger.warning("{} uploads failed, not advancing the checkpoint past offset {}".format(
+				failures, self.read_checkpoint()))
+		self.upload_failures += failures
+		if self.upload_failures:
+			return False
+		temporary = self.checkpoint + '.tmp'
+		offset, records = min(self._window_starts.values()) if self._window_starts else (self.offset, self.records)
+		with open(temporary, 'w') as checkpoint:
+			json.dump({'path': self.path, 'offset': offset, 'records': records}, checkpoint)
+		_replace(temporary, self.checkpoint)
+		return True
+
+	def progress(self):
+		"""Return the records processed and failed, the uploads failed, the offset reached, the
+		share of the file read, the seconds elapsed and the records processed per second."""
+		elapsed = time.time() - self.started if self.started else 0.0
+		position = self.offset
+		if self._stream is not None and hasattr(self._stream, 'fileobj') and self._stream.fileobj is not None:
+			# For gzipped dumps, compare the compressed bytes read with the file size.
+			position = self._stream.fileobj.tell()
+		return {
+			'records': self.records,
+			'failed': self.failed,
+			'upload_failures': self.upload_failures,
+			'offset': self.offset,
+			'percent': min(100.0, 100.0 * position / self._size) if self._size else 100.0,
+			'seconds': elapsed,
+			'rate': self.records / elapsed if elapsed > 0 else 0.0,
+		}
+
+	def _default_decoder(self):
+		relay = self.relay
+		return ('decode_payload' not in relay.__dict__ and
+			_function(type(relay).decode_payload) is _function(KeenMQTT.decode_payload))
+
+	def _process(self, result, end):
+		decoded, failed = result
+		relay = self.relay
+		start = (self.offset, self.records)
+		for topic, messages, received_at, seconds in decoded:
+			relay.received_at = received_at if received_at is not None else time.time()
+			relay.process_messages(topic, messages, seconds)
+		self.records += len(decoded)
+		self.failed += failed
+		self.offset = end
+		if self.checkpoint and relay.rollups:
+			window_starts = {}
+			for mapping, rollup in relay.rollups.items():
+				for topic, window in rollup.open_windows():
+					key = (mapping, topic, window)
+					window_starts[key] = self._window_starts.get(key, start)
+			self._window_starts = window_starts
+
+	def _read(self, offset):
+		"""Yield chunks of records as ``(columns, items, end offset)`` tuples."""
+		stream = self._stream
+		columns = None
+		position = [offset]
+		if self.format == CSV:
+			header = stream.readline()
+			names = next(csv.reader([header.decode('utf-8')]))
+			if 'topic' not in names or 'payload' not in names:
+				raise ValueError("A backfill CSV file needs topic and payload columns, not {}".format(names))
+			columns = (names.index('topic'), names.index('payload'), names.index('time') if 'time' in names else None)
+			if offset:
+				stream.seek(offset)
+			else:
+				position[0] = len(header)
+		else:
+			stream.seek(offset)
+
+		def lines():
+			for line in stream:
+				position[0] += len(line)
+				yield line
+
+		items = []
+		if self.format == CSV:
+			records = csv.reader(line.decode('utf-8') for line in lines())
+		else:
+			records = lines()
+		for item in records:
+			if not item or (self.format == JSONL and not item.strip()):
+				continue
+			items.append(item)
+			if len(items) >= self.chunk_size:
+				yield columns, items, position[0]
+				items = []
+		if items:
+			yield columns, items, position[0]
@@ -0,0 +1,137 @@
+""" Grouping of events into bulk uploads for Keen IO """
+
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger('keenmqtt')
+
+
+class EventBatcher(object):
+	"""Buffer events per collection and hand them on in bulk.
+
+	Events are held until one of the thresholds is reached, at which point every buffered
+	event is passed to ``flush_callback`` as a dictionary of collection name to a list of
+	events, which is the format expected by ``KeenClient.add_events``.
+
+	Args:
+		flush_callback (callable): Called with a ``{collection: [event, ...]}`` dictionary.
+		max_events (int): Flush once this many events are buffered. ``0`` disables the check.
+		max_bytes (int): Flush once the JSON size of the buffered events reaches this. ``0``
+			disables the check, which avoids serialising each event an extra time.
+		max_age (float): Flush once the oldest buffered event is this many seconds old.
+			``0`` disables the check.
+	"""
+
+	def __init__(self, flush_callback, max_events=500, max_bytes=0, max_age=1.0):
+		self.flush_callback = flush_callback
+		self.max_events = max_events
+		self.max_bytes = max_bytes
+		self.max_age = max_age
+		self._lock = threading.Lock()
+		self._buffer = {}
+		self._count = 0
+		self._bytes = 0
+		self._oldest = None
+		self._thread = None
+		self._stopping = threading.Event()
+
+	@classmethod
+	def from_settings(cls, flush_callback, settings):
+		"""Create a batcher from the ``batching`` section of a config file.
+
+		Args:
+			flush_callback (callable): See the class documentation.
+			settings (dict): Dictionary with optional ``max_events``, ``max_bytes`` and
+				``max_age`` keys.
+		Return:
+			EventBatcher: The new batcher.
+		"""
+		settings = settings or {}
+		return cls(flush_callback,
+			max_events=int(settings.get('max_events', 500)),
+			max_bytes=int(settings.get('max_bytes', 0)),
+			max_age=float(settings.get('max_age', 1.0)))
+
+	def add(self, collection, event):
+		"""Buffer a single event, flushing if any threshold has been reached.
+
+		Args:
+			collection (str): The collection to push to.
+			event (dict): The complete event.
+		Return:
+			None
+		"""
+		with self._lock:
+			if self._count == 0:
+				self._oldest = time.time()
+			self._buffer.setdefault(collection, []).append(event)
+			self._count += 1
+			if self.max_bytes:
+				self._bytes += len(json.dumps(event))
+			batch = self._take_if_due()
+		if batch:
+			self.flush_callback(batch)
+
+	def flush(self):
+		"""Hand every buffered event on, regardless of the thresholds."""
+		with self._lock:
+			batch = self._take()
+		if batch:
+			self.flush_callback(batch)
+
+	def flush_expired(self):
+		"""Flush only if the oldest buffered event is older than ``max_age``."""
+		with self._lock:
+			batch = self._take_if_due()
+		if batch:
+			self.flush_callback(batch)
+
+	def pending(self):
+		"""Return the number of events currently buffered."""
+		return self._count
+
+	def start(self):
+		"""Start a background thread which enforces ``max_age`` when no events arrive."""
+		if self._thread is not None or not self.max_age:
+			return
+		self._stopping.clear()
+		self._thread = threading.Thread(target=self._run, name='keenmqtt-batcher')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		"""Stop the background thread and flush whatever is still buffered."""
+		if self._thread is not None:
+			self._stopping.set()
+			self._thread.join()
+			self._thread = None
+		self.flush()
+
+	def _run(self):
+		interval = min(self.max_age / 2.0, 1.0)
+		while not self._stopping.wait(interval):
+			try:
+				self.flush_expired()
+			except Exception:
+				logger.exception("Failed to flush expired batch")
+
+	def _take_if_due(self):
+		if not self._count:
+			return None
+		if self.max_events and self._count >= self.max_events:
+			return self._take()
+		if self.max_bytes and self._bytes >= self.max_bytes:
+			return self._take()
+		if self.max_age and time.time() - self._oldest >= self.max_age:
+			return self._take()
+		return None
+
+	def _take(self):
+		batch = self._buffer
+		self._buffer = {}
+		self._count = 0
+		self._bytes = 0
+		self._oldest = None
+		return batch
@@ -0,0 +1,232 @@
+""" A memory budget for events waiting to be uploaded, with overload policies """
+
+import logging
+import sys
+import threading
+import time
+
+from .spool import DROP_OLDEST, DROP_NEWEST
+
+logger = logging.getLogger('keenmqtt')
+
+BLOCK = 'block'
+SAMPLE = 'sample'
+
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, SAMPLE)
+
+_getsizeof = sys.getsizeof
+
+
+def event_size(value):
+	"""Estimate the memory held by an event, in bytes.
+
+	The sizes of the dictionaries, lists and values making up the event are added up.
+	Strings shared between events, such as field names, are counted for every event, so
+	the estimate errs on the high side.
+
+	Args:
+		value: The event, or any value within it.
+	Return:
+		int: The estimated size.
+	"""
+	size = _getsizeof(value)
+	kind = type(value)
+	if kind is dict:
+		for key, item in value.items():
+			size += _getsizeof(key) + event_size(item)
+	elif kind is list or kind is tuple:
+		for item in value:
+			size += event_size(item)
+	return size
+
+
+class MemoryBudget(object):
+	"""Limit the estimated memory held by events which have been pushed but not yet uploaded.
+
+	Events are charged against the budget, see ``event_size``, as they are pushed and
+	refunded once their upload has finished, failed or been spooled. An event which would
+	take the total over ``max_bytes`` is handled according to ``policy``:
+
+	``block``
+		Wait up to ``block_timeout`` seconds for uploads to make room. The MQTT network
+		thread stops reading from the socket meanwhile, so the broker holds the messages
+		back. Events still not admitted after the timeout are dropped.
+	``drop-oldest``
+		Drop the oldest batches waiting for an upload worker until the event fits. Without
+		waiting batches to drop, the new event is dropped instead.
+	``drop-newest``
+		Drop the new event.
+	``sample``
+		Keep one in ``sample_every`` events, dropping the rest, for as long as the budget is
+		exceeded. Kept events may take the total up to twice ``max_bytes``.
+
+	An event is always admitted when nothing else is held, however large it is. Safe to
+	share between threads.
+
+	Args:
+		max_bytes (int): The budget.
+		policy (str): One of ``POLICIES``.
+		block_timeout Optional[float]: Seconds the ``block`` policy waits, ``None`` to wait
+			for as long as it takes.
+		sample_every (int): The ``sample`` policy keeps one in this many events.
+		evict Optional[callable]: Called by ``drop-oldest`` to take the oldest waiting batch
+			of events, returning ``None`` if there is none.
+		on_drop Optional[callable]: Called with the collection and the number of events
+			whenever events are dropped.
+	"""
+
+	def __init__(self, max_bytes, policy=BLOCK, block_timeout=30.0, sample_every=10, evict=None, on_drop=None):
+		if policy not in POLICIES:
+			raise ValueError("Unknown memory budget policy '{}'".format(policy))
+		self.max_bytes = max_bytes
+		self.policy = policy
+		self.block_timeout = block_timeout
+		self.sample_every = max(1, sample_every)
+		self.evict = evict
+		self.on_drop = on_drop
+		self.dropped = {}
+		self.blocked = 0
+		self.blocked_seconds = 0.0
+		self._bytes = 0
+		self._events = 0
+		self._over = 0
+		self._condition = threading.Condition(threading.Lock())
+
+	@classmethod
+	def from_settings(cls, settings):
+		"""Create a budget from the `memory_budget` section of a config file.
+
+		Args:
+			settings (dict): Dictionary with a ``max_bytes`` key and optional ``policy``,
+				``block_timeout`` and ``sample_every`` keys.
+		Return:
+			MemoryBudget: The budget.
+		"""
+		block_timeout = settings.get('block_timeout', 30.0)
+		return cls(int(settings['max_bytes']),
+			policy=settings.get('policy', BLOCK),
+			block_timeout=None if block_timeout is None else float(block_timeout),
+			sample_every=int(settings.get('sample_every', 10)))
+
+	def acquire(self, collection, event, block=True):
+		"""Charge an event against the budget, applying the policy if it does not fit.
+
+		Args:
+			collection (str): The event's collection.
+			event (dict): The complete event.
+			block (bool): Whether the ``block`` policy may wait. If not, the event is
+				admitted regardless and the caller should check ``exceeded``.
+		Return:
+			bool: ``True`` if the event was admitted, ``False`` if it was dropped.
+		"""
+		size = event_size(event)
+		with self._condition:
+			if self._events and self._bytes + size > self.max_bytes:
+				if not self._make_room(collection, size, block):
+					self._drop(collection, 1)
+					return False
+			self._bytes += size
+			self._events += 1
+		return True
+
+	def wait(self):
+		"""Under the ``block`` policy, wait up to ``block_timeout`` seconds for uploads to
+		make room, so events can then be charged with ``acquire`` without blocking.
+
+		Return:
+			bool: ``False`` if the events held still take up the whole budget.
+		"""
+		if self.policy != BLOCK:
+			return True
+		with self._condition:
+			return self._bytes < self.max_bytes or self._wait(1)
+
+	def drop(self, collection, count=1):
+		"""Count events dropped without being charged, such as after ``wait`` timed out."""
+		with self._condition:
+			self._drop(collection, count)
+
+	def release(self, events):
+		"""Refund a batch of events whose upload has finished, failed or been spooled.
+
+		Args:
+			events (dict): A dictionary of collection names to lists of events.
+		Return:
+			None
+		"""
+		size, count = _batch_size(events)
+		with self._condition:
+			self._refund(size, count)
+
+	def exceeded(self):
+		"""Return whether the events held take up the whole budget."""
+		return self._bytes >= self.max_bytes
+
+	def stats(self):
+		"""Return the budget, the bytes and events held, the events dropped and the number of
+		times and seconds spent blocked."""
+		with self._condition:
+			return {
+				'max_bytes': self.max_bytes,
+				'bytes': self._bytes,
+				'events': self._events,
+				'dropped': sum(self.dropped.values()),
+				'blocked': self.blocked,
+				'blocked_seconds': self.blocked_seconds,
+			}
+
+	def _make_room(self, collection, size, block):
+		policy = self.policy
+		if policy == BLOCK:
+			return not block or self._wait(size)
+		if policy == DROP_OLDEST:
+			while self._events and self._bytes + size > self.max_bytes:
+				batch = self.evict() if self.evict is not None else None
+				if batch is None:
+					return False
+				batch_size, count = _batch_size(batch)
+				self._refund(batch_size, count)
+				for evicted, events in batch.items():
+					self._drop(evicted, len(events))
+			return True
+		if policy == SAMPLE:
+			self._over += 1
+			return not self._over % self.sample_every and self._bytes + size <= 2 * self.max_bytes
+		return False
+
+	def _wait(self, size):
+		self.blocked += 1
+		start = time.time()
+		deadline = None if self.block_timeout is None else start + self.block_timeout
+		try:
+			while self._events and self._bytes + size > self.max_bytes:
+				remaining = None if deadline is None else deadline - time.time()
+				if remaining is not None and remaining <= 0:
+					logger.warning("Memory budget still exceeded after {} seconds".format(self.block_timeout))
+					return False
+				self._condition.wait(remaining)
+			return True
+		finally:
+			self.blocked_seconds += time.time() - start
+
+	def _refund(self, size, count):
+		self._bytes = max(self._bytes - size, 0)
+		self._events = max(self._events - count, 0)
+		if self._bytes < self.max_bytes:
+			self._over = 0
+		self._condition.notify_all()
+
+	def _drop(self, collection, count):
+		self.dropped[collection] = self.dropped.get(collection, 0) + count
+		if self.on_drop is not None:
+			self.on_drop(collection, count)
+
+
+def _batch_size(events):
+	size = 0
+	count = 0
+	for batch in events.values():
+		count += len(batch)
+		for event in batch:
+			size += event_size(event)
+	return size, count
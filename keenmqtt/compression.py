@@ -0,0 +1,75 @@
+""" Gzip compression of upload request bodies """
+
+import threading
+import zlib
+
+from .stats import clock
+
+
+class GzipCompressor(object):
+	"""Gzip request bodies of at least ``min_size`` bytes, counting the bytes saved.
+
+	Safe to share between upload threads.
+
+	Args:
+		level (int): zlib compression level, from 1 (fastest) to 9 (smallest).
+		min_size (int): Bodies smaller than this many bytes are sent uncompressed.
+	"""
+
+	def __init__(self, level=6, min_size=1024):
+		if not 1 <= level <= 9:
+			raise ValueError("Compression level must be from 1 to 9, not {}".format(level))
+		self.level = level
+		self.min_size = min_size
+		self._lock = threading.Lock()
+		self._counts = {
+			'compressed': 0,
+			'skipped': 0,
+			'bytes_in': 0,
+			'bytes_out': 0,
+			'seconds': 0.0,
+		}
+
+	@classmethod
+	def from_settings(cls, settings):
+		"""Create a compressor from the `compression` section of a config file.
+
+		Args:
+			settings Optional[dict]: Dictionary with optional ``level`` and ``min_size`` keys.
+		Return:
+			GzipCompressor: The compressor.
+		"""
+		settings = settings or {}
+		return cls(level=int(settings.get('level', 6)), min_size=int(settings.get('min_size', 1024)))
+
+	def compress(self, body):
+		"""Gzip a request body if it is large enough.
+
+		Args:
+			body (bytes|str): The request body. Text is encoded as UTF-8.
+		Return:
+			bytes: The gzipped body, or ``None`` if the body is smaller than ``min_size``.
+		"""
+		if not isinstance(body, bytes):
+			body = body.encode('utf-8')
+		if len(body) < self.min_size:
+			with self._lock:
+				self._counts['skipped'] += 1
+			return None
+		start = clock()
+		compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+		compressed = compressor.compress(body) + compressor.flush()
+		elapsed = clock() - start
+		with self._lock:
+			counts = self._counts
+			counts['compressed'] += 1
+			counts['bytes_in'] += len(body)
+			counts['bytes_out'] += len(compressed)
+			counts['seconds'] += elapsed
+		return compressed
+
+	def stats(self):
+		"""Return the number of bodies compressed and skipped, bytes before and after
+		compression and the seconds spent compressing."""
+		with self._lock:
+			return dict(self._counts)
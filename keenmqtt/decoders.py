@@ -0,0 +1,374 @@
+""" Payload decoders, selected per topic pattern """
+
+import json
+import re
+import struct
+import sys
+
+from .imports import optional_import
+from .matching import TopicTrie, TopicCache
+
+# Imported when their decoders are first looked up, see ``get_decoder``.
+msgpack = None
+cbor2 = None
+
+_MISSING = object()
+
+# NumPy types for the struct format characters with a standard size.
+_NUMPY_TYPES = {
+	'b': 'i1', 'B': 'u1', '?': 'b1', 'h': 'i2', 'H': 'u2', 'i': 'i4', 'I': 'u4', 'l': 'i4', 'L': 'u4',
+	'q': 'i8', 'Q': 'u8', 'e': 'f2', 'f': 'f4', 'd': 'f8',
+}
+_NUMPY_BYTE_ORDERS = {'<': '<', '>': '>', '!': '>', '=': '='}
+_FORMAT_ITEM = re.compile(r'\s*(\d*)([a-zA-Z?])')
+
+
+def _find_json_loads():
+	"""Return the name and ``loads`` function of the fastest installed JSON library.
+
+	Each candidate accepts the raw ``bytes`` payload directly.
+	"""
+	try:
+		import orjson
+		return 'orjson', orjson.loads
+	except ImportError:
+		pass
+	try:
+		import rapidjson
+		return 'rapidjson', rapidjson.loads
+	except ImportError:
+		pass
+	try:
+		import ujson
+		return 'ujson', ujson.loads
+	except ImportError:
+		pass
+	return 'json', stdlib_loads
+
+
+if sys.version_info[0] == 3 and sys.version_info[1] < 6:
+	def stdlib_loads(payload):
+		if isinstance(payload, bytes):
+			payload = payload.decode('utf-8')
+		return json.loads(payload)
+else:
+	stdlib_loads = json.loads
+
+JSON_BACKEND, fast_loads = _find_json_loads()
+
+
+def decode_json(topic, payload):
+	"""Decode a JSON payload with the fastest installed JSON library.
+
+	Raises:
+		ValueError: When the JSON payload cannot be parsed.
+	"""
+	return [fast_loads(payload)]
+
+
+def decode_json_stdlib(topic, payload):
+	"""Decode a JSON payload with the standard library ``json`` module.
+
+	Raises:
+		ValueError: When the JSON payload cannot be parsed.
+	"""
+	return [stdlib_loads(payload)]
+
+
+def decode_msgpack(topic, payload):
+	"""Decode a MessagePack payload. A map is one message, and an array holds one message
+	per item, such as a frame of samples.
+
+	Raises:
+		ValueError: When the MessagePack payload cannot be parsed.
+	"""
+	try:
+		message = msgpack.unpackb(payload, raw=False)
+	except (ValueError, TypeError) as e:
+		raise ValueError("Malformed MessagePack payload: {}".format(e))
+	return message if type(message) is list else [message]
+
+
+def decode_cbor(topic, payload):
+	"""Decode a CBOR payload. A map is one message, and an array holds one message per item,
+	such as a frame of samples.
+
+	Raises:
+		ValueError: When the CBOR payload cannot be parsed.
+	"""
+	try:
+		message = cbor2.loads(payload)
+	except (ValueError, TypeError, cbor2.CBORDecodeError) as e:
+		raise ValueError("Malformed CBOR payload: {}".format(e))
+	return message if type(message) is list else [message]
+
+
+class StructDecoder(object):
+	"""Decode packed binary frames of fixed size records with the ``struct`` module.
+
+	A payload holds any number of records, back to back, each of which becomes a message
+	with one field per value. The layout is compiled into a function which unpacks a frame
+	in bulk with ``struct.iter_unpack`` and builds each message as a dictionary literal.
+	When NumPy is installed, frames of at least ``numpy_min_records`` records with scaled
+	fields are read with ``numpy.frombuffer`` and scaled a column at a time instead, in a type
+	wide enough that the values match.
+
+	Args:
+		format (str): A ``struct`` format for one record, such as ``<Ihh``. Use a byte order
+			prefix, as devices rarely share the relay's native alignment.
+		fields (list): The name of each value of a record, in order.
+		scale Optional[dict]: Factors to multiply fields by, such as to turn hundredths of a
+			degree into degrees.
+		numpy_min_records (int): The smallest frame which NumPy decodes.
+	Raises:
+		ValueError: When the format is invalid or has a different number of values than
+			``fields``.
+	"""
+
+	def __init__(self, format, fields, scale=None, numpy_min_records=64):
+		try:
+			record = struct.Struct(format)
+		except struct.error as e:
+			raise ValueError("Invalid struct format '{}': {}".format(format, e))
+		count = len(record.unpack(b'\0' * record.size))
+		if count != len(fields):
+			raise ValueError("The struct format '{}' has {} values but {} fields are named".format(
+				format, count, len(fields)))
+		scale = dict(scale or {})
+		for field in scale:
+			if field not in fields:
+				raise ValueError("Cannot scale unknown struct field '{}'".format(field))
+		self.format = format
+		self.fields = tuple(fields)
+		self.scale = scale
+		self.size = record.size
+		self.numpy_min_records = numpy_min_records
+
+		namespace = {'_size': record.size, '_unpack': record.unpack, '_iter_unpack': record.iter_unpack}
+		keys = []
+		values = []
+		columns = []
+		for index, field in enumerate(self.fields):
+			namespace['_f{}'.format(index)] = field
+			keys.append('_f{}'.format(index))
+			values.append('v{}'.format(index))
+			if field in scale:
+				namespace['_s{}'.format(index)] = scale[field]
+				columns.append('(records[_f{0}].astype(_t{0}) * _s{0}).tolist()'.format(index))
+			else:
+				columns.append('records[_f{}].tolist()'.format(index))
+		message = '{' + ', '.join('{}: {}'.format(key, value) for key, value in zip(keys, values)) + '}'
+		scaled = '{' + ', '.join('{}: {}{}'.format(key, value, ' * _s{}'.format(index) if field in scale else '')
+			for index, (key, value, field) in enumerate(zip(keys, values, self.fields))) + '}'
+		# Most devices send one record at a time, which is quicker to unpack on its own.
+		source = ('def unpack(payload):\n    if len(payload) == _size:\n        {0} = _unpack(payload)\n'
+			'        return [{1}]\n    return [{1} for {0} in _iter_unpack(payload)]\n').format(', '.join(values) + ',', scaled)
+		numpy = optional_import('numpy') if scale else None
+		self._dtype = _numpy_dtype(numpy, format, self.fields) if numpy is not None else None
+		if self._dtype is not None:
+			namespace['_dtype'] = self._dtype
+			for index, field in enumerate(self.fields):
+				if field in scale:
+					namespace['_t{}'.format(index)] = _scaled_dtype(numpy, self._dtype[field], scale[field])
+			namespace['_frombuffer'] = numpy.frombuffer
+			source += ('def unpack_columns(payload):\n    records = _frombuffer(payload, _dtype)\n'
+				'    return [{} for {} in zip({})]\n').format(message, ', '.join(values) + ',', ', '.join(columns))
+		exec(compile(source, '<keenmqtt struct decoder>', 'exec'), namespace)
+		self.source = source
+		self._unpack = namespace['unpack']
+		self._unpack_columns = namespace.get('unpack_columns')
+
+	@classmethod
+	def from_settings(cls, settings):
+		"""Create a decoder from a `decoders` entry with a ``struct`` key.
+
+		Args:
+			settings (dict): Dictionary with ``struct`` and ``fields`` keys and an optional
+				``scale`` key.
+		Return:
+			StructDecoder: The decoder.
+		"""
+		return cls(settings['struct'], settings['fields'], settings.get('scale'))
+
+	def __call__(self, topic, payload):
+		"""Decode a frame into a list of messages.
+
+		Raises:
+			ValueError: When the payload is not a whole number of records.
+		"""
+		length = len(payload)
+		if length % self.size:
+			raise ValueError("A {} byte payload is not a whole number of {} byte records".format(length, self.size))
+		if self._unpack_columns is not None and length >= self.numpy_min_records * self.size:
+			return self._unpack_columns(payload)
+		return self._unpack(payload)
+
+	def __getstate__(self):
+		# The compiled functions cannot be pickled, such as for backfill workers.
+		return (self.format, self.fields, self.scale, self.numpy_min_records)
+
+	def __setstate__(self, state):
+		self.__init__(*state)
+
+
+def _scaled_dtype(numpy, dtype, scale):
+	"""Return the type to scale a column of ``dtype`` in, so each value is the one Python's
+	arithmetic gives instead of wrapping around in the column's own type."""
+	if isinstance(scale, float) or dtype.kind == 'f':
+		return numpy.dtype('f8')
+	if dtype.itemsize <= 4 and abs(scale) < 2 ** 31:
+		return numpy.dtype('i8')
+	return numpy.dtype(object)
+
+
+def _numpy_dtype(numpy, format, fields):
+	"""Return the NumPy record type matching a struct format, or ``None`` if it has none."""
+	byte_order = _NUMPY_BYTE_ORDERS.get(format[:1])
+	if byte_order is None:
+		# Native formats are aligned the way the C compiler would, which is not worth copying.
+		return None
+	names = []
+	formats = []
+	offsets = []
+	offset = 0
+	fields = iter(fields)
+	position = 1
+	while position < len(format):
+		match = _FORMAT_ITEM.match(format, position)
+		if match is None:
+			return None
+		position = match.end()
+		count = int(match.group(1) or 1)
+		code = match.group(2)
+		if code == 'x':
+			offset += count
+			continue
+		kind = _NUMPY_TYPES.get(code)
+		if kind is None:
+			return None
+		for _ in range(count):
+			names.append(next(fields))
+			formats.append(byte_order + kind)
+			offsets.append(offset)
+			offset += numpy.dtype(kind).itemsize
+	return numpy.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': offset})
+
+
+DECODERS = {
+	'json': decode_json,
+	'json-stdlib': decode_json_stdlib,
+}
+
+
+def _load_msgpack():
+	global msgpack
+	msgpack = optional_import('msgpack')
+	return msgpack is not None
+
+
+def _load_cbor():
+	global cbor2
+	cbor2 = optional_import('cbor2')
+	return cbor2 is not None
+
+
+# Decoders needing a package which may not be installed: the package, a function importing
+# it and the decoder. They are registered the first time they are looked up.
+_OPTIONAL_DECODERS = {
+	'msgpack': ('msgpack', _load_msgpack, decode_msgpack),
+	'cbor': ('cbor2', _load_cbor, decode_cbor),
+}
+
+
+def register_decoder(name, decoder):
+	"""Make a decoder available by name to the `decoders` config section.
+
+	Args:
+		name (str): The name used in the config file.
+		decoder (callable): Called with ``(topic, payload)``, returning a list of new
+			dictionaries, which may be modified and used as the events, and raising
+			``ValueError`` for malformed payloads.
+	Return:
+		None
+	"""
+	DECODERS[name] = decoder
+
+
+def get_decoder(name):
+	"""Look up a registered decoder.
+
+	Raises:
+		ValueError: When no decoder has that name.
+	"""
+	try:
+		return DECODERS[name]
+	except KeyError:
+		pass
+	if name in _OPTIONAL_DECODERS:
+		package, load, decoder = _OPTIONAL_DECODERS[name]
+		if not load():
+			raise ValueError("The {} payload decoder needs the {} package".format(name, package))
+		DECODERS[name] = decoder
+		return decoder
+	raise ValueError("Unknown payload decoder '{}'".format(name))
+
+
+class DecoderSelector(object):
+	"""Choose the decoder for a topic from a set of subscription patterns.
+
+	Topics matching no pattern use ``default``. Lookups use the same first-added-wins
+	matching and caching as the collection mappings.
+
+	Args:
+		default (str): Name of the decoder for topics matching no pattern.
+		cache_size (int): Number of topics whose decoder is remembered.
+	"""
+
+	def __init__(self, default='json', cache_size=4096):
+		self.default = get_decoder(default)
+		self._index = TopicTrie()
+		self._cache = TopicCache(cache_size)
+
+	@classmethod
+	def from_settings(cls, settings, default='json'):
+		"""Create a selector from the `decoders` section of a config file.
+
+		Args:
+			settings (dict): Subscription patterns mapped to decoder names, or to the
+				settings of a ``StructDecoder``.
+			default (str): Name of the decoder for topics matching no pattern.
+		Return:
+			DecoderSelector: The selector.
+		"""
+		selector = cls(default)
+		for sub, decoder in (settings or {}).items():
+			if isinstance(decoder, dict):
+				if 'struct' not in decoder:
+					raise ValueError("The decoder settings for '{}' need a struct key".format(sub))
+				decoder = StructDecoder.from_settings(decoder)
+			selector.add(sub, decoder)
+		return selector
+
+	def add(self, sub, decoder):
+		"""Use a decoder for topics matching a subscription pattern.
+
+		Args:
+			sub (str): The subscription pattern.
+			decoder (str|callable): A registered decoder name, or the decoder itself.
+		Return:
+			None
+		"""
+		if not callable(decoder):
+			decoder = get_decoder(decoder)
+		self._index.add(sub, decoder)
+		self._cache.clear()
+
+	def for_topic(self, topic):
+		"""Return the decoder to use for a topic."""
+		if not len(self._index):
+			return self.default
+		decoder = self._cache.get(topic, _MISSING)
+		if decoder is _MISSING:
+			decoder = self._index.match(topic, self.default)
+			self._cache.put(topic, decoder)
+		return decoder
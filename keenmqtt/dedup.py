@@ -0,0 +1,112 @@
+""" Suppression of duplicate MQTT messages, such as QoS 1 redeliveries and retained replays """
+
+import re
+
+
+class Deduplicator(object):
+	"""Remember recently seen messages, in a rotating pair of sets, to spot duplicates.
+
+	Each message is reduced to a 64-bit hash of its topic and either its payload or, with
+	``id_field``, the value of that field in its JSON payload. The field is found with a
+	regular expression rather than by decoding the payload, so checking a message costs one
+	hash and two set lookups. Payloads without the field are keyed on the whole payload.
+
+	Hashes go in the current set, which becomes the previous set every ``ttl / 2`` seconds,
+	or sooner once it holds ``max_keys / 2`` hashes, and the old previous set is forgotten.
+	A message is a duplicate if its hash is in either set, so it is remembered for between
+	``ttl / 2`` and ``ttl`` seconds and memory is bounded by ``max_keys`` hashes.
+
+	Every message is remembered, but only duplicates with the retain or DUP flag set are
+	suppressed, as a live message repeating an earlier one, such as a sensor publishing the
+	same reading every minute, is a new event. With ``all_messages`` any duplicate is
+	suppressed, which is the default with ``id_field`` as genuine repeats then have IDs of
+	their own.
+
+	Args:
+		ttl (float): Seconds for which messages are remembered, at most.
+		max_keys (int): The most hashes remembered at once.
+		id_field Optional[str]: A field of JSON payloads holding a unique message ID.
+		all_messages Optional[bool]: Suppress duplicates without the retain or DUP flag too.
+	"""
+
+	def __init__(self, ttl=300.0, max_keys=100000, id_field=None, all_messages=None):
+		self.ttl = ttl
+		self.max_keys = max_keys
+		self.id_field = id_field
+		self.all_messages = id_field is not None if all_messages is None else all_messages
+		self.suppressed = 0
+		self.rotations = 0
+		self._current = set()
+		self._previous = set()
+		self._rotate_at = None
+		self._id_pattern = None
+		if id_field is not None:
+			self._id_pattern = re.compile(b'"' + re.escape(id_field.encode('utf-8')) +
+				b'"\\s*:\\s*("(?:[^"\\\\]|\\\\.)*"|[^,}\\]\\s]+)')
+
+	@classmethod
+	def from_settings(cls, settings):
+		"""Create a deduplicator from the `dedup` section of a config file.
+
+		Args:
+			settings Optional[dict]: Dictionary with optional ``ttl``, ``max_keys``,
+				``id_field`` and ``all_messages`` keys.
+		Return:
+			Deduplicator: The deduplicator.
+		"""
+		settings = settings or {}
+		all_messages = settings.get('all_messages')
+		return cls(ttl=float(settings.get('ttl', 300.0)),
+			max_keys=int(settings.get('max_keys', 100000)),
+			id_field=settings.get('id_field'),
+			all_messages=bool(all_messages) if all_messages is not None else None)
+
+	def seen(self, topic, payload, now, redelivered=True):
+		"""Return whether a message is a duplicate to suppress, and remember it.
+
+		Args:
+			topic (str): The topic string.
+			payload (bytes): Raw MQTT payload.
+			now (float): The time the message was received, in seconds.
+			redelivered (bool): Whether the message has the retain or DUP flag set.
+		Return:
+			bool: ``True`` if the message was seen within the time-to-live, and is
+			``redelivered`` or ``all_messages`` is set.
+		"""
+		if self._rotate_at is None or now >= self._rotate_at or len(self._current) >= self.max_keys // 2:
+			self._rotate(now)
+		key = payload
+		if self._id_pattern is not None:
+			match = self._id_pattern.search(payload)
+			if match is not None:
+				key = match.group(1)
+		key = hash((topic, key))
+		current = self._current
+		if key in current:
+			duplicate = True
+		else:
+			current.add(key)
+			duplicate = key in self._previous
+		if duplicate and (redelivered or self.all_messages):
+			self.suppressed += 1
+			return True
+		return False
+
+	def stats(self):
+		"""Return the number of duplicates suppressed, hashes remembered and set rotations."""
+		return {
+			'suppressed': self.suppressed,
+			'keys': len(self._current) + len(self._previous),
+			'rotations': self.rotations,
+		}
+
+	def _rotate(self, now):
+		if self._rotate_at is not None:
+			if now >= self._rotate_at + self.ttl / 2.0:
+				# Nothing has arrived for longer than the ttl, so every hash has expired.
+				self._previous = set()
+			else:
+				self._previous = self._current
+			self._current = set()
+			self.rotations += 1
+		self._rotate_at = now + self.ttl / 2.0
@@ -0,0 +1,115 @@
+""" Per-mapping downsampling of noisy topics before upload.
+
+A collection mapping may keep only some of the messages on each concrete topic::
+
+    collection_mappings:
+        sensors/+/vibration:
+            collection: vibration
+            downsample:
+                every: 10
+                interval: 1.0
+                deadband: {value: 0.5}
+                max_topics: 4096
+
+``every`` keeps one in N records, ``interval`` keeps at most one record per that many
+seconds and ``deadband`` keeps a record only when one of the fields has changed by at least
+the given amount since the last record kept. A record must pass every rule given to be
+kept, and the first record on a topic always is.
+"""
+
+from .matching import TopicCache
+
+
+class Downsampler(object):
+	"""Decide which records on each concrete topic to keep, with a fixed amount of state per topic.
+
+	The state of at most ``max_topics`` topics is kept, in a least recently used table. A
+	topic whose state has been forgotten starts again as if it were new.
+
+	Args:
+		every (int): Keep one in this many records. ``1`` keeps every record.
+		interval (float): Keep at most one record per this many seconds. ``0`` disables the check.
+		deadband Optional[dict]: Field names to the change in value needed for a record to be
+			kept. Values which cannot be subtracted are compared for equality.
+		max_topics (int): The number of topics whose state is kept.
+	"""
+
+	def __init__(self, every=1, interval=0.0, deadband=None, max_topics=4096):
+		if every < 1:
+			raise ValueError("Downsampling must keep one in at least 1 records, not {}".format(every))
+		self.every = every
+		self.interval = interval
+		self.deadband = tuple((deadband or {}).items())
+		self.topics = TopicCache(max_topics)
+		self.kept = 0
+		self.dropped = 0
+
+	@classmethod
+	def from_settings(cls, settings):
+		"""Create a downsampler from the `downsample` section of a collection mapping.
+
+		Args:
+			settings Optional[dict]: Dictionary with optional ``every``, ``interval``,
+				``deadband`` and ``max_topics`` keys.
+		Return:
+			Downsampler: The downsampler, or ``None`` if there are no settings.
+		"""
+		if not settings:
+			return None
+		deadband = dict((field, float(delta)) for field, delta in (settings.get('deadband') or {}).items())
+		return cls(every=int(settings.get('every', 1)),
+			interval=float(settings.get('interval', 0.0)),
+			deadband=deadband,
+			max_topics=int(settings.get('max_topics', 4096)))
+
+	def keep(self, topic, message, now):
+		"""Return whether to keep a record, updating the topic's state.
+
+		Args:
+			topic (str): The concrete topic the record was received on.
+			message (dict): The decoded, and transformed, record.
+			now (float): The time the record was received, in seconds.
+		Return:
+			bool: ``True`` to keep the record.
+		"""
+		# The state is [records seen since the last kept, time kept, deadband values kept].
+		state = self.topics.get(topic)
+		if state is None:
+			self.topics.put(topic, [0, now, self._values(message)])
+			self.kept += 1
+			return True
+		state[0] += 1
+		if state[0] < self.every or now - state[1] < self.interval:
+			self.dropped += 1
+			return False
+		if self.deadband:
+			values = self._values(message)
+			if not self._changed(state[2], values):
+				self.dropped += 1
+				return False
+			state[2] = values
+		state[0] = 0
+		state[1] = now
+		self.kept += 1
+		return True
+
+	def stats(self):
+		"""Return the number of records kept and dropped and the number of topics tracked."""
+		return {'kept': self.kept, 'dropped': self.dropped, 'topics': len(self.topics)}
+
+	def _values(self, message):
+		if not self.deadband or not isinstance(message, dict):
+			return None
+		return tuple(message.get(field) for field, delta in self.deadband)
+
+	def _changed(self, kept, values):
+		if kept is None or values is None:
+			return True
+		for (field, delta), old, new in zip(self.deadband, kept, values):
+			try:
+				if abs(new - old) >= delta:
+					return True
+			except TypeError:
+				if new != old:
+					return True
+		return False
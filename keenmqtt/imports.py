@@ -0,0 +1,28 @@
+""" Importing optional dependencies the first time they are needed, to keep startup quick """
+
+import importlib
+
+# Stands in for an optional module which has not been imported yet.
+NOT_IMPORTED = object()
+
+_modules = {}
+
+
+def optional_import(name):
+	"""Import an optional module, remembering whether it is installed.
+
+	Args:
+		name (str): The module name, such as ``numpy``.
+	Return:
+		module: The module, or ``None`` if it is not installed.
+	"""
+	try:
+		return _modules[name]
+	except KeyError:
+		pass
+	try:
+		module = importlib.import_module(name)
+	except ImportError:
+		module = None
+	_modules[name] = module
+	return module
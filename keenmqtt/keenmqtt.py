@@ -1,25 +1,103 @@
 """ Keen mqtt relay class """
 
-import paho.mqtt.client as mqtt
-import keen
-import json
-from datetime import datetime
 import logging
+import threading
+from time import time
+
+from .batching import EventBatcher
+from .budget import BLOCK, MemoryBudget
+from .compression import GzipCompressor
+from .decoders import DecoderSelector
+from .dedup import Deduplicator
+from .downsampling import Downsampler
+from .matching import TopicTrie, TopicCache, check_subscription
+from .recording import Recorder
+from .rollups import Rollup, RollupCloser
+from .sharding import SHARED, HASH, shared_subscription, topic_shard
+from .spool import Spool, SpoolReplayer
+from .stats import Stats, clock
+from .subscriptions import Subscriber, check_qos
+from .timestamps import Timestamper, RECEIVE
+from .transforms import compile_transform
+from .upload import UploadWorkerPool
 
 logger = logging.getLogger('keenmqtt')
 
+_MISSING = object()
+
+# The collection, transform, downsampler and rollup for topics matching no mapping.
+_NO_MAPPING = (False, None, None, None)
+
+# Hooks which build the event from a decoded message, see ``KeenMQTT.on_mqtt_message``.
+_EVENT_HOOKS = ('process_topic', 'process_payload', 'process_time')
+
+def _mapping_rules(mapping):
+	# A mapping's settings other than the QoS, which only changes how it is subscribed to.
+	if isinstance(mapping, dict) and 'qos' in mapping:
+		return dict((key, value) for key, value in mapping.items() if key != 'qos')
+	return mapping
+
+def _function(method):
+	return getattr(method, '__func__', method)
+
 class KeenMQTT:
 
 	def __init__(self):
 		self.ready = False
 		self.running = False
 		self.collection_mapping = {}
+		self.downsamplers = {}
+		self.rollups = {}
+		self.rollup_closer = None
+		self.collection_index = TopicTrie()
+		self.collection_cache = TopicCache()
+		# Held while a message is processed, and while ``reload_collection_mappings`` swaps
+		# in new mappings, so each message sees either the old or the new mappings.
+		self._mapping_lock = threading.Lock()
+		self._mapping_entries = {}
+		self._mapping_settings = {}
+		self.subscription_qos = {}
+		self.subscriber = Subscriber()
+		self.decoders = DecoderSelector()
+		self.dedup = None
+		self.recorder = None
+		self.batcher = None
+		self.uploader = None
+		self.spool = None
+		self.spool_replayer = None
+		self.budget = None
+		self._budget_room = True
+		self.stats = Stats()
+		self.shard = None
+		self.http_pool = None
+		self.compressor = None
+		self.timestamper = Timestamper()
+		self.received_at = None
+		self._default_event_hooks = all(_function(getattr(type(self), name)) is _function(getattr(KeenMQTT, name))
+			for name in _EVENT_HOOKS)
+		self._default_collection_hook = _function(type(self).process_collection) is _function(KeenMQTT.process_collection)
 
 	def setup(self, mqtt_client=None, keen_client=None, settings=None):
 		"""Setup the clients for this instance.
 
 		Normally called with a settings object containing `keen` and `mqtt` keys
-		with dictionary values of settings.
+		with dictionary values of settings. Each of the `collection_mappings` is either a
+		collection name or a dictionary with a `collection` key and transform rules, see
+		``keenmqtt.transforms``, `downsample` rules, see ``keenmqtt.downsampling``, and a
+		`rollup` to send instead of the raw events, see ``keenmqtt.rollups``. An optional `batching` key enables bulk
+		uploads, see ``setup_batching``, and an optional `upload_workers` key moves
+		uploads to background threads, see ``setup_upload_workers``, and an optional `spool`
+		key keeps events which could not be uploaded on disk, see ``setup_spool``. An optional
+		`memory_budget` key bounds the memory held by events waiting to be uploaded, see
+		``setup_memory_budget``. Pipeline
+		stats are collected unless the `stats` key has `enabled: false`, see ``get_stats``.
+		Uploads share a pool of keep-alive connections, sized by the optional `http_pool`
+		key and optionally gzipped with the `compression` key, see ``connect_keen``. The optional `timestamps` key chooses when events are
+		timestamped, see ``get_time``. An optional `dedup` key suppresses duplicate messages, see
+		``on_mqtt_message``, and an optional `recording` key logs the raw traffic, see
+		``setup_recording``. The mappings can be replaced later, see
+		``reload_collection_mappings``. A mapping's `qos` key, or the optional `subscriptions`
+		section, sets the QoS it is subscribed with, see ``register_subscriptions``.
 
 		Args:
 			mqtt_client Optional[class]: An instance of an Paho MQTT client class.
@@ -28,6 +106,32 @@ class KeenMQTT:
 		Return:
 			None
 		"""
+		settings = settings or {}
+		stats_settings = settings.get('stats', {})
+		if not stats_settings.get('enabled', True):
+			self.stats = None
+		elif 'sample_every' in stats_settings:
+			self.stats = Stats(stats_settings['sample_every'])
+
+		if 'timestamps' in settings:
+			self.timestamper = Timestamper.from_settings(settings['timestamps'])
+
+		if 'collection_cache_size' in settings:
+			self.collection_cache = TopicCache(int(settings['collection_cache_size']))
+
+		if 'decoders' in settings or 'default_decoder' in settings:
+			self.decoders = DecoderSelector.from_settings(settings.get('decoders'),
+				settings.get('default_decoder', 'json'))
+
+		if 'dedup' in settings:
+			self.dedup = Deduplicator.from_settings(settings['dedup'])
+
+		if 'recording' in settings:
+			self.setup_recording(settings['recording'])
+
+		if 'subscriptions' in settings:
+			self.subscriber = Subscriber.from_settings(settings['subscriptions'])
+
 		if mqtt_client:
 			self.mqtt_client = mqtt_client
 			self.register_subscriptions()
@@ -41,11 +145,169 @@ class KeenMQTT:
 
 		if 'collection_mappings' in settings:
 			for subscription in settings['collection_mappings']:
-				collection = settings['collection_mappings'][subscription]
-				self.add_collection_mapping(subscription, collection)
+				mapping = settings['collection_mappings'][subscription]
+				self.add_collection_mapping(subscription, *self._mapping_from_settings(mapping),
+					qos=self._mapping_qos(mapping))
+				self._mapping_settings[subscription] = mapping
+
+		if 'batching' in settings:
+			self.setup_batching(settings['batching'])
+
+		if 'upload_workers' in settings:
+			self.setup_upload_workers(settings['upload_workers'])
+
+		if 'spool' in settings:
+			self.setup_spool(settings['spool'])
+
+		if 'memory_budget' in settings:
+			self.setup_memory_budget(settings['memory_budget'])
 
 		self.ready = True
 
+	def setup_batching(self, batch_settings=None):
+		"""Group events into bulk uploads instead of one upload per event.
+
+		Events are buffered per collection and sent with ``upload_events`` once ``max_events``
+		events are buffered, ``max_bytes`` bytes of JSON are buffered or the oldest event is
+		``max_age`` seconds old, whichever comes first.
+
+		Args:
+			batch_settings Optional[dict]: Thresholds, such as the `batching` section of config.yaml.
+		Return:
+			None
+		"""
+		self.batcher = EventBatcher.from_settings(self.dispatch_events, batch_settings)
+		if self.running:
+			self.batcher.start()
+
+	def setup_upload_workers(self, worker_settings=None):
+		"""Perform uploads from a pool of background threads.
+
+		Without workers, uploads happen in the MQTT network thread which then cannot read
+		messages or send keep-alives until the request has finished. With workers, the MQTT
+		thread only places events on a queue of at most ``queue_size`` batches, which
+		``workers`` threads upload. When the queue is full the MQTT thread waits for space,
+		unless a spool is set up in which case the events are spooled instead.
+
+		Args:
+			worker_settings Optional[dict]: Such as the `upload_workers` section of config.yaml.
+		Return:
+			None
+		"""
+		self.uploader = UploadWorkerPool.from_settings(self.deliver_events, worker_settings)
+		self.uploader.start()
+
+	def setup_spool(self, spool_settings):
+		"""Keep events which could not be uploaded in an on-disk spool.
+
+		Failed uploads, and batches which do not fit in a full upload queue, are appended to
+		a spool in ``directory``. A background thread retries the spool every
+		``replay_interval`` seconds, in uploads of up to ``replay_max_events`` events. See
+		``keenmqtt.spool.Spool`` for the remaining settings.
+
+		Args:
+			spool_settings (dict): Such as the `spool` section of config.yaml.
+		Return:
+			None
+		"""
+		self.spool = Spool.from_settings(spool_settings)
+		self.spool_replayer = SpoolReplayer(self.spool, self.upload_events,
+			interval=float(spool_settings.get('replay_interval', 10.0)),
+			max_events=int(spool_settings.get('replay_max_events', 500)))
+		self.spool_replayer.start()
+
+	def setup_recording(self, recording_settings):
+		"""Append every message received to a binary log, to be replayed later.
+
+		Messages are recorded with the time they were received, their QoS and retain flag and
+		their raw payload, before duplicates are suppressed or payloads decoded. See
+		``keenmqtt.recording`` for the log format and its replay.
+
+		Args:
+			recording_settings (dict): Such as the `recording` section of config.yaml.
+		Return:
+			None
+		"""
+		self.recorder = Recorder.from_settings(recording_settings)
+
+	def setup_memory_budget(self, budget_settings):
+		"""Bound the memory held by events which have been pushed but not yet uploaded.
+
+		When Keen IO is slower than the broker, events pile up in the batcher and the upload
+		queue. Once they take up ``max_bytes``, new events are held back, dropped or sampled
+		according to ``policy``, see ``keenmqtt.budget.MemoryBudget``. ``drop-oldest`` drops
+		batches waiting in the upload queue, so needs upload workers. Dropped events are
+		counted per collection as ``dropped_by_budget``. The budget only applies when events
+		are batched, uploaded by workers or spooled, as otherwise each event is uploaded
+		before the next message is read.
+
+		Args:
+			budget_settings (dict): Such as the `memory_budget` section of config.yaml.
+		Return:
+			None
+		"""
+		self.budget = MemoryBudget.from_settings(budget_settings)
+		self.budget.evict = self.evict_oldest
+		self.budget.on_drop = self._record_budget_drop
+
+	def evict_oldest(self):
+		"""Take the oldest batch waiting to be uploaded, for the ``drop-oldest`` budget policy.
+
+		Returns:
+			dict: The batch, or ``None`` if no batch is waiting.
+		"""
+		if self.uploader:
+			return self.uploader.take_oldest()
+		return None
+
+	def _wait_for_budget(self):
+		"""Wait for a ``block`` memory budget to have room before a message is processed.
+
+		This happens before the mapping lock is taken, so reloads and rollup closing are not
+		held up, and the events of the message are then charged without waiting. Events
+		still waiting in the batcher are charged too, so they are flushed first.
+		"""
+		budget = self.budget
+		if budget is None or budget.policy != BLOCK or not budget.exceeded():
+			self._budget_room = True
+			return
+		if self.batcher:
+			self.batcher.flush()
+		self._budget_room = budget.wait()
+
+	def _charge_budget(self, collection, event):
+		if not self._mapping_lock.locked():
+			return self.budget.acquire(collection, event)
+		# Within the pipeline, ``_wait_for_budget`` has already waited.
+		if not self._budget_room:
+			self.budget.drop(collection)
+			return False
+		return self.budget.acquire(collection, event, block=False)
+
+	def _record_budget_drop(self, collection, count):
+		if self.stats is not None:
+			self.stats.incr('dropped_by_budget', collection, count)
+
+	def setup_sharding(self, index, count, mode=SHARED, group='keenmqtt'):
+		"""Handle only a share of the incoming messages, alongside other relay processes.
+
+		In ``shared`` mode every subscription is made as a shared subscription in ``group``,
+		so the broker splits the messages between the relays. In ``hash`` mode, for brokers
+		without shared subscriptions, every relay receives every message and keeps only the
+		topics whose hash falls in its shard. Call this before ``setup`` subscribes.
+
+		Args:
+			index (int): This relay's shard, from ``0`` to ``count - 1``.
+			count (int): The number of relays sharing the messages.
+			mode (str): ``shared`` or ``hash``.
+			group (str): The shared subscription group name.
+		Return:
+			None
+		"""
+		if mode not in (SHARED, HASH):
+			raise ValueError("Unknown sharding mode '{}'".format(mode))
+		self.shard = (index, count, mode, group)
+
 	def connect_mqtt_client(self, settings):
 		"""Setup MQTT client.
 
@@ -58,27 +320,61 @@ class KeenMQTT:
 			None
 		"""
 		mqtt_settings = settings['mqtt']
+		self.mqtt_client = self.create_mqtt_client(mqtt_settings)
+		self.mqtt_client.connect(mqtt_settings['host'], mqtt_settings['port'])
+
+	def create_mqtt_client(self, mqtt_settings):
+		"""Create an unconnected Paho MQTT client with this instance's callbacks.
+
+		Args:
+			mqtt_settings (dict): The `mqtt` section of the settings object. A random
+				``client_id`` is added if it has none.
+		Return:
+			paho.mqtt.client.Client: The client.
+		"""
+		# Imported here rather than at the top, like keen in ``connect_keen``, as importing it
+		# takes longer than starting everything else.
+		import paho.mqtt.client as mqtt
+
 		if 'client_id' not in mqtt_settings:
 			import uuid
 			mqtt_settings['client_id'] = str(uuid.uuid4())
 
-		self.mqtt_client = mqtt.Client(mqtt_settings['client_id'])
-		self.mqtt_client.on_message = self.on_mqtt_message
-		self.mqtt_client.on_connect = self.on_mqtt_connect
+		if hasattr(mqtt, 'CallbackAPIVersion'):
+			# paho-mqtt 2.x needs to be told to use the 1.x callback signatures.
+			client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, mqtt_settings['client_id'])
+		else:
+			client = mqtt.Client(mqtt_settings['client_id'])
+		client.on_message = self.on_mqtt_message
+		client.on_connect = self.on_mqtt_connect
+		client.on_subscribe = self.on_mqtt_subscribe
 		if 'user' in mqtt_settings and len(mqtt_settings['user']):
-			self.mqtt_client.username_pw_set(mqtt_settings['user'], mqtt_settings['pass'])
-		self.mqtt_client.connect(mqtt_settings['host'], mqtt_settings['port'])
+			client.username_pw_set(mqtt_settings['user'], mqtt_settings['pass'])
+		return client
 
 	def connect_keen(self, settings):
 		"""Setup the Keen IO client.
 
+		The client sends its requests through an ``HTTPPool`` of keep-alive connections,
+		configured by the `http_pool` settings, which also sets the request timeouts. If
+		there is a `compression` key, request bodies of at least `min_size` bytes are gzipped
+		at `level`. Compression happens in the thread making the upload, so set up upload
+		workers to keep it off the MQTT network thread.
+
 		Args:
 			settings Optional[dict]: The settings object, such as one read from config.yaml
 		Return:
 			None
 		"""
+		import keen
+		from .pool import HTTPPool
+
 		if 'keen' in settings:
 			self.keen_client = keen.KeenClient(**settings['keen'])
+			if 'compression' in settings:
+				self.compressor = GzipCompressor.from_settings(settings['compression'])
+			self.http_pool = HTTPPool.from_settings(settings.get('http_pool'), self.compressor)
+			self.http_pool.attach(self.keen_client)
 		else:
 			self.keen_client = keen
 
@@ -94,38 +390,346 @@ class KeenMQTT:
 	def register_subscriptions(self):
 		"""This should always be called since re-subscribes after any
 		unexpected disconnects.
+
+		Filters covered by a broader mapping's filter are skipped, and the rest are sent in
+		as few SUBSCRIBE packets as the `subscriptions` settings allow, see
+		``keenmqtt.subscriptions``.
+		"""
+		self.subscriber.subscribe_all(self.mqtt_client, self._subscription_filters())
+
+	def on_mqtt_subscribe(self, client, userdata, mid, granted_qos):
+		"""Called when the broker acknowledges a SUBSCRIBE packet.
+
+		See the Paho MQTT client documentation ``on_subscribe`` documentation for arguments.
 		"""
-		for subscription in self.collection_mapping:
-			self.mqtt_client.subscribe(subscription)
+		self.subscriber.on_subscribe(mid, granted_qos)
+
+	def _subscription_filters(self):
+		qos = self.subscriber.qos
+		return [(self.subscription_filter(subscription), self.subscription_qos.get(subscription, qos))
+			for subscription in self.collection_mapping]
+
+	def subscription_filter(self, subscription):
+		"""Return the filter to subscribe with for a collection mapping's subscription.
+
+		This is the subscription itself, unless shared subscriptions are used for sharding.
+		"""
+		if self.shard is not None and self.shard[2] == SHARED:
+			return shared_subscription(subscription, self.shard[3])
+		return subscription
 
 	def on_mqtt_message(self, mosq, obj, mqtt_message):
 		"""Called when an MQTT message is recieved.
 
 		See the Paha MQTT client documentation ``on_message`` documentation for arguments.
+		Messages whose payload ``decode_payload`` cannot decode are logged and dropped.
+
+		With the `recording` setting, the message is first appended to the traffic log.
+		With the `dedup` setting, retained and redelivered messages seen within its `ttl`,
+		such as QoS 1 redeliveries and retained messages replayed after a reconnect, are
+		counted as ``duplicates_suppressed`` and dropped before they are decoded. See
+		``keenmqtt.dedup.Deduplicator``.
+
+		The decoded messages are passed on to ``process_messages``.
 		"""
 		topic = mqtt_message.topic
 		payload = mqtt_message.payload
-		messages = self.decode_payload(topic, payload)
-		
-		if len(messages):
-			for message in messages:
-				event = {}
+		shard = self.shard
+		if shard is not None and shard[2] == HASH and topic_shard(topic, shard[1]) != shard[0]:
+			return
+		self.received_at = time()
+		if self.recorder is not None:
+			self.recorder.record(topic, payload, mqtt_message.qos, mqtt_message.retain, self.received_at)
+		if self.dedup is not None and self.dedup.seen(topic, payload, self.received_at,
+				mqtt_message.retain or getattr(mqtt_message, 'dup', False)):
+			if self.stats is not None:
+				self.stats.incr('duplicates_suppressed')
+			return
+		if self.stats is not None:
+			return self._process_message_with_stats(topic, payload)
+		try:
+			messages = self.decode_payload(topic, payload)
+		except ValueError as e:
+			logger.debug("Dropping malformed payload on {topic}: {error}".format(topic=topic, error=e))
+			return
+		self._wait_for_budget()
+		with self._mapping_lock:
+			self._process_messages(topic, messages)
+
+	def process_messages(self, topic, messages, decode_seconds=0.0):
+		"""Turn the decoded messages of one MQTT message into events and push them.
+
+		This is the pipeline ``on_mqtt_message`` runs once the payload has been decoded, for
+		callers such as ``keenmqtt.backfill`` which decode payloads themselves. ``received_at``
+		should hold the time the message was received.
+
+		When ``process_topic``, ``process_payload`` and ``process_time`` are not overridden,
+		they are skipped: each decoded dictionary becomes the event itself, with the topic
+		and timestamp added in place, rather than being copied into a new one. ``get_time``
+		then sees the message with ``mqtt_topic`` already added.
+
+		If the mapping matching the topic has transform rules, the compiled transform is
+		applied to each decoded message before the event is built, and may drop it. The
+		mapping's downsampler then decides whether to keep the result, and if the mapping has
+		a rollup, the finished event is added to it rather than pushed. When
+		``process_collection`` is not overridden, the mapping is looked up once per message
+		rather than once per decoded record.
+
+		Args:
+			topic (str): The topic string.
+			messages (list): The messages returned by ``decode_payload``.
+			decode_seconds (float): Time taken to decode them, for the stats.
+		Return:
+			None
+		"""
+		self._wait_for_budget()
+		if self.stats is not None:
+			self.stats.record_decode(decode_seconds, len(messages))
+			with self._mapping_lock:
+				return self._process_messages_with_stats(topic, messages, clock())
+		with self._mapping_lock:
+			self._process_messages(topic, messages)
+
+	def _process_messages(self, topic, messages):
+		fast = self._fast_path()
+		by_topic = self._collection_by_topic()
+		collection, transform, downsampler, rollup = self.match_mapping(topic)
+		for message in messages:
+			if not by_topic:
 				collection = self.process_collection(topic, message)
-				if collection:
-					if self.process_topic(event, topic):
-						if self.process_payload(event, topic, message):
-							if self.process_time(event, topic, message):
+			if not collection:
+				continue
+			if transform is not None:
+				message = transform(topic, message)
+				if message is None:
+					continue
+			if downsampler is not None and not downsampler.keep(topic, message, self.received_at):
+				continue
+			if fast and type(message) is dict:
+				message.setdefault('mqtt_topic', topic)
+				iso_datetime = self.get_time(topic, message)
+				if iso_datetime is not None:
+					message['keen'] = {"timestamp": iso_datetime}
+				if rollup is not None:
+					rollup.add(topic, message)
+				else:
+					self.push_event(collection, message)
+			else:
+				event = {}
+				if self.process_topic(event, topic):
+					if self.process_payload(event, topic, message):
+						if self.process_time(event, topic, message):
+							if rollup is not None:
+								rollup.add(topic, event)
+							else:
 								self.push_event(collection, event)
 
+	def _process_message_with_stats(self, topic, payload):
+		"""The same pipeline as ``on_mqtt_message``, recording counters and stage timings."""
+		stats = self.stats
+		start = clock()
+		try:
+			messages = self.decode_payload(topic, payload)
+		except ValueError as e:
+			stats.record_decode(clock() - start)
+			logger.debug("Dropping malformed payload on {topic}: {error}".format(topic=topic, error=e))
+			return
+		except Exception:
+			stats.record_decode(clock() - start)
+			raise
+		now = clock()
+		stats.record_decode(now - start, len(messages))
+		self._wait_for_budget()
+		with self._mapping_lock:
+			self._process_messages_with_stats(topic, messages, now)
+
+	def _process_messages_with_stats(self, topic, messages, now):
+		"""The same pipeline as ``process_messages``, recording counters and stage timings.
+
+		The time taken by a mapping's transform and downsampler is counted in the payload stage,
+		and adding an event to a rollup in the push stage.
+		"""
+		stats = self.stats
+		fast = self._fast_path()
+		by_topic = self._collection_by_topic()
+		collection, transform, downsampler, rollup = self.match_mapping(topic)
+		pushed = 'events_pushed' if rollup is None else 'events_rolled_up'
+		for message in messages:
+			t0 = now
+			if not by_topic:
+				collection = self.process_collection(topic, message)
+			t1 = now = clock()
+			if not collection:
+				stats.record_event(None, 'dropped_no_collection', t0, t1)
+				continue
+			# Readings are shifted by the transform and downsampler's duration so that they
+			# count as payload time.
+			shift = 0.0
+			if transform is not None:
+				message = transform(topic, message)
+				now = clock()
+				if message is None:
+					stats.record_event(collection, 'dropped_by_payload', t0, t1, t1, now)
+					continue
+				shift = now - t1
+			if downsampler is not None:
+				keep = downsampler.keep(topic, message, self.received_at)
+				now = clock()
+				if not keep:
+					stats.record_event(collection, 'dropped_by_downsampling', t0, t1, t1, now)
+					continue
+				shift = now - t1
+			if fast and type(message) is dict:
+				message.setdefault('mqtt_topic', topic)
+				# Nothing is copied, so apart from the transform the payload stage takes no time.
+				t3 = clock()
+				t2 = t3 - shift
+				iso_datetime = self.get_time(topic, message)
+				if iso_datetime is not None:
+					message['keen'] = {"timestamp": iso_datetime}
+				t4 = clock()
+				if rollup is not None:
+					rollup.add(topic, message)
+				else:
+					self.push_event(collection, message)
+				now = clock()
+				stats.record_event(collection, pushed, t0, t1, t2, t3, t4, now)
+				continue
+			event = {}
+			keep = self.process_topic(event, topic)
+			now = clock()
+			t2 = now - shift
+			if not keep:
+				stats.record_event(collection, 'dropped_by_topic', t0, t1, t2)
+				continue
+			keep = self.process_payload(event, topic, message)
+			t3 = now = clock()
+			if not keep:
+				stats.record_event(collection, 'dropped_by_payload', t0, t1, t2, t3)
+				continue
+			keep = self.process_time(event, topic, message)
+			t4 = now = clock()
+			if not keep:
+				stats.record_event(collection, 'dropped_by_time', t0, t1, t2, t3, t4)
+				continue
+			if rollup is not None:
+				rollup.add(topic, event)
+			else:
+				self.push_event(collection, event)
+			now = clock()
+			stats.record_event(collection, pushed, t0, t1, t2, t3, t4, now)
+
+	def _collection_by_topic(self):
+		"""Whether the default ``process_collection`` is in use, which only looks at the topic."""
+		return self._default_collection_hook and 'process_collection' not in self.__dict__
+
+	def _fast_path(self):
+		"""Whether the default event hooks are in use, on the class and the instance."""
+		if not self._default_event_hooks:
+			return False
+		instance = self.__dict__
+		return not ('process_topic' in instance or 'process_payload' in instance or 'process_time' in instance)
+
+	def get_stats(self):
+		"""Return a snapshot of the relay's counters, latency histograms and queue sizes.
+
+		Counters cover messages received, decoded and failing to decode, events dropped by
+		each stage of the pipeline, and events pushed, uploaded, rejected or failing to
+		upload. ``stages`` has a latency histogram for each stage of the pipeline and
+		``collections`` has the counters and a latency histogram per collection. Histograms
+		sample one in `sample_every` messages, 16 by default. Collecting stats can be turned
+		off with ``enabled: false`` in the `stats` settings, in which case only the queue and
+		cache sizes are returned.
+
+		Returns:
+			dict: The stats, made up of plain dictionaries, lists and numbers.
+		"""
+		stats = self.stats.snapshot() if self.stats is not None else {'enabled': False}
+		stats['collection_cache'] = self.collection_cache.stats()
+		stats['subscriptions'] = self.subscriber.stats()
+		if self.batcher:
+			stats['batcher'] = {'pending': self.batcher.pending()}
+		if self.uploader:
+			stats['upload_queue'] = {'depth': self.uploader.qsize(), 'size': self.uploader.queue_size}
+		if self.http_pool:
+			stats['http_pool'] = self.http_pool.stats()
+		if self.compressor:
+			stats['compression'] = self.compressor.stats()
+		if self.dedup:
+			stats['dedup'] = self.dedup.stats()
+		if self.recorder:
+			stats['recording'] = self.recorder.stats()
+		if self.downsamplers:
+			downsampling = stats['downsampling'] = {'kept': 0, 'dropped': 0, 'topics': 0}
+			for downsampler in self.downsamplers.values():
+				for name, value in downsampler.stats().items():
+					downsampling[name] += value
+		if self.rollups:
+			rollups = stats['rollups'] = {'events': 0, 'late': 0, 'unparsed': 0, 'windows': 0, 'open': 0}
+			for rollup in self.rollups.values():
+				for name, value in rollup.stats().items():
+					rollups[name] += value
+		if self.budget:
+			stats['memory_budget'] = self.budget.stats()
+		if self.spool:
+			stats['spool'] = {
+				'bytes': self.spool.size(),
+				'dropped_batches': self.spool.dropped_batches,
+				'dropped_segments': self.spool.dropped_segments,
+				'dropped_bytes': self.spool.dropped_bytes,
+			}
+		return stats
+
 	def start(self):
 		"""Automatically loop in a background thread."""
 		self.running = True
 		self.mqtt_client.loop_start()
+		if self.rollups:
+			self._start_rollup_closer()
+		if self.batcher:
+			self.batcher.start()
+
+	def _start_rollup_closer(self):
+		if self.rollup_closer is None:
+			self.rollup_closer = RollupCloser(self.rollups)
+			self.rollup_closer.start()
 
 	def stop(self):
-		"""Disconnect and stop. """
+		"""Disconnect and stop, uploading any buffered or queued events and open rollups. """
 		self.mqtt_client.loop_stop()
 		self.running = False
+		if self.rollup_closer:
+			self.rollup_closer.stop()
+			self.rollup_closer = None
+		else:
+			self.close_rollups(expired_only=False)
+		if self.batcher:
+			self.batcher.stop()
+		if self.uploader:
+			self.uploader.stop()
+		if self.spool:
+			self.spool_replayer.stop()
+			self.spool.close()
+		if self.http_pool:
+			self.http_pool.close()
+		if self.recorder:
+			self.recorder.close()
+
+	def drain(self):
+		"""Hand on every buffered event and wait for every queued upload to finish.
+
+		Open rollup windows are left open.
+
+		Returns:
+			int: The number of batches the upload workers failed to upload, and dropped, since
+			the last drain. Without upload workers a failed upload raises instead.
+		"""
+		if self.batcher:
+			self.batcher.flush()
+		if self.uploader:
+			self.uploader.join()
+			return self.uploader.take_failures()
+		return 0
 
 	def step(self):
 		"""Do a single MQTT step.
@@ -136,6 +740,30 @@ class KeenMQTT:
 		if self.running:
 			raise BackgroundRunningException("Cannot perform a step whilst background loop is running.")
 		self.mqtt_client.loop()
+		if self.rollups:
+			self.close_rollups()
+		if self.batcher:
+			self.batcher.flush_expired()
+
+	def _push_rollup(self, collection, event):
+		self.push_event(collection, event)
+
+	def close_rollups(self, expired_only=True):
+		"""Push the rollups of windows which have ended, see ``keenmqtt.rollups``.
+
+		Called by ``step``, or by a background thread after ``start``.
+
+		Args:
+			expired_only (bool): Close only windows which ended at least `grace` seconds
+				ago, rather than every open window.
+		Return:
+			None
+		"""
+		for rollup in list(self.rollups.values()):
+			if expired_only:
+				rollup.close_expired()
+			else:
+				rollup.close_all()
 
 	def process_topic(self, event, topic):
 		"""Process an incoming MQTT message's topic string.
@@ -159,7 +787,7 @@ class KeenMQTT:
 		"""Assign a collection to the MQTT message.
 
 		By default will find a matching topic in the collection_mapping dictionary and return
-		the associated string. Could also be based on event contents.
+		the associated string, see ``match_mapping``. Could also be based on event contents.
 
 		Args:
 			event (dict): The event dictionary for this mqtt message.
@@ -169,12 +797,29 @@ class KeenMQTT:
 			str: A string indicating the Keen IO collection which this event should be pushed to, or 
 			false if a matching event collection could not be found.
 		"""
-		for subscription in self.collection_mapping:
-			if mqtt.topic_matches_sub(subscription, topic):
-				return self.collection_mapping[subscription]
-		return False
+		return self.match_mapping(topic)[0]
+
+	def match_mapping(self, topic):
+		"""Find the collection mapping for a topic.
 
-	def add_collection_mapping(self,sub,collection):
+		If several subscriptions match, the one which was added first wins. Results,
+		including topics with no match, are remembered in ``collection_cache``.
+
+		Args:
+			topic (str): The topic string.
+
+		Return:
+			tuple: The collection, the compiled transform, the downsampler and the rollup, each
+			``None`` if the mapping has no such rules. ``(False, None, None, None)`` if no
+			mapping matches.
+		"""
+		mapping = self.collection_cache.get(topic, _MISSING)
+		if mapping is _MISSING:
+			mapping = self.collection_index.match(topic, _NO_MAPPING)
+			self.collection_cache.put(topic, mapping)
+		return mapping
+
+	def add_collection_mapping(self, sub, collection, transform=None, downsampler=None, rollup=None, qos=None):
 		"""Add a subcription to event collection mapping.
 
 		This will overide existing subscriptions if present.
@@ -182,30 +827,141 @@ class KeenMQTT:
 		Args:
 			sub (str): The string subscription pattern.
 			collection (str): The sting event collection.
+			transform Optional[callable]: Called with ``(topic, message)`` for each decoded
+				message on matching topics, returning the message to use or ``None`` to drop
+				it. See ``keenmqtt.transforms.compile_transform``.
+			downsampler Optional[Downsampler]: Decides which of the transformed messages on
+				each matching topic to keep. See ``keenmqtt.downsampling``.
+			rollup Optional[Rollup]: Summarises the events on each matching topic over
+				windows of time, and is pushed instead of them. See ``keenmqtt.rollups``.
+			qos Optional[int]: The QoS to subscribe with, the `subscriptions` default if ``None``.
 
 		Return:
 			None
+
+		Raises:
+			ValueError: When the subscription pattern or QoS is malformed.
 		"""
+		check_subscription(sub)
+		if qos is not None:
+			qos = check_qos(qos)
 		self.collection_mapping[sub] = collection
+		if qos is not None:
+			self.subscription_qos[sub] = qos
+		else:
+			self.subscription_qos.pop(sub, None)
+		if downsampler is not None:
+			self.downsamplers[sub] = downsampler
+		else:
+			self.downsamplers.pop(sub, None)
+		if rollup is not None:
+			self.rollups[sub] = rollup
+		else:
+			self.rollups.pop(sub, None)
+		entry = (collection, transform, downsampler, rollup)
+		self.collection_index.add(sub, entry)
+		self.collection_cache.clear()
+		self._mapping_entries[sub] = entry
+		self._mapping_settings.pop(sub, None)
+
+	def reload_collection_mappings(self, mappings):
+		"""Replace every collection mapping while connected, such as after the config file changed.
+
+		The new matching index is built aside and swapped in between messages, so each message
+		is handled entirely by either the old or the new mappings. Mappings whose settings are
+		unchanged keep their downsampling state and open rollup windows, while the open windows
+		of removed or changed mappings are pushed. Only the filters which were added, or whose
+		QoS changed, are subscribed to and only those removed are unsubscribed from, see
+		``keenmqtt.subscriptions.Subscriber.update``.
+
+		With ``keenmqtt.aio``, call this from the event loop's thread.
+
+		Args:
+			mappings (dict): The new `collection_mappings` section of config.yaml.
+		Return:
+			tuple: The lists of subscriptions added and removed.
+		Raises:
+			ValueError: When a mapping is invalid, in which case nothing is changed.
+		"""
+		mappings = mappings or {}
+		entries = {}
+		subscription_qos = {}
+		for subscription, mapping in mappings.items():
+			check_subscription(subscription)
+			if subscription in self._mapping_settings and \
+					_mapping_rules(self._mapping_settings[subscription]) == _mapping_rules(mapping):
+				entries[subscription] = self._mapping_entries[subscription]
+			else:
+				entries[subscription] = self._mapping_from_settings(mapping)
+			qos = self._mapping_qos(mapping)
+			if qos is not None:
+				subscription_qos[subscription] = qos
+		index = TopicTrie()
+		for subscription, entry in entries.items():
+			index.add(subscription, entry)
+		old_entries = self._mapping_entries
+		added = [subscription for subscription in entries if subscription not in old_entries]
+		removed = [subscription for subscription in old_entries if subscription not in entries]
+		retired = [entry[3] for subscription, entry in old_entries.items()
+			if entry[3] is not None and entries.get(subscription) is not entry]
+
+		with self._mapping_lock:
+			self.collection_index = index
+			self.collection_cache.clear()
+			self.collection_mapping = dict((subscription, entry[0]) for subscription, entry in entries.items())
+			# The rollup closer holds on to these dictionaries, so they are updated in place.
+			self.downsamplers.clear()
+			self.downsamplers.update((subscription, entry[2]) for subscription, entry in entries.items()
+				if entry[2] is not None)
+			self.rollups.clear()
+			self.rollups.update((subscription, entry[3]) for subscription, entry in entries.items()
+				if entry[3] is not None)
+			self._mapping_entries = entries
+			self._mapping_settings = dict(mappings)
+			self.subscription_qos = subscription_qos
+			for rollup in retired:
+				rollup.close_all()
+
+		if self.running and self.rollups:
+			self._start_rollup_closer()
+		self.subscriber.update(self.mqtt_client, self._subscription_filters())
+		logger.info("Reloaded collection mappings: {} added, {} removed".format(len(added), len(removed)))
+		return added, removed
+
+	def _mapping_from_settings(self, mapping):
+		"""Return the arguments of ``add_collection_mapping`` for a mapping in the config file."""
+		if isinstance(mapping, dict):
+			return (mapping['collection'], compile_transform(mapping),
+				Downsampler.from_settings(mapping.get('downsample')),
+				Rollup.from_settings(mapping['collection'], self._push_rollup, mapping.get('rollup'), self.timestamper))
+		return (mapping, None, None, None)
+
+	def _mapping_qos(self, mapping):
+		if isinstance(mapping, dict) and 'qos' in mapping:
+			return check_qos(mapping['qos'])
+		return None
 
 	def decode_payload(self, topic, payload):
 		"""Decode the payload of an incoming MQTT payload.
 
 		By default a JSON object is expected, however this method can be overriden to provide
 		alternative means to extract a MQTT payload. For example, a binary format could be 
-		extracted here.
+		extracted here. Alternatively, decoders can be chosen per topic pattern with the
+		`decoders` setting, see ``keenmqtt.decoders``. JSON is parsed straight from the payload
+		bytes by the fastest installed JSON library.
 
 		Args:
 			topic (str): The topic string.
-			payload (str): Raw MQTT payload.
+			payload (bytes): Raw MQTT payload.
 
 		Returns:
 			An array of dictionaries containing the decoded MQTT payload.
 
 		Raises:
-			ValueError: Whent the JSON payload cannot be parsed.
+			ValueError: Whent the payload cannot be parsed. ``on_mqtt_message`` counts and
+			drops these messages.
 		"""
-		return [json.loads(payload)]
+		return self.decoders.for_topic(topic)(topic, payload)
 
 	def process_payload(self, event, topic, message):
 		"""Process an incoming MQTT message's payload.
@@ -250,7 +1006,9 @@ class KeenMQTT:
 		"""Get the timestamp to send to Keen IO.
 
 		This method is used to extract the timestamp from the MQTT message if required, 
-		or to generate a timestamp. By default, the current time will be fetched.
+		or to generate a timestamp. By default, the current time will be fetched, or with
+		`timestamps: {source: receive}` the time the MQTT message was received. Times are
+		in UTC, see ``keenmqtt.timestamps.Timestamper``.
 
 		Args:
 			topic (str): The topic string.
@@ -259,11 +1017,19 @@ class KeenMQTT:
 		Returns:
 			str: A string containing ISO-8601 string.
 		"""
-		return datetime.now().isoformat()
+		timestamper = self.timestamper
+		if timestamper.source == RECEIVE and self.received_at is not None:
+			return timestamper.format(self.received_at)
+		return timestamper.now()
 	
 	def push_event(self, collection, event):
 		"""Thin wrapper around Keen IO API object.
 
+		If batching is enabled the event is buffered and uploaded later by ``upload_events``.
+		If upload workers are enabled the upload happens in a background thread, and if a
+		spool is set up a failed upload is spooled rather than raising an exception. With a
+		memory budget, the event may be held back or dropped first, see ``setup_memory_budget``.
+
 		Args:
 			collection (str): The collection string to push to
 			event (dict): The complete event to push
@@ -271,10 +1037,105 @@ class KeenMQTT:
 			None
 		"""
 		assert self.ready == True
-		logger.debug("Saving event to collection {collection}: '{event}'".format(collection=collection, event=event))
-		self.keen_client.add_event(collection, event)
+		if logger.isEnabledFor(logging.DEBUG):
+			logger.debug("Saving event to collection {collection}: '{event}'".format(collection=collection, event=event))
+		if self.batcher:
+			if self.budget is not None and not self._charge_budget(collection, event):
+				return
+			self.batcher.add(collection, event)
+		elif self.uploader or self.spool:
+			if self.budget is not None and not self._charge_budget(collection, event):
+				return
+			self.dispatch_events({collection: [event]})
+		else:
+			try:
+				self.keen_client.add_event(collection, event)
+			except Exception:
+				if self.stats is not None:
+					self.stats.record_upload_error({collection: [event]})
+				raise
+			if self.stats is not None:
+				self.stats.record_upload({collection: (1, 0)})
+
+	def dispatch_events(self, events):
+		"""Send a batch of events on, either to the upload workers or straight to Keen IO.
+
+		Args:
+			events (dict): A dictionary of collection names to lists of events.
+		Returns:
+			None
+		"""
+		if self.uploader:
+			if not self.uploader.submit(events, block=self.spool is None):
+				self.spool.append(events)
+				if self.budget is not None:
+					self.budget.release(events)
+		else:
+			self.deliver_events(events)
+
+	def deliver_events(self, events):
+		"""Upload a batch of events, spooling them to disk if the upload fails.
+
+		Args:
+			events (dict): A dictionary of collection names to lists of events.
+		Returns:
+			None
+
+		Raises:
+			Exception: Whatever ``upload_events`` raised, if no spool is set up.
+		"""
+		try:
+			self.upload_events(events)
+		except Exception:
+			if self.spool is None:
+				raise
+			logger.warning("Upload failed, spooling events", exc_info=True)
+			self.spool.append(events)
+		finally:
+			if self.budget is not None:
+				self.budget.release(events)
+
+	def upload_events(self, events):
+		"""Upload a batch of events with a single Keen IO bulk request.
+
+		Args:
+			events (dict): A dictionary of collection names to lists of events.
+		Returns:
+			None
+		"""
+		count = sum(len(batch) for batch in events.values())
+		logger.debug("Uploading {count} events to {collections} collections".format(count=count, collections=len(events)))
+		try:
+			results = self.keen_client.add_events(events)
+		except Exception:
+			self._record_upload_error(events)
+			raise
+		self._record_upload(events, results)
+
+	def _record_upload(self, events, results):
+		"""Log and count the events Keen IO accepted and rejected in a bulk upload."""
+		counts = {}
+		for collection, batch in events.items():
+			failed = 0
+			if isinstance(results, dict):
+				failed = len([status for status in results.get(collection, []) if not status.get('success', True)])
+			if failed:
+				logger.warning("{failed} events rejected by collection {collection}".format(failed=failed, collection=collection))
+			counts[collection] = (len(batch) - failed, failed)
+		if self.stats is not None:
+			self.stats.record_upload(counts)
+
+	def _record_upload_error(self, events):
+		if self.stats is not None:
+			self.stats.record_upload_error(events)
 
 class BackgroundRunningException(Exception):
 	""" Used when the user tries to run in the foreground whilst
 	a background loop is already running."""
-	pass
\ No newline at end of file
+	pass
+
+class UploadError(Exception):
+	""" Used when Keen IO answers an upload with an error status."""
+	def __init__(self, status, message):
+		Exception.__init__(self, "Keen IO upload failed with status {}: {}".format(status, message))
+		self.status = status
\ No newline at end of file
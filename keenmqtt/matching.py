@@ -0,0 +1,249 @@
+""" Fast lookup of the subscription patterns which match an MQTT topic """
+
+from collections import OrderedDict
+
+
+def check_subscription(sub):
+	"""Check that an MQTT subscription pattern is well formed.
+
+	Args:
+		sub (str): The subscription pattern.
+	Raises:
+		ValueError: When the pattern is empty, or a wildcard is not a whole level or ``#`` is
+			not the last level.
+	"""
+	if not sub:
+		raise ValueError("A subscription cannot be empty")
+	levels = sub.split('/')
+	for index, level in enumerate(levels):
+		if level == '#' and index != len(levels) - 1:
+			raise ValueError("'#' must be the last level of the subscription '{}'".format(sub))
+		if level not in ('#', '+') and ('#' in level or '+' in level):
+			raise ValueError("Wildcards must be a whole level of the subscription '{}'".format(sub))
+
+
+class _Node(object):
+	__slots__ = ('children', 'plus', 'hash', 'value')
+
+	def __init__(self):
+		self.children = {}
+		self.plus = None
+		self.hash = None
+		self.value = None
+
+
+class TopicTrie(object):
+	"""An index of MQTT subscription patterns, split into a tree by topic level.
+
+	Looking up a topic only visits the branches which can match it, so the cost depends on
+	the depth of the topic rather than the number of subscriptions. Matching follows
+	``paho.mqtt.client.topic_matches_sub``, including ``#`` matching the parent level and
+	wildcards in the first level never matching topics starting with ``$``.
+
+	When more than one subscription matches, ``match`` returns the value of the subscription
+	which was added first, which is the same as scanning the subscriptions in insertion order.
+	Re-adding an existing subscription replaces its value but keeps its position.
+	"""
+
+	def __init__(self):
+		self._root = _Node()
+		self._order = {}
+		self._next = 0
+
+	def __len__(self):
+		return len(self._order)
+
+	def __contains__(self, sub):
+		return sub in self._order
+
+	def add(self, sub, value):
+		"""Add or replace a subscription.
+
+		Args:
+			sub (str): The subscription pattern.
+			value: The value returned by ``match`` for topics matching ``sub``.
+		Return:
+			None
+		"""
+		if sub in self._order:
+			order = self._order[sub]
+		else:
+			order = self._next
+			self._next += 1
+			self._order[sub] = order
+		node = self._root
+		for level in sub.split('/'):
+			if level == '#':
+				if node.hash is None:
+					node.hash = _Node()
+				node = node.hash
+				break
+			elif level == '+':
+				if node.plus is None:
+					node.plus = _Node()
+				node = node.plus
+			else:
+				child = node.children.get(level)
+				if child is None:
+					child = node.children[level] = _Node()
+				node = child
+		node.value = (order, value)
+
+	def remove(self, sub):
+		"""Remove a subscription, if present.
+
+		Args:
+			sub (str): The subscription pattern.
+		Return:
+			None
+		"""
+		if self._order.pop(sub, None) is None:
+			return
+		path = []
+		node = self._root
+		for level in sub.split('/'):
+			path.append((node, level))
+			if level == '#':
+				node = node.hash
+				break
+			elif level == '+':
+				node = node.plus
+			else:
+				node = node.children[level]
+		node.value = None
+		# Prune branches which no longer lead to any subscription.
+		for parent, level in reversed(path):
+			if node.value is not None or node.children or node.plus or node.hash:
+				break
+			if level == '#':
+				parent.hash = None
+			elif level == '+':
+				parent.plus = None
+			else:
+				del parent.children[level]
+			node = parent
+
+	def match(self, topic, default=None):
+		"""Find the value of the first added subscription matching a topic.
+
+		Args:
+			topic (str): A concrete topic string.
+			default: Returned when no subscription matches.
+		Return:
+			The matching value, or ``default``.
+		"""
+		levels = topic.split('/')
+		best = self._match(self._root, levels, 0, None, topic.startswith('$'))
+		if best is None:
+			return default
+		return best[1]
+
+	def covering(self, sub):
+		"""Find the other subscriptions which match every topic that ``sub`` matches.
+
+		For example ``home/#`` and ``home/+/temp`` cover ``home/kitchen/temp``, and ``home/#``
+		covers ``home/+/temp``.
+
+		Args:
+			sub (str): A subscription pattern, which need not have been added.
+		Return:
+			list: The values of the covering subscriptions.
+		"""
+		levels = sub.split('/')
+		found = []
+		self._cover(self._root, levels, 0, self._order.get(sub), levels[0].startswith('$'), found)
+		return [value for _, value in found]
+
+	def _cover(self, node, levels, depth, own, system, found):
+		wildcards = not (system and depth == 0)
+		# ``#`` covers everything below its parent level, including another ``#``.
+		if wildcards and node.hash is not None and node.hash.value is not None and node.hash.value[0] != own:
+			found.append(node.hash.value)
+		if depth == len(levels):
+			if node.value is not None and node.value[0] != own:
+				found.append(node.value)
+			return
+		level = levels[depth]
+		if level == '#':
+			return
+		if level != '+':
+			child = node.children.get(level)
+			if child is not None:
+				self._cover(child, levels, depth + 1, own, system, found)
+		if wildcards and node.plus is not None:
+			self._cover(node.plus, levels, depth + 1, own, system, found)
+
+	def _match(self, node, levels, depth, best, system):
+		wildcards = not (system and depth == 0)
+		if wildcards and node.hash is not None and node.hash.value is not None:
+			if best is None or node.hash.value[0] < best[0]:
+				best = node.hash.value
+		if depth == len(levels):
+			if node.value is not None and (best is None or node.value[0] < best[0]):
+				best = node.value
+			return best
+		child = node.children.get(levels[depth])
+		if child is not None:
+			best = self._match(child, levels, depth + 1, best, system)
+		if wildcards and node.plus is not None:
+			best = self._match(node.plus, levels, depth + 1, best, system)
+		return best
+
+
+class TopicCache(object):
+	"""A size bounded, least recently used cache of topic lookup results.
+
+	Negative results can be cached too, so ``get`` signals a miss by returning ``default``
+	rather than ``None``. A ``maxsize`` of ``0`` disables caching.
+
+	Args:
+		maxsize (int): The maximum number of topics to remember.
+	"""
+
+	def __init__(self, maxsize=4096):
+		self.maxsize = maxsize
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._entries = OrderedDict()
+
+	def __len__(self):
+		return len(self._entries)
+
+	def get(self, topic, default=None):
+		"""Return the cached result for a topic, or ``default`` if it is not cached."""
+		try:
+			value = self._entries.pop(topic)
+		except KeyError:
+			self.misses += 1
+			return default
+		self._entries[topic] = value
+		self.hits += 1
+		return value
+
+	def put(self, topic, value):
+		"""Cache the result for a topic, evicting the least recently used entry if full."""
+		if not self.maxsize:
+			return
+		self._entries[topic] = value
+		if len(self._entries) > self.maxsize:
+			self._entries.popitem(last=False)
+			self.evictions += 1
+
+	def clear(self):
+		"""Forget every cached result, such as when the subscriptions change."""
+		self._entries.clear()
+
+	def stats(self):
+		"""Return the cache counters.
+
+		Return:
+			dict: ``size``, ``maxsize``, ``hits``, ``misses`` and ``evictions``.
+		"""
+		return {
+			'size': len(self._entries),
+			'maxsize': self.maxsize,
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+		}
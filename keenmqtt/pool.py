@@ -0,0 +1,113 @@
+""" A shared keep-alive HTTP connection pool for Keen IO uploads """
+
+import threading
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class CountingAdapter(HTTPAdapter):
+	"""A ``requests`` transport adapter which counts requests and new connections.
+
+	Connections are counted by the urllib3 pools which served the requests, so the
+	number of reused connections is the number of requests less the connections opened.
+	Request bodies are gzipped by ``compressor``, if one is set.
+	"""
+
+	def __init__(self, *args, **kwargs):
+		self.compressor = kwargs.pop('compressor', None)
+		self.requests = 0
+		self._counted_lock = threading.Lock()
+		self._pools = weakref.WeakSet()
+		HTTPAdapter.__init__(self, *args, **kwargs)
+
+	def send(self, request, **kwargs):
+		if self.compressor is not None and request.body:
+			compressed = self.compressor.compress(request.body)
+			if compressed is not None:
+				request.body = compressed
+				request.headers['Content-Encoding'] = 'gzip'
+				request.headers['Content-Length'] = str(len(compressed))
+		response = HTTPAdapter.send(self, request, **kwargs)
+		pool = getattr(response.raw, '_pool', None)
+		with self._counted_lock:
+			self.requests += 1
+			if pool is not None:
+				self._pools.add(pool)
+		return response
+
+	def connections_opened(self):
+		"""Return the number of connections opened by the pools currently in use."""
+		with self._counted_lock:
+			return sum(pool.num_connections for pool in list(self._pools))
+
+
+class HTTPPool(object):
+	"""A ``requests`` session with a bounded pool of keep-alive connections.
+
+	The relay hands the session to its Keen IO client, so every upload, from whichever
+	thread, reuses an idle connection rather than making a new TCP and TLS handshake.
+	When all ``pool_size`` connections to a host are busy, further requests wait for one.
+
+	Args:
+		pool_size (int): Maximum connections kept open per host. Use at least as many as
+			there are upload workers.
+		connect_timeout (float): Seconds to wait for a connection to be made.
+		read_timeout (float): Seconds to wait for the server to answer.
+		compressor Optional[GzipCompressor]: Compresses request bodies in the thread making
+			the request, see ``keenmqtt.compression``.
+	"""
+
+	def __init__(self, pool_size=10, connect_timeout=5.0, read_timeout=30.0, compressor=None):
+		self.pool_size = pool_size
+		self.timeout = (connect_timeout, read_timeout)
+		self.adapter = CountingAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True,
+			compressor=compressor)
+		self.session = requests.Session()
+		self.session.mount('https://', self.adapter)
+		self.session.mount('http://', self.adapter)
+
+	@classmethod
+	def from_settings(cls, settings, compressor=None):
+		"""Create a pool from the `http_pool` section of a config file.
+
+		Args:
+			settings Optional[dict]: Dictionary with optional ``pool_size``,
+				``connect_timeout`` and ``read_timeout`` keys.
+			compressor Optional[GzipCompressor]: See the class documentation.
+		Return:
+			HTTPPool: The pool.
+		"""
+		settings = settings or {}
+		return cls(pool_size=int(settings.get('pool_size', 10)),
+			connect_timeout=float(settings.get('connect_timeout', 5.0)),
+			read_timeout=float(settings.get('read_timeout', 30.0)),
+			compressor=compressor)
+
+	def attach(self, keen_client):
+		"""Make a ``keen.KeenClient`` send its requests through this pool.
+
+		Args:
+			keen_client (keen.KeenClient): The client.
+		Return:
+			None
+		"""
+		keen_client.api.session = self.session
+		keen_client.api.post_timeout = self.timeout
+		keen_client.api.get_timeout = self.timeout
+
+	def stats(self):
+		"""Return the pool size and the number of requests, new and reused connections."""
+		requests_sent = self.adapter.requests
+		opened = self.adapter.connections_opened()
+		return {
+			'size': self.pool_size,
+			'requests': requests_sent,
+			'connections_opened': opened,
+			'connections_reused': max(requests_sent - opened, 0),
+		}
+
+	def close(self):
+		"""Close every pooled connection."""
+		self.session.close()
@@ -0,0 +1,301 @@
+""" Recording of raw MQTT traffic to a compact binary log, and its replay.
+
+With a `recording` section in the config file, every message the relay receives is
+appended to a log before it is decoded::
+
+    recording:
+        directory: /var/lib/keenmqtt/recording
+        segment_size: 67108864
+        max_segments: 16
+
+The log is split into numbered segment files of about ``segment_size`` bytes. Each segment
+starts with a magic marker and a version byte, followed by records:
+
+* a topic record, ``0x01``, a 32-bit topic number, a 16-bit length and the UTF-8 topic,
+  written the first time a segment sees a topic;
+* a message record, ``0x02``, the receive time as a double, the 32-bit topic number, a
+  flags byte holding the QoS and the retain flag, a 32-bit length and the raw payload.
+
+So a repeated topic costs four bytes, and every segment can be read on its own. Integers
+are big-endian. A record torn by a crash ends the segment it is in.
+
+``read_log`` reads a segment or a directory of segments back, and ``Replayer`` feeds them
+to a relay's ``on_mqtt_message`` at their original pace, a multiple of it, or flat out.
+"""
+
+import io
+import logging
+import os
+import struct
+import threading
+import time
+
+logger = logging.getLogger('keenmqtt')
+
+MAGIC = b'KMQR'
+VERSION = 1
+_SUFFIX = '.mqlog'
+_FILE_HEADER = struct.Struct('>4sB')
+_TOPIC = struct.Struct('>BIH')
+_MESSAGE = struct.Struct('>BdIBI')
+_TOPIC_RECORD = 1
+_MESSAGE_RECORD = 2
+_RETAIN = 0x04
+
+
+class RecordedMessage(object):
+	"""A message read from a log, with the attributes of ``paho.mqtt.client.MQTTMessage``
+	which ``on_mqtt_message`` uses. ``timestamp`` is the Unix time it was received."""
+
+	__slots__ = ('topic', 'payload', 'qos', 'retain', 'mid', 'timestamp')
+
+	def __init__(self, topic, payload, qos=0, retain=False, timestamp=0.0):
+		self.topic = topic
+		self.payload = payload
+		self.qos = qos
+		self.retain = retain
+		self.mid = 0
+		self.timestamp = timestamp
+
+
+class Recorder(object):
+	"""Append raw MQTT messages to a log split into segment files.
+
+	Safe to share between threads. Writes are buffered, so the last messages reach the
+	disk on ``flush``, ``close`` or rotation.
+
+	Args:
+		directory (str): Directory holding the segment files, created if missing.
+		segment_size (int): Start a new segment once the current one reaches this size.
+		max_segments (int): Delete the oldest segments so at most this many are kept.
+			``0`` keeps every segment.
+	"""
+
+	def __init__(self, directory, segment_size=64 * 1024 * 1024, max_segments=0):
+		self.directory = directory
+		self.segment_size = segment_size
+		self.max_segments = max_segments
+		self.messages = 0
+		self.bytes = 0
+		self.rotations = 0
+		self._lock = threading.Lock()
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self._segments = segment_paths(directory)
+		self._next_seq = int(os.path.basename(self._segments[-1])[:-len(_SUFFIX)]) + 1 if self._segments else 0
+		self._active = None
+		self._active_size = 0
+		self._topics = {}
+
+	@classmethod
+	def from_settings(cls, settings):
+		"""Create a recorder from the `recording` section of a config file.
+
+		Args:
+			settings (dict): Dictionary with a ``directory`` key and optional ``segment_size``
+				and ``max_segments`` keys.
+		Return:
+			Recorder: The new recorder.
+		"""
+		return cls(settings['directory'],
+			segment_size=int(settings.get('segment_size', 64 * 1024 * 1024)),
+			max_segments=int(settings.get('max_segments', 0)))
+
+	def record(self, topic, payload, qos=0, retain=False, now=None):
+		"""Append a message to the log.
+
+		Args:
+			topic (str): The topic string.
+			payload (bytes): Raw MQTT payload.
+			qos (int): The QoS it was received with.
+			retain (bool): Whether it was a retained message.
+			now Optional[float]: The Unix time it was received, the current time by default.
+		Return:
+			None
+		"""
+		if now is None:
+			now = time.time()
+		with self._lock:
+			if self._active is None or self._active_size >= self.segment_size:
+				self._rotate()
+			write = self._active.write
+			size = 0
+			number = self._topics.get(topic)
+			if number is None:
+				number = self._topics[topic] = len(self._topics)
+				name = topic.encode('utf-8')
+				write(_TOPIC.pack(_TOPIC_RECORD, number, len(name)))
+				write(name)
+				size += _TOPIC.size + len(name)
+			write(_MESSAGE.pack(_MESSAGE_RECORD, now, number, qos | (_RETAIN if retain else 0), len(payload)))
+			write(payload)
+			size += _MESSAGE.size + len(payload)
+			self._active_size += size
+			self.bytes += size
+			self.messages += 1
+
+	def flush(self):
+		"""Write buffered records to the current segment."""
+		with self._lock:
+			if self._active is not None:
+				self._active.flush()
+
+	def close(self):
+		"""Close the current segment. The next message starts a new one."""
+		with self._lock:
+			self._close_active()
+
+	def stats(self):
+		"""Return the number of messages and bytes recorded, rotations and segments kept."""
+		return {
+			'messages': self.messages,
+			'bytes': self.bytes,
+			'rotations': self.rotations,
+			'segments': len(self._segments),
+		}
+
+	def _rotate(self):
+		if self._active is not None:
+			self._close_active()
+			self.rotations += 1
+		path = os.path.join(self.directory, '{:08d}{}'.format(self._next_seq, _SUFFIX))
+		self._next_seq += 1
+		self._active = io.open(path, 'wb')
+		self._active.write(_FILE_HEADER.pack(MAGIC, VERSION))
+		self._active_size = _FILE_HEADER.size
+		self._topics = {}
+		self._segments.append(path)
+		if self.max_segments:
+			while len(self._segments) > self.max_segments:
+				oldest = self._segments.pop(0)
+				try:
+					os.remove(oldest)
+				except OSError:
+					logger.warning("Could not remove recording segment {}".format(oldest), exc_info=True)
+
+	def _close_active(self):
+		if self._active is not None:
+			self._active.close()
+			self._active = None
+
+
+def segment_paths(path):
+	"""Return the segment files of a log in the order they were written.
+
+	Args:
+		path (str): A directory of segments, or a single segment file.
+	Return:
+		list: Of paths.
+	"""
+	if not os.path.isdir(path):
+		return [path]
+	return [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(_SUFFIX)]
+
+
+def read_log(path):
+	"""Yield the messages of a log.
+
+	Args:
+		path (str): A directory of segments, or a single segment file.
+	Return:
+		generator: Of ``RecordedMessage``, in the order they were recorded.
+	"""
+	for segment in segment_paths(path):
+		for message in _read_segment(segment):
+			yield message
+
+
+def _read_segment(path):
+	with io.open(path, 'rb') as segment:
+		data = segment.read()
+	if data[:len(MAGIC)] != MAGIC:
+		raise ValueError("{} is not a keenmqtt recording".format(path))
+	version = _FILE_HEADER.unpack_from(data)[1]
+	if version != VERSION:
+		raise ValueError("{} is a version {} recording, not {}".format(path, version, VERSION))
+	topics = {}
+	position = _FILE_HEADER.size
+	end = len(data)
+	message_size = _MESSAGE.size
+	unpack_message = _MESSAGE.unpack_from
+	while position < end:
+		kind = data[position:position + 1]
+		if kind == b'\x02' and position + message_size <= end:
+			_, now, number, flags, length = unpack_message(data, position)
+			position += message_size
+			if position + length > end:
+				break
+			yield RecordedMessage(topics[number], data[position:position + length], flags & 0x03,
+				bool(flags & _RETAIN), now)
+			position += length
+		elif kind == b'\x01' and position + _TOPIC.size <= end:
+			_, number, length = _TOPIC.unpack_from(data, position)
+			position += _TOPIC.size
+			if position + length > end:
+				break
+			topics[number] = data[position:position + length].decode('utf-8')
+			position += length
+		else:
+			break
+	if position < end:
+		logger.warning("Skipping {} bytes of a torn or damaged record at the end of {}".format(end - position, path))
+
+
+class Replayer(object):
+	"""Feed the messages of a log to a relay's ``on_mqtt_message``.
+
+	The relay timestamps events with the time they are replayed, as it would live messages.
+
+	Args:
+		relay (KeenMQTT): A set up relay. Its MQTT client need not be connected.
+		path (str): A directory of segments, or a single segment file.
+		speed (float): A multiple of the recorded pace, ``2`` replaying twice as fast. ``0``
+			replays as fast as the relay can take the messages.
+	"""
+
+	def __init__(self, relay, path, speed=1.0):
+		if speed < 0:
+			raise ValueError("A replay speed cannot be negative, not {}".format(speed))
+		self.relay = relay
+		self.path = path
+		self.speed = speed
+		self.messages = 0
+		self.max_lag = 0.0
+		self._stopping = threading.Event()
+
+	def run(self):
+		"""Replay the whole log, or until ``stop`` is called.
+
+		Return:
+			dict: The messages replayed, the seconds taken, the messages per second and the
+			most seconds a message was replayed behind its schedule.
+		"""
+		on_message = self.relay.on_mqtt_message
+		speed = self.speed
+		started = time.time()
+		first = None
+		for message in read_log(self.path):
+			if self._stopping.is_set():
+				break
+			if speed:
+				if first is None:
+					first = message.timestamp
+				delay = started + (message.timestamp - first) / speed - time.time()
+				if delay > 0:
+					if self._stopping.wait(delay):
+						break
+				elif -delay > self.max_lag:
+					self.max_lag = -delay
+			on_message(None, None, message)
+			self.messages += 1
+		elapsed = time.time() - started
+		return {
+			'messages': self.messages,
+			'seconds': elapsed,
+			'rate': self.messages / elapsed if elapsed > 0 else 0.0,
+			'max_lag': self.max_lag,
+		}
+
+	def stop(self):
+		"""Stop a replay running in another thread."""
+		self._stopping.set()
@@ -0,0 +1,298 @@
+""" Windowed rollups of numeric fields, sent instead of every raw event.
+
+A collection mapping may summarise each concrete topic's events over fixed windows::
+
+    collection_mappings:
+        sensors/+/power:
+            collection: power
+            rollup:
+                window: 60
+                fields: [watts, volts]
+                statistics: [count, min, max, mean, last, stddev]
+                grace: 1.0
+                max_topics: 4096
+
+Windows are aligned to multiples of ``window`` seconds since the epoch, and an event falls
+in the window holding its ``keen.timestamp``, as set from ``KeenMQTT.get_time``. So the same
+events always give the same rollups. A topic's window is closed when an event for a later
+window arrives, ``grace`` seconds after the window has ended or when the relay stops. Its
+rollup is then pushed as a single event, with each field's statistics in a dictionary.
+
+Values are buffered in ``array`` objects of doubles. NumPy, when installed, computes the
+statistics over the whole buffer at once. It is imported when the first window closes.
+"""
+
+import logging
+import math
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from .imports import NOT_IMPORTED, optional_import
+from .timestamps import Timestamper
+
+numpy = NOT_IMPORTED
+
+logger = logging.getLogger('keenmqtt')
+
+STATISTICS = ('count', 'min', 'max', 'mean', 'last', 'stddev')
+
+
+def summarise(values, statistics=STATISTICS):
+	"""Compute statistics of a buffer of values.
+
+	Args:
+		values (array.array): At least one value, as doubles.
+		statistics (tuple): The names of the statistics to compute, from ``STATISTICS``.
+			``stddev`` is the population standard deviation.
+	Return:
+		dict: Each statistic's name to its value.
+	"""
+	global numpy
+	if numpy is NOT_IMPORTED:
+		numpy = optional_import('numpy')
+	count = len(values)
+	if numpy is not None:
+		data = numpy.frombuffer(values, dtype=numpy.float64)
+		summary = {
+			'count': count,
+			'min': float(data.min()),
+			'max': float(data.max()),
+			'mean': float(data.mean()),
+			'last': values[-1],
+			'stddev': float(data.std()),
+		}
+	else:
+		mean = math.fsum(values) / count
+		summary = {
+			'count': count,
+			'min': min(values),
+			'max': max(values),
+			'mean': mean,
+			'last': values[-1],
+			'stddev': math.sqrt(math.fsum((value - mean) ** 2 for value in values) / count),
+		}
+	return dict((name, summary[name]) for name in statistics)
+
+
+class Rollup(object):
+	"""Summarise the numeric fields of each concrete topic's events over fixed windows.
+
+	Safe to share between threads.
+
+	Args:
+		collection (str): The collection rollup events are pushed to.
+		emit (callable): Called with the collection and the rollup event of each closed window.
+		window (float): The length of a window in seconds.
+		fields Optional[list]: The fields to summarise. ``None`` summarises every top-level
+			field holding an ``int`` or a ``float``.
+		statistics (tuple): The statistics to compute, from ``STATISTICS``.
+		grace (float): Seconds after a window ends before ``close_expired`` closes it, to
+			allow for events which arrive late.
+		max_topics (int): The number of topics with an open window. Opening another closes
+			the window of the topic updated least recently.
+		timestamper Optional[Timestamper]: Reads event timestamps and formats window times.
+	"""
+
+	def __init__(self, collection, emit, window=60.0, fields=None, statistics=STATISTICS, grace=1.0,
+			max_topics=4096, timestamper=None):
+		if window <= 0:
+			raise ValueError("A rollup window must be longer than 0 seconds, not {}".format(window))
+		for name in statistics:
+			if name not in STATISTICS:
+				raise ValueError("Unknown rollup statistic '{}'".format(name))
+		self.collection = collection
+		self.emit = emit
+		self.window = window
+		self.fields = tuple(fields) if fields is not None else None
+		self.statistics = tuple(statistics)
+		self.grace = grace
+		self.max_topics = max_topics
+		self.timestamper = timestamper or Timestamper()
+		self.events = 0
+		self.late = 0
+		self.unparsed = 0
+		self.windows = 0
+		self._topics = OrderedDict()
+		self._lock = threading.Lock()
+
+	@classmethod
+	def from_settings(cls, collection, emit, settings, timestamper=None):
+		"""Create a rollup from the `rollup` section of a collection mapping.
+
+		Args:
+			collection (str): See the class documentation.
+			emit (callable): See the class documentation.
+			settings Optional[dict]: Dictionary with optional ``window``, ``fields``,
+				``statistics``, ``grace`` and ``max_topics`` keys.
+			timestamper Optional[Timestamper]: See the class documentation.
+		Return:
+			Rollup: The rollup, or ``None`` if there are no settings.
+		"""
+		if not settings:
+			return None
+		return cls(collection, emit,
+			window=float(settings.get('window', 60.0)),
+			fields=settings.get('fields'),
+			statistics=settings.get('statistics', STATISTICS),
+			grace=float(settings.get('grace', 1.0)),
+			max_topics=int(settings.get('max_topics', 4096)),
+			timestamper=timestamper)
+
+	def add(self, topic, event):
+		"""Add an event's values to its topic's window, closing the previous window if it has ended.
+
+		Events for a window older than the topic's open window are counted as late and dropped.
+		Events whose timestamp is neither an ISO-8601 string nor a Unix time are counted as
+		unparsed and added to the window of the current time.
+
+		Args:
+			topic (str): The concrete topic the event was received on.
+			event (dict): The complete event, timestamped with ``keen.timestamp``.
+		Return:
+			None
+		"""
+		keen = event.get('keen')
+		timestamp = keen.get('timestamp') if keen else None
+		if timestamp is None:
+			seconds = time.time()
+		elif isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool):
+			seconds = timestamp
+		else:
+			try:
+				seconds = self.timestamper.parse(timestamp)
+			except (ValueError, TypeError):
+				seconds = time.time()
+				with self._lock:
+					self.unparsed += 1
+		index = int(seconds // self.window)
+		closed = []
+		with self._lock:
+			topics = self._topics
+			state = topics.pop(topic, None)
+			if state is not None and state[0] != index:
+				if index < state[0]:
+					topics[topic] = state
+					self.late += 1
+					return
+				closed.append((topic, state))
+				state = None
+			if state is None:
+				state = [index, {}]
+			topics[topic] = state
+			buffers = state[1]
+			if self.fields is None:
+				items = event.items()
+			else:
+				items = [(field, event.get(field)) for field in self.fields]
+			for field, value in items:
+				kind = type(value)
+				if kind is float or kind is int:
+					values = buffers.get(field)
+					if values is None:
+						values = buffers[field] = array('d')
+					values.append(value)
+			self.events += 1
+			if len(topics) > self.max_topics:
+				closed.append(topics.popitem(last=False))
+		for topic, state in closed:
+			self._emit(topic, state)
+
+	def close_expired(self, now=None):
+		"""Close every window which ended at least ``grace`` seconds ago.
+
+		Args:
+			now Optional[float]: The current Unix time.
+		Return:
+			int: The number of windows closed.
+		"""
+		if now is None:
+			now = time.time()
+		# Windows with an index below this ended at least ``grace`` seconds ago.
+		limit = (now - self.grace) // self.window
+		with self._lock:
+			closed = [(topic, state) for topic, state in self._topics.items() if state[0] < limit]
+			for topic, state in closed:
+				del self._topics[topic]
+		for topic, state in closed:
+			self._emit(topic, state)
+		return len(closed)
+
+	def open_windows(self):
+		"""Return the ``(topic, window index)`` of every open window."""
+		with self._lock:
+			return [(topic, state[0]) for topic, state in self._topics.items()]
+
+	def close_all(self):
+		"""Close every open window, such as when the relay stops."""
+		with self._lock:
+			closed = list(self._topics.items())
+			self._topics.clear()
+		for topic, state in closed:
+			self._emit(topic, state)
+
+	def stats(self):
+		"""Return the number of events added, late events dropped, events with unparsed timestamps,
+		windows closed and windows open."""
+		return {'events': self.events, 'late': self.late, 'unparsed': self.unparsed, 'windows': self.windows,
+			'open': len(self._topics)}
+
+	def _emit(self, topic, state):
+		index, buffers = state
+		start = index * self.window
+		format = self.timestamper.format
+		event = {
+			'mqtt_topic': topic,
+			'window_start': format(start),
+			'window_end': format(start + self.window),
+			'keen': {'timestamp': format(start)},
+		}
+		for field, values in buffers.items():
+			event[field] = summarise(values, self.statistics)
+		self.windows += 1
+		try:
+			self.emit(self.collection, event)
+		except Exception:
+			logger.exception("Failed to push rollup for {}".format(topic))
+
+
+class RollupCloser(object):
+	"""A background thread which closes expired rollup windows once topics fall quiet.
+
+	Args:
+		rollups (dict): The relay's rollups, read afresh at every check.
+		interval (float): Seconds between checks.
+	"""
+
+	def __init__(self, rollups, interval=1.0):
+		self.rollups = rollups
+		self.interval = interval
+		self._thread = None
+		self._stopping = threading.Event()
+
+	def start(self):
+		"""Start the background thread."""
+		if self._thread is not None:
+			return
+		self._stopping.clear()
+		self._thread = threading.Thread(target=self._run, name='keenmqtt-rollups')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		"""Stop the background thread and close every open window."""
+		if self._thread is not None:
+			self._stopping.set()
+			self._thread.join()
+			self._thread = None
+		for rollup in list(self.rollups.values()):
+			rollup.close_all()
+
+	def _run(self):
+		while not self._stopping.wait(self.interval):
+			for rollup in list(self.rollups.values()):
+				try:
+					rollup.close_expired()
+				except Exception:
+					logger.exception("Failed to close rollup windows")
@@ -0,0 +1,255 @@
+""" Running several relay processes which share the incoming messages """
+
+import logging
+import os
+import signal
+import time
+import zlib
+
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+from .stats import merge_stats
+
+logger = logging.getLogger('keenmqtt')
+
+SHARED = 'shared'
+HASH = 'hash'
+
+
+def shared_subscription(sub, group):
+	"""Return the shared subscription form of a subscription filter.
+
+	Shared subscriptions are part of MQTT 5 and supported by many MQTT 3.1.1 brokers. The
+	broker delivers each message to only one of the clients subscribed in ``group``.
+	"""
+	return '$share/{}/{}'.format(group, sub)
+
+
+def topic_shard(topic, count):
+	"""Return which of ``count`` shards a topic belongs to.
+
+	The CRC32 of the topic is used so that every process, and every run, agrees.
+	"""
+	return (zlib.crc32(topic.encode('utf-8')) & 0xffffffff) % count
+
+
+def run_worker(settings, index, count, mode, group, stats_queue, stop_event, stats_interval=5.0, reload_queue=None):
+	"""Run one relay process until ``stop_event`` is set.
+
+	Args:
+		settings (dict): The relay settings, as read from config.yaml.
+		index (int): This worker's shard number, from ``0`` to ``count - 1``.
+		count (int): Total number of workers.
+		mode (str): ``shared`` or ``hash``, see ``KeenMQTT.setup_sharding``.
+		group (str): Shared subscription group name.
+		stats_queue (multiprocessing.Queue): Receives ``(index, stats)`` tuples.
+		stop_event (multiprocessing.Event): Set by the supervisor to stop the worker.
+		stats_interval (float): Seconds between stats reports.
+		reload_queue Optional[multiprocessing.Queue]: Receives new `collection_mappings`
+			settings, see ``KeenMQTT.reload_collection_mappings``.
+	"""
+	from .keenmqtt import KeenMQTT
+
+	# The supervisor handles Ctrl-C and SIGHUP and tells the workers what to do. SIGTERM, as
+	# sent by ``Process.terminate``, must not be caught by the supervisor's handler.
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, signal.SIG_DFL)
+	if hasattr(signal, 'SIGHUP'):
+		signal.signal(signal.SIGHUP, signal.SIG_IGN)
+	settings = dict(settings)
+	mqtt_settings = dict(settings.get('mqtt', {}))
+	if 'client_id' in mqtt_settings:
+		mqtt_settings['client_id'] = '{}-{}'.format(mqtt_settings['client_id'], index)
+	settings['mqtt'] = mqtt_settings
+	if 'recording' in settings:
+		# Each worker records its share of the traffic in its own directory.
+		recording_settings = dict(settings['recording'])
+		recording_settings['directory'] = os.path.join(recording_settings['directory'], 'worker-{}'.format(index))
+		settings['recording'] = recording_settings
+
+	relay = KeenMQTT()
+	relay.setup_sharding(index, count, mode, group)
+	relay.setup(settings=settings)
+	relay.start()
+	interval = stats_interval if reload_queue is None else min(stats_interval, 1.0)
+	next_stats = time.time() + stats_interval
+	try:
+		while not stop_event.wait(interval):
+			if reload_queue is not None:
+				_reload_worker(relay, index, reload_queue)
+			if time.time() >= next_stats:
+				next_stats += stats_interval
+				stats_queue.put((index, relay.get_stats()))
+	finally:
+		relay.stop()
+		stats_queue.put((index, relay.get_stats()))
+
+
+def _reload_worker(relay, index, reload_queue):
+	while True:
+		try:
+			mappings = reload_queue.get_nowait()
+		except queue.Empty:
+			return
+		try:
+			relay.reload_collection_mappings(mappings)
+		except (KeyError, TypeError, ValueError):
+			logger.exception("Relay worker {} could not reload its collection mappings".format(index))
+
+
+class Supervisor(object):
+	"""Start relay worker processes, restart any that exit, and combine their stats.
+
+	Args:
+		settings (dict): The relay settings, as read from config.yaml.
+		workers (int): Number of relay processes.
+		mode (str): ``shared`` to split messages with shared subscriptions, or ``hash`` to
+			have every worker subscribe to everything and keep only its share of the topics.
+		group (str): Shared subscription group name.
+		restart_delay (float): Minimum seconds between restarts of the same worker.
+	"""
+
+	def __init__(self, settings, workers, mode=SHARED, group='keenmqtt', restart_delay=1.0):
+		if mode not in (SHARED, HASH):
+			raise ValueError("Unknown sharding mode '{}'".format(mode))
+		# Only the supervisor needs multiprocessing, not every relay importing this module.
+		import multiprocessing
+		self.settings = settings
+		self.workers = workers
+		self.mode = mode
+		self.group = group
+		self.restart_delay = restart_delay
+		self.restarts = 0
+		self._stats_queue = multiprocessing.Queue()
+		self._stop_event = multiprocessing.Event()
+		self._reload_queues = [multiprocessing.Queue() for _ in range(workers)]
+		self._processes = [None] * workers
+		self._started = [0.0] * workers
+		self._stats = {}
+		self._retired = None
+		self._terminated = False
+
+	def start(self):
+		"""Start every worker process."""
+		for index in range(self.workers):
+			self._start_worker(index)
+
+	def check(self):
+		"""Collect stats reports and restart any worker which has exited."""
+		self._drain_stats()
+		if self._stop_event.is_set():
+			return
+		now = time.time()
+		for index, process in enumerate(self._processes):
+			if process.is_alive() or now - self._started[index] < self.restart_delay:
+				continue
+			logger.warning("Relay worker {} exited with code {}, restarting".format(index, process.exitcode))
+			self.restarts += 1
+			# Keep the crashed worker's counts, its replacement starts from zero.
+			if index in self._stats:
+				self._retired = merge_stats([s for s in (self._retired, self._stats.pop(index)) if s])
+			self._start_worker(index)
+
+	def reload_collection_mappings(self, mappings):
+		"""Send new collection mappings to every worker, which apply them within a second.
+
+		Workers started later, such as after a crash, use them too.
+
+		Args:
+			mappings (dict): The new `collection_mappings` section of config.yaml.
+		Return:
+			None
+		"""
+		self.settings = dict(self.settings)
+		self.settings['collection_mappings'] = mappings
+		for reload_queue in self._reload_queues:
+			reload_queue.put(mappings)
+
+	def run(self, interval=1.0, wait=time.sleep):
+		"""Supervise the workers until interrupted or sent SIGTERM, then stop them.
+
+		Args:
+			interval (float): Seconds between checks on the workers.
+			wait (callable): Called with ``interval`` between checks, such as
+				``keenmqtt.app.ConfigReloader.wait`` to reload the config file meanwhile.
+		"""
+		self._terminated = False
+		try:
+			previous = signal.signal(signal.SIGTERM, self._terminate)
+		except ValueError:
+			# Signal handlers can only be set from the main thread.
+			previous = None
+		self.start()
+		try:
+			while not self._terminated:
+				wait(interval)
+				if not self._terminated:
+					self.check()
+			logger.info("terminated, shutting down")
+		except KeyboardInterrupt:
+			logger.info("shutting down")
+		finally:
+			self.stop()
+			if previous is not None:
+				signal.signal(signal.SIGTERM, previous)
+
+	def stop(self, timeout=30.0):
+		"""Ask every worker to stop and wait for them to finish uploading.
+
+		Args:
+			timeout (float): Seconds to wait before terminating the workers still running.
+		"""
+		self._stop_event.set()
+		deadline = time.time() + timeout
+		for process in self._processes:
+			if process is None:
+				continue
+			# A worker does not exit until the queue has taken its last stats, so it is
+			# drained while waiting.
+			while process.is_alive() and time.time() < deadline:
+				process.join(0.1)
+				self._drain_stats()
+			if process.is_alive():
+				logger.warning("Worker {} did not stop in time, terminating it".format(process.name))
+				process.terminate()
+				process.join()
+		self._drain_stats()
+
+	def get_stats(self):
+		"""Return the combined stats of every worker, as reported most recently.
+
+		Counts from workers which crashed and were restarted are included.
+		"""
+		self._drain_stats()
+		stats = merge_stats([s for s in [self._retired] + list(self._stats.values()) if s])
+		stats['supervisor'] = {
+			'workers': self.workers,
+			'alive': len([p for p in self._processes if p is not None and p.is_alive()]),
+			'restarts': self.restarts,
+		}
+		return stats
+
+	def _start_worker(self, index):
+		import multiprocessing
+		process = multiprocessing.Process(target=run_worker, name='keenmqtt-worker-{}'.format(index),
+			args=(self.settings, index, self.workers, self.mode, self.group, self._stats_queue, self._stop_event),
+			kwargs={'reload_queue': self._reload_queues[index]})
+		process.daemon = False
+		process.start()
+		self._processes[index] = process
+		self._started[index] = time.time()
+
+	def _terminate(self, signum, frame):
+		# A plain flag, as a signal handler must not take locks.
+		self._terminated = True
+
+	def _drain_stats(self):
+		while True:
+			try:
+				index, stats = self._stats_queue.get_nowait()
+			except queue.Empty:
+				return
+			self._stats[index] = stats
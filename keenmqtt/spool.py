@@ -0,0 +1,292 @@
+""" A local on-disk spool for events which could not be uploaded to Keen IO """
+
+import json
+import logging
+import os
+import re
+import struct
+import threading
+import zlib
+
+logger = logging.getLogger('keenmqtt')
+
+MAGIC = b'KS'
+_HEADER = struct.Struct('>2sII')
+_SUFFIX = '.spool'
+_SEGMENT_NAME = re.compile(r'^\d{12}' + re.escape(_SUFFIX) + '$')
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+
+
+class Spool(object):
+	"""An append-only log of event batches, split into segment files.
+
+	Each record is a ``{collection: [event, ...]}`` batch stored as JSON behind a header of
+	a magic marker, the payload length and a CRC32 of the payload. If a write was torn by a
+	crash, the damaged record fails its checks and reading resumes at the next good record.
+	Segments left behind by a previous run are replayed, and new records always go to a
+	fresh segment.
+
+	Replay is at-least-once: a batch may be uploaded again if the process stops between
+	uploading it and removing its segment.
+
+	Args:
+		directory (str): Directory holding the segment files, created if missing.
+		segment_size (int): Start a new segment once the current one reaches this size.
+		max_bytes (int): Maximum total size of all segments. ``0`` means unlimited.
+		drop_policy (str): What to do when ``max_bytes`` would be exceeded.
+			``drop-oldest`` deletes the oldest segments to make room, ``drop-newest``
+			discards the batch being appended.
+		fsync (bool): Call ``os.fsync`` after every append.
+	"""
+
+	def __init__(self, directory, segment_size=16 * 1024 * 1024, max_bytes=1024 * 1024 * 1024,
+			drop_policy=DROP_OLDEST, fsync=False):
+		if drop_policy not in (DROP_OLDEST, DROP_NEWEST):
+			raise ValueError("Unknown spool drop policy '{}'".format(drop_policy))
+		self.directory = directory
+		self.segment_size = segment_size
+		self.max_bytes = max_bytes
+		self.drop_policy = drop_policy
+		self.fsync = fsync
+		self.dropped_batches = 0
+		self.dropped_segments = 0
+		self.dropped_bytes = 0
+		self._lock = threading.Lock()
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self._segments = []
+		for name in sorted(os.listdir(directory)):
+			if _SEGMENT_NAME.match(name):
+				self._segments.append(name)
+			elif name.endswith(_SUFFIX):
+				logger.warning("Ignoring {} in the spool directory, it is not a spool segment".format(name))
+		self._total_bytes = sum(os.path.getsize(self._path(name)) for name in self._segments)
+		self._next_seq = int(self._segments[-1][:-len(_SUFFIX)]) + 1 if self._segments else 0
+		self._active = None
+		self._active_name = None
+		self._active_size = 0
+
+	@classmethod
+	def from_settings(cls, settings):
+		"""Create a spool from the ``spool`` section of a config file.
+
+		Args:
+			settings (dict): Dictionary with a ``directory`` key and optional ``segment_size``,
+				``max_bytes``, ``drop_policy`` and ``fsync`` keys.
+		Return:
+			Spool: The new spool.
+		"""
+		return cls(settings['directory'],
+			segment_size=int(settings.get('segment_size', 16 * 1024 * 1024)),
+			max_bytes=int(settings.get('max_bytes', 1024 * 1024 * 1024)),
+			drop_policy=settings.get('drop_policy', DROP_OLDEST),
+			fsync=bool(settings.get('fsync', False)))
+
+	def size(self):
+		"""Return the total size in bytes of all segments."""
+		return self._total_bytes
+
+	def append(self, events):
+		"""Write a batch of events to the spool.
+
+		Args:
+			events (dict): A dictionary of collection names to lists of events.
+		Return:
+			bool: ``True`` if the batch was written, ``False`` if it was dropped.
+		"""
+		payload = json.dumps(events).encode('utf-8')
+		frame = _HEADER.pack(MAGIC, len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+		with self._lock:
+			if not self._make_room(len(frame)):
+				self.dropped_batches += 1
+				logger.warning("Spool is full, dropping a batch of events")
+				return False
+			if self._active is None or self._active_size >= self.segment_size:
+				self._rotate()
+			self._active.write(frame)
+			self._active.flush()
+			if self.fsync:
+				os.fsync(self._active.fileno())
+			self._active_size += len(frame)
+			self._total_bytes += len(frame)
+		return True
+
+	def replay(self, upload_callback, max_events=500):
+		"""Upload the spooled events in bulk batches, oldest first.
+
+		Each segment is deleted once all of its records have been uploaded. If
+		``upload_callback`` raises, the exception propagates and the segment being
+		replayed is kept, to be retried in full by the next call.
+
+		Args:
+			upload_callback (callable): Called with ``{collection: [event, ...]}`` batches.
+			max_events (int): Maximum number of events passed to one ``upload_callback`` call.
+		Return:
+			int: The number of events uploaded.
+		"""
+		with self._lock:
+			if self._active is not None:
+				self._close_active()
+			segments = list(self._segments)
+		uploaded = 0
+		for name in segments:
+			batch = {}
+			count = 0
+			for events in self.read_segment(self._path(name)):
+				for collection, collection_events in events.items():
+					batch.setdefault(collection, []).extend(collection_events)
+					count += len(collection_events)
+				if count >= max_events:
+					upload_callback(batch)
+					uploaded += count
+					batch = {}
+					count = 0
+			if count:
+				upload_callback(batch)
+				uploaded += count
+			with self._lock:
+				self._remove(name)
+		return uploaded
+
+	@staticmethod
+	def read_segment(path):
+		"""Yield each intact batch stored in a segment file, skipping damaged records.
+
+		Args:
+			path (str): Path to the segment file.
+		Return:
+			generator: Of ``{collection: [event, ...]}`` dictionaries.
+		"""
+		with open(path, 'rb') as segment:
+			data = segment.read()
+		offset = 0
+		end = len(data)
+		while offset + _HEADER.size <= end:
+			magic, length, crc = _HEADER.unpack_from(data, offset)
+			start = offset + _HEADER.size
+			payload = data[start:start + length]
+			if magic == MAGIC and len(payload) == length and zlib.crc32(payload) & 0xffffffff == crc:
+				try:
+					events = json.loads(payload.decode('utf-8'))
+				except ValueError:
+					events = None
+				if isinstance(events, dict):
+					yield events
+					offset = start + length
+					continue
+			resync = data.find(MAGIC, offset + 1)
+			logger.warning("Skipping damaged spool record in {} at offset {}".format(path, offset))
+			if resync < 0:
+				return
+			offset = resync
+
+	def close(self):
+		"""Close the segment currently being written."""
+		with self._lock:
+			self._close_active()
+
+	def _path(self, name):
+		return os.path.join(self.directory, name)
+
+	def _rotate(self):
+		self._close_active()
+		name = '{:012d}{}'.format(self._next_seq, _SUFFIX)
+		self._next_seq += 1
+		self._active = open(self._path(name), 'ab')
+		self._active_name = name
+		self._active_size = 0
+		self._segments.append(name)
+
+	def _close_active(self):
+		if self._active is None:
+			return
+		self._active.close()
+		self._active = None
+		if not self._active_size:
+			self._remove(self._active_name)
+		self._active_name = None
+
+	def _make_room(self, size):
+		if not self.max_bytes or self._total_bytes + size <= self.max_bytes:
+			return True
+		if self.drop_policy == DROP_NEWEST:
+			return False
+		while self._segments and self._total_bytes + size > self.max_bytes:
+			name = self._segments[0]
+			if name == self._active_name:
+				self._close_active()
+				if name not in self._segments:
+					continue
+			segment_bytes = os.path.getsize(self._path(name))
+			self._remove(name)
+			self.dropped_segments += 1
+			self.dropped_bytes += segment_bytes
+			logger.warning("Spool is full, dropped segment {} of {} bytes".format(name, segment_bytes))
+		return self._total_bytes + size <= self.max_bytes
+
+	def _remove(self, name):
+		if name not in self._segments:
+			return
+		path = self._path(name)
+		self._total_bytes -= os.path.getsize(path)
+		os.remove(path)
+		self._segments.remove(name)
+
+
+class SpoolReplayer(object):
+	"""A background thread which periodically drains a spool.
+
+	Args:
+		spool (Spool): The spool to drain.
+		upload_callback (callable): Performs the upload of each ``{collection: [event, ...]}``
+			batch, raising an exception on failure.
+		interval (float): Seconds between attempts while the spool is empty or uploads fail.
+		max_events (int): Maximum number of events in each upload.
+	"""
+
+	def __init__(self, spool, upload_callback, interval=10.0, max_events=500):
+		self.spool = spool
+		self.upload_callback = upload_callback
+		self.interval = interval
+		self.max_events = max_events
+		self._thread = None
+		self._stopping = threading.Event()
+
+	def start(self):
+		"""Start the replay thread."""
+		if self._thread is not None:
+			return
+		self._stopping.clear()
+		self._thread = threading.Thread(target=self._run, name='keenmqtt-spool')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		"""Stop the replay thread. Anything still spooled stays on disk for the next run."""
+		if self._thread is not None:
+			self._stopping.set()
+			self._thread.join()
+			self._thread = None
+
+	def replay_once(self):
+		"""Try to drain the spool once.
+
+		Return:
+			int: The number of events uploaded.
+		"""
+		if not self.spool.size():
+			return 0
+		try:
+			uploaded = self.spool.replay(self.upload_callback, self.max_events)
+		except Exception:
+			logger.warning("Spool replay failed, will retry in {} seconds".format(self.interval), exc_info=True)
+			return 0
+		if uploaded:
+			logger.info("Replayed {} spooled events".format(uploaded))
+		return uploaded
+
+	def _run(self):
+		while not self._stopping.wait(self.interval):
+			self.replay_once()
@@ -0,0 +1,361 @@
+""" Counters and latency histograms describing the relay pipeline """
+
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+try:
+	clock = time.perf_counter
+except AttributeError:
+	clock = time.time
+
+logger = logging.getLogger('keenmqtt')
+
+# Upper bounds, in seconds, of the histogram buckets: 1us doubling up to about 8s.
+BUCKETS = tuple(1e-6 * 2 ** i for i in range(24))
+
+
+class Histogram(object):
+	"""A fixed bucket latency histogram.
+
+	Recording a value is a bisect and three additions, so it is cheap enough to use on
+	every message. Percentiles are reported as the upper bound of the bucket they fall in.
+	"""
+
+	__slots__ = ('counts', 'count', 'total')
+
+	def __init__(self):
+		self.counts = [0] * (len(BUCKETS) + 1)
+		self.count = 0
+		self.total = 0.0
+
+	def observe(self, seconds):
+		self.counts[bisect_left(BUCKETS, seconds)] += 1
+		self.count += 1
+		self.total += seconds
+
+	def percentile(self, fraction):
+		"""Return the upper bucket bound below which ``fraction`` of the values fall."""
+		if not self.count:
+			return 0.0
+		target = fraction * self.count
+		seen = 0
+		for bound, count in zip(BUCKETS, self.counts):
+			seen += count
+			if seen >= target:
+				return bound
+		return float('inf')
+
+	def snapshot(self):
+		return {
+			'count': self.count,
+			'sum': self.total,
+			'p50': self.percentile(0.5),
+			'p99': self.percentile(0.99),
+			'buckets': list(self.counts),
+		}
+
+
+# Pipeline stages timed by ``Stats.record_event``, in the order they run.
+STAGES = ('collection', 'topic', 'payload', 'time', 'push')
+
+
+class Stats(object):
+	"""Pipeline counters and histograms, overall, per stage and per collection.
+
+	``record_decode`` and ``record_event`` are called for every message, so they take no
+	lock and must only be called from the thread receiving MQTT messages. Upload threads
+	use ``incr``, which is locked and updates a separate set of counter names.
+
+	Counters are exact. Updating a histogram costs about as much as a counter per stage, so
+	the latency histograms only record one in every ``sample_every`` calls.
+
+	Args:
+		sample_every (int): Record latencies for one in this many messages and events.
+	"""
+
+	def __init__(self, sample_every=16):
+		self.sample_every = max(1, int(sample_every))
+		self.started = time.time()
+		self.counters = {}
+		self.stages = dict((stage, Histogram()) for stage in ('decode',) + STAGES)
+		self.collections = {}
+		self._lock = threading.Lock()
+		self._decodes = 0
+		self._events = 0
+
+	def incr(self, name, collection=None, amount=1):
+		"""Add ``amount`` to a counter, and to the collection's counter if one is given."""
+		with self._lock:
+			self._incr(name, collection, amount)
+
+	def record_upload(self, results):
+		"""Record one successful upload request.
+
+		Args:
+			results (dict): Collection name to a tuple of the number of events accepted and
+				the number rejected by Keen IO.
+		"""
+		with self._lock:
+			self._incr('uploads', None, 1)
+			for collection, (uploaded, rejected) in results.items():
+				self._incr('events_uploaded', collection, uploaded)
+				if rejected:
+					self._incr('events_rejected', collection, rejected)
+
+	def record_upload_error(self, events):
+		"""Record one failed upload request of a ``{collection: [event, ...]}`` batch."""
+		with self._lock:
+			self._incr('upload_errors', None, 1)
+			for collection, batch in events.items():
+				self._incr('events_failed', collection, len(batch))
+
+	def record_decode(self, seconds, records=None):
+		"""Record one call to ``decode_payload``.
+
+		Args:
+			seconds (float): Time taken.
+			records Optional[int]: Number of records decoded, or ``None`` if decoding failed.
+		"""
+		counters = self.counters
+		counters['messages_received'] = counters.get('messages_received', 0) + 1
+		if records is None:
+			counters['decode_failed'] = counters.get('decode_failed', 0) + 1
+		else:
+			counters['messages_decoded'] = counters.get('messages_decoded', 0) + 1
+			counters['records_decoded'] = counters.get('records_decoded', 0) + records
+		self._decodes += 1
+		if not self._decodes % self.sample_every:
+			self.stages['decode'].observe(seconds)
+
+	def record_event(self, collection, outcome, *times):
+		"""Record one decoded record's trip through the rest of the pipeline.
+
+		Args:
+			collection Optional[str]: The collection assigned to the record, if any.
+			outcome (str): The counter to increment, such as ``events_pushed`` or the name of
+				the stage which dropped the record.
+			times (float): Clock readings taken before the first stage and after each stage
+				which ran, so consecutive differences are the durations of ``STAGES``.
+		"""
+		self._incr(outcome, collection, 1)
+		self._events += 1
+		if self._events % self.sample_every:
+			return
+		stages = self.stages
+		for i in range(len(times) - 1):
+			# Histogram.observe, inlined as this runs up to five times per record.
+			seconds = times[i + 1] - times[i]
+			histogram = stages[STAGES[i]]
+			histogram.counts[bisect_left(BUCKETS, seconds)] += 1
+			histogram.count += 1
+			histogram.total += seconds
+		if collection is not None and outcome == 'events_pushed':
+			self._collection(collection)['latency'].observe(times[-1] - times[0])
+
+	def snapshot(self):
+		"""Return a copy of every counter and histogram as plain dictionaries.
+
+		Return:
+			dict: With ``enabled``, ``uptime``, ``counters``, ``stages`` and ``collections`` keys.
+		"""
+		with self._lock:
+			return {
+				'enabled': True,
+				'uptime': time.time() - self.started,
+				'counters': dict(self.counters),
+				'stages': dict((stage, histogram.snapshot()) for stage, histogram in self.stages.items() if histogram.count),
+				'collections': dict((collection, {
+					'counters': dict(entry['counters']),
+					'latency': entry['latency'].snapshot(),
+				}) for collection, entry in list(self.collections.items())),
+			}
+
+	def _incr(self, name, collection, amount):
+		counters = self.counters
+		counters[name] = counters.get(name, 0) + amount
+		if collection is not None:
+			counters = self._collection(collection)['counters']
+			counters[name] = counters.get(name, 0) + amount
+
+	def _collection(self, collection):
+		entry = self.collections.get(collection)
+		if entry is None:
+			entry = self.collections.setdefault(collection, {'counters': {}, 'latency': Histogram()})
+		return entry
+
+
+def _merge_histograms(histograms):
+	merged = Histogram()
+	for histogram in histograms:
+		merged.count += histogram['count']
+		merged.total += histogram['sum']
+		merged.counts = [a + b for a, b in zip(merged.counts, histogram['buckets'])]
+	return merged.snapshot()
+
+
+def _merge_counters(dicts):
+	merged = {}
+	for counters in dicts:
+		for name, value in counters.items():
+			merged[name] = merged.get(name, 0) + value
+	return merged
+
+
+def merge_stats(snapshots):
+	"""Combine the stats of several relays, such as the worker processes of one supervisor.
+
+	Counters and other numbers are added up, histograms are merged bucket by bucket and the
+	uptime is the longest of any relay.
+
+	Args:
+		snapshots (list): Dictionaries returned by ``KeenMQTT.get_stats``.
+	Return:
+		dict: A dictionary in the same form.
+	"""
+	merged = {
+		'enabled': any(snapshot.get('enabled') for snapshot in snapshots),
+		'uptime': max([snapshot.get('uptime', 0) for snapshot in snapshots] or [0]),
+		'counters': _merge_counters([snapshot.get('counters', {}) for snapshot in snapshots]),
+		'stages': {},
+		'collections': {},
+	}
+	for stage in set(stage for snapshot in snapshots for stage in snapshot.get('stages', {})):
+		merged['stages'][stage] = _merge_histograms([snapshot['stages'][stage]
+			for snapshot in snapshots if stage in snapshot.get('stages', {})])
+	for collection in set(c for snapshot in snapshots for c in snapshot.get('collections', {})):
+		entries = [snapshot['collections'][collection] for snapshot in snapshots
+			if collection in snapshot.get('collections', {})]
+		merged['collections'][collection] = {
+			'counters': _merge_counters([entry['counters'] for entry in entries]),
+			'latency': _merge_histograms([entry['latency'] for entry in entries]),
+		}
+	for snapshot in snapshots:
+		for section, values in snapshot.items():
+			if section in ('counters', 'stages', 'collections') or not isinstance(values, dict):
+				continue
+			target = merged.setdefault(section, {})
+			for name, value in values.items():
+				if isinstance(value, (int, float)) and not isinstance(value, bool):
+					target[name] = target.get(name, 0) + value
+	return merged
+
+
+def _escape(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _histogram_lines(name, labels, histogram):
+	lines = []
+	cumulative = 0
+	for bound, count in zip(BUCKETS + (float('inf'),), histogram['buckets']):
+		cumulative += count
+		le = '+Inf' if bound == float('inf') else repr(bound)
+		lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, le, cumulative))
+	lines.append('{}_sum{{{}}} {}'.format(name, labels.rstrip(','), histogram['sum']))
+	lines.append('{}_count{{{}}} {}'.format(name, labels.rstrip(','), histogram['count']))
+	return lines
+
+
+def format_prometheus(stats, prefix='keenmqtt'):
+	"""Format the dictionary returned by ``KeenMQTT.get_stats`` in the Prometheus text format.
+
+	Counters become ``<prefix>_<name>_total``, and their per collection counts
+	``<prefix>_collection_<name>_total`` with a ``collection`` label. Stage and collection
+	latencies become histograms, and any other numeric values are exported as gauges named
+	after their position in the dictionary.
+
+	Args:
+		stats (dict): The stats dictionary.
+		prefix (str): Prefix for every metric name.
+	Return:
+		str: The metrics text.
+	"""
+	lines = []
+	for name, value in sorted(stats.get('counters', {}).items()):
+		lines.append('# TYPE {}_{}_total counter'.format(prefix, name))
+		lines.append('{}_{}_total {}'.format(prefix, name, value))
+	collection_counters = {}
+	for collection, entry in sorted(stats.get('collections', {}).items()):
+		for name, value in entry['counters'].items():
+			collection_counters.setdefault(name, []).append((collection, value))
+	for name, values in sorted(collection_counters.items()):
+		lines.append('# TYPE {}_collection_{}_total counter'.format(prefix, name))
+		for collection, value in values:
+			lines.append('{}_collection_{}_total{{collection="{}"}} {}'.format(prefix, name, _escape(collection), value))
+	if stats.get('stages'):
+		lines.append('# TYPE {}_stage_seconds histogram'.format(prefix))
+		for stage, histogram in sorted(stats['stages'].items()):
+			lines.extend(_histogram_lines(prefix + '_stage_seconds', 'stage="{}",'.format(_escape(stage)), histogram))
+	if stats.get('collections'):
+		lines.append('# TYPE {}_collection_seconds histogram'.format(prefix))
+		for collection, entry in sorted(stats['collections'].items()):
+			lines.extend(_histogram_lines(prefix + '_collection_seconds',
+				'collection="{}",'.format(_escape(collection)), entry['latency']))
+	for section, values in sorted(stats.items()):
+		if section in ('counters', 'stages', 'collections') or not isinstance(values, dict):
+			continue
+		for name, value in sorted(values.items()):
+			if isinstance(value, (int, float)) and not isinstance(value, bool):
+				lines.append('{}_{}_{} {}'.format(prefix, section, name, value))
+	if 'uptime' in stats:
+		lines.append('{}_uptime_seconds {}'.format(prefix, stats['uptime']))
+	return '\n'.join(lines) + '\n'
+
+
+class StatsServer(object):
+	"""A small HTTP server exposing stats at ``/metrics`` (Prometheus) and ``/stats`` (JSON).
+
+	Args:
+		get_stats (callable): Returns the stats dictionary, such as ``KeenMQTT.get_stats``.
+		host (str): Address to listen on.
+		port (int): Port to listen on, ``0`` picks a free port.
+	"""
+
+	def __init__(self, get_stats, host='127.0.0.1', port=9100):
+		# Imported here as most relays never serve stats, and it brings in much of http and ssl.
+		try:
+			from http.server import BaseHTTPRequestHandler, HTTPServer
+		except ImportError:
+			from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+		get = get_stats
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				path = self.path.split('?')[0]
+				if path == '/metrics':
+					body = format_prometheus(get()).encode('utf-8')
+					content_type = 'text/plain; version=0.0.4'
+				elif path == '/stats':
+					body = json.dumps(get(), sort_keys=True).encode('utf-8')
+					content_type = 'application/json'
+				else:
+					self.send_error(404)
+					return
+				self.send_response(200)
+				self.send_header('Content-Type', content_type)
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				logger.debug("stats http: " + format % args)
+
+		self.server = HTTPServer((host, port), Handler)
+		self.host, self.port = self.server.server_address[:2]
+		self._thread = None
+
+	def start(self):
+		self._thread = threading.Thread(target=self.server.serve_forever, name='keenmqtt-stats')
+		self._thread.daemon = True
+		self._thread.start()
+		logger.info("Serving stats on http://{}:{}/metrics".format(self.host, self.port))
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
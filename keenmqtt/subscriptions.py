@@ -0,0 +1,262 @@
+""" Subscribing to the collection mappings' filters in as few SUBSCRIBE packets as possible.
+
+The `subscriptions` section of the config file sets how::
+
+    subscriptions:
+        qos: 0
+        max_packet_size: 65536
+        max_filters: 0
+        consolidate: true
+
+A filter which another filter with at least its QoS already covers, such as ``home/a/+``
+alongside ``home/#``, is not subscribed to: the broker delivers its messages through the
+broader filter, and the relay's matching still picks the mapping for each topic. The rest
+are sent in multi-topic SUBSCRIBE packets of at most ``max_packet_size`` bytes and, where a
+broker limits it, ``max_filters`` filters. ``qos`` is the default for mappings without
+their own `qos` key. The time from sending each packet to its SUBACK is reported in the
+stats.
+"""
+
+import logging
+import threading
+
+from .matching import TopicTrie
+from .stats import clock
+
+logger = logging.getLogger('keenmqtt')
+
+# The granted QoS of a filter the broker refused. MQTT 5 reason codes from here up are
+# failures too.
+SUBSCRIBE_FAILURE = 0x80
+
+# A fixed header of at most 5 bytes, and the packet identifier.
+_PACKET_OVERHEAD = 5 + 2
+
+
+def check_qos(qos):
+	"""Return a QoS level as an int.
+
+	Raises:
+		ValueError: When it is not 0, 1 or 2.
+	"""
+	qos = int(qos)
+	if qos not in (0, 1, 2):
+		raise ValueError("A subscription QoS must be 0, 1 or 2, not {}".format(qos))
+	return qos
+
+
+def consolidate(subscriptions):
+	"""Drop the filters which another filter with at least the same QoS covers.
+
+	Args:
+		subscriptions (list): ``(filter, qos)`` tuples, each filter appearing once.
+	Return:
+		tuple: The ``(filter, qos)`` tuples to subscribe to, in the order given, and the list
+		of filters skipped.
+	"""
+	trie = TopicTrie()
+	for sub, qos in subscriptions:
+		trie.add(sub, (sub, qos))
+	kept = []
+	skipped = []
+	for sub, qos in subscriptions:
+		if any(other_qos >= qos for _, other_qos in trie.covering(sub)):
+			skipped.append(sub)
+		else:
+			kept.append((sub, qos))
+	return kept, skipped
+
+
+def group_packets(filters, max_packet_size=65536, max_filters=0, per_filter=3):
+	"""Split filters into the packets to send them in, keeping their order.
+
+	Args:
+		filters (list): Filters, or ``(filter, qos)`` tuples.
+		max_packet_size (int): The most bytes in a packet, ``0`` for no limit. A filter too
+			long to share a packet gets one of its own.
+		max_filters (int): The most filters in a packet, ``0`` for no limit.
+		per_filter (int): Bytes added to each filter's UTF-8 length: the length prefix, and
+			the QoS byte in SUBSCRIBE packets.
+	Return:
+		list: Of lists of filters.
+	"""
+	packets = []
+	current = []
+	size = _PACKET_OVERHEAD
+	for entry in filters:
+		sub = entry[0] if isinstance(entry, tuple) else entry
+		length = len(sub.encode('utf-8')) + per_filter
+		if current and ((max_packet_size and size + length > max_packet_size) or
+				(max_filters and len(current) >= max_filters)):
+			packets.append(current)
+			current = []
+			size = _PACKET_OVERHEAD
+		current.append(entry)
+		size += length
+	if current:
+		packets.append(current)
+	return packets
+
+
+class Subscriber(object):
+	"""Keep an MQTT client subscribed to a set of filters, with few packets.
+
+	Safe to share between the thread running the client's loop and the thread applying new
+	collection mappings. No lock is held while calling the client.
+
+	Args:
+		qos (int): The QoS for mappings without their own.
+		max_packet_size (int): The most bytes in a SUBSCRIBE or UNSUBSCRIBE packet, ``0``
+			for no limit.
+		max_filters (int): The most filters in a packet, ``0`` for no limit.
+		consolidate (bool): Skip filters covered by another filter, see ``consolidate``.
+	"""
+
+	def __init__(self, qos=0, max_packet_size=65536, max_filters=0, consolidate=True):
+		self.qos = check_qos(qos)
+		self.max_packet_size = max_packet_size
+		self.max_filters = max_filters
+		self.consolidate = consolidate
+		self.subscribed = {}
+		self.skipped = 0
+		self.subscribe_packets = 0
+		self.unsubscribe_packets = 0
+		self.acks = 0
+		self.failures = 0
+		self.round_trip_last = 0.0
+		self.round_trip_max = 0.0
+		self.round_trip_sum = 0.0
+		self._pending = {}
+		self._early = {}
+		self._lock = threading.Lock()
+
+	@classmethod
+	def from_settings(cls, settings):
+		"""Create a subscriber from the `subscriptions` section of a config file.
+
+		Args:
+			settings Optional[dict]: Dictionary with optional ``qos``, ``max_packet_size``,
+				``max_filters`` and ``consolidate`` keys.
+		Return:
+			Subscriber: The new subscriber.
+		"""
+		settings = settings or {}
+		return cls(qos=settings.get('qos', 0),
+			max_packet_size=int(settings.get('max_packet_size', 65536)),
+			max_filters=int(settings.get('max_filters', 0)),
+			consolidate=bool(settings.get('consolidate', True)))
+
+	def subscribe_all(self, client, subscriptions):
+		"""Subscribe to every filter, such as after connecting.
+
+		Args:
+			client (paho.mqtt.client.Client): The MQTT client.
+			subscriptions (list): ``(filter, qos)`` tuples.
+		Return:
+			None
+		"""
+		with self._lock:
+			kept = self._plan(subscriptions)
+			self.subscribed = dict(kept)
+			# SUBACKs for packets sent on an earlier connection will never arrive.
+			self._pending.clear()
+			self._early.clear()
+		self._subscribe(client, kept)
+
+	def update(self, client, subscriptions):
+		"""Subscribe to the filters which are new or whose QoS changed, then unsubscribe from
+		those no longer wanted.
+
+		Args:
+			client (paho.mqtt.client.Client): The MQTT client.
+			subscriptions (list): ``(filter, qos)`` tuples.
+		Return:
+			None
+		"""
+		with self._lock:
+			kept = self._plan(subscriptions)
+			wanted = dict(kept)
+			added = [(sub, qos) for sub, qos in kept if self.subscribed.get(sub) != qos]
+			removed = [sub for sub in self.subscribed if sub not in wanted]
+			self.subscribed = wanted
+		# Subscribing first means no message is missed when a broader filter replaces the
+		# ones it covers.
+		self._subscribe(client, added)
+		for packet in group_packets(removed, self.max_packet_size, self.max_filters, 2):
+			client.unsubscribe(packet)
+			with self._lock:
+				self.unsubscribe_packets += 1
+
+	def on_subscribe(self, mid, granted_qos):
+		"""Record the round trip of a SUBSCRIBE packet when its SUBACK arrives.
+
+		Args:
+			mid (int): The packet's message id.
+			granted_qos (list): The QoS granted for each filter, or a reason code of ``0x80`` or
+				more if refused.
+		Return:
+			None
+		"""
+		received = clock()
+		with self._lock:
+			pending = self._pending.pop(mid, None)
+			if pending is None:
+				# The SUBACK can beat ``subscribe`` returning the packet's id. Only a few are
+				# kept, so SUBACKs for packets sent by others do not pile up.
+				if len(self._early) < 64:
+					self._early[mid] = (received, granted_qos)
+				return
+		self._acknowledged(pending, received, granted_qos)
+
+	def stats(self):
+		"""Return the filters subscribed and skipped, packets sent, SUBACKs received and
+		awaited, filters refused, and the last, longest and total SUBACK round trip in seconds."""
+		with self._lock:
+			return {
+				'filters': len(self.subscribed),
+				'skipped': self.skipped,
+				'subscribe_packets': self.subscribe_packets,
+				'unsubscribe_packets': self.unsubscribe_packets,
+				'acks': self.acks,
+				'pending': len(self._pending),
+				'failures': self.failures,
+				'round_trip_last': self.round_trip_last,
+				'round_trip_max': self.round_trip_max,
+				'round_trip_sum': self.round_trip_sum,
+			}
+
+	def _plan(self, subscriptions):
+		if not self.consolidate:
+			self.skipped = 0
+			return list(subscriptions)
+		kept, skipped = consolidate(subscriptions)
+		self.skipped = len(skipped)
+		return kept
+
+	def _subscribe(self, client, subscriptions):
+		for packet in group_packets(subscriptions, self.max_packet_size, self.max_filters):
+			sent = clock()
+			_, mid = client.subscribe(packet)
+			with self._lock:
+				self.subscribe_packets += 1
+				if mid is None:
+					continue
+				early = self._early.pop(mid, None)
+				if early is None:
+					self._pending[mid] = (sent, packet)
+					continue
+			self._acknowledged((sent, packet), *early)
+
+	def _acknowledged(self, pending, received, granted_qos):
+		sent, filters = pending
+		seconds = received - sent
+		refused = [sub for (sub, _), granted in zip(filters, granted_qos)
+			if getattr(granted, 'value', granted) >= SUBSCRIBE_FAILURE]
+		with self._lock:
+			self.acks += 1
+			self.round_trip_last = seconds
+			self.round_trip_sum += seconds
+			self.round_trip_max = max(self.round_trip_max, seconds)
+			self.failures += len(refused)
+		if refused:
+			logger.warning("The broker refused the subscriptions {}".format(', '.join(refused)))
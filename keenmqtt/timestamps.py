@@ -0,0 +1,94 @@
+""" Cheap UTC ISO-8601 timestamps for events """
+
+import calendar
+import re
+import time
+
+RECEIVE = 'receive'
+PROCESS = 'process'
+
+# The fraction of a second and UTC offset following the seconds of an ISO-8601 time.
+_FRACTION_AND_OFFSET = re.compile(r'(\.\d+)?(?:Z|([+-])(\d\d):?(\d\d))?$')
+
+
+class Timestamper(object):
+	"""Format Unix times as UTC ISO-8601 strings, such as ``2016-01-01T12:00:00.123456+00:00``.
+
+	The date and time up to the second is formatted once per second and reused, so most
+	calls only convert the time to a string of microseconds and append its last six
+	digits. Safe to share between threads.
+
+	Args:
+		source (str): ``process`` to timestamp events when ``process_time`` runs, or
+			``receive`` to use the time each MQTT message was received, shared by every
+			event decoded from that message.
+	"""
+
+	def __init__(self, source=PROCESS):
+		if source not in (PROCESS, RECEIVE):
+			raise ValueError("Unknown timestamp source '{}'".format(source))
+		self.source = source
+		self._second = (None, None)
+		self._parsed = (None, None)
+
+	@classmethod
+	def from_settings(cls, settings):
+		"""Create a timestamper from the `timestamps` section of a config file.
+
+		Args:
+			settings Optional[dict]: Dictionary with an optional ``source`` key.
+		Return:
+			Timestamper: The timestamper.
+		"""
+		return cls((settings or {}).get('source', PROCESS))
+
+	def format(self, seconds):
+		"""Return the ISO-8601 string for a Unix time.
+
+		Args:
+			seconds (float): Seconds since the epoch, as returned by ``time.time()``.
+		Return:
+			str: The UTC time with microseconds and an explicit offset.
+		"""
+		digits = str(int(seconds * 1000000 + 0.5))
+		if seconds < 1:
+			digits = digits.zfill(7)
+		second, prefix = self._second
+		if digits[:-6] != second:
+			second = digits[:-6]
+			prefix = time.strftime('%Y-%m-%dT%H:%M:%S.', time.gmtime(int(second)))
+			self._second = (second, prefix)
+		return prefix + digits[-6:] + '+00:00'
+
+	def parse(self, timestamp):
+		"""Return the Unix time of an ISO-8601 string, such as one returned by ``format``.
+
+		As with ``format``, the date and time up to the second is converted once per second.
+
+		Args:
+			timestamp (str): A time such as ``2016-01-01T12:00:00.123456+00:00``, with an
+				optional fraction of a second and an optional ``Z`` or numeric UTC offset.
+		Return:
+			float: Seconds since the epoch.
+		Raises:
+			ValueError: When the string is not an ISO-8601 time.
+		"""
+		second, seconds = self._parsed
+		if timestamp[:19] != second:
+			second = timestamp[:19]
+			seconds = calendar.timegm(time.strptime(second, '%Y-%m-%dT%H:%M:%S'))
+			self._parsed = (second, seconds)
+		match = _FRACTION_AND_OFFSET.match(timestamp, 19)
+		if match is None:
+			raise ValueError("Not an ISO-8601 time: '{}'".format(timestamp))
+		fraction, sign, hours, minutes = match.groups()
+		if fraction:
+			seconds += float(fraction)
+		if sign:
+			offset = int(hours) * 3600 + int(minutes) * 60
+			seconds += -offset if sign == '+' else offset
+		return seconds
+
+	def now(self):
+		"""Return the ISO-8601 string for the current time."""
+		return self.format(time.time())
@@ -0,0 +1,134 @@
+""" Per-mapping payload transforms, compiled once from the config file.
+
+A collection mapping may be a dictionary instead of a collection name::
+
+    collection_mappings:
+        home/+/temperature:
+            collection: temperature
+            rename: {val: value}
+            coerce: {value: float}
+            drop_if: {value: {lt: -50}, status: offline}
+            include: [value, unit]
+            exclude: [debug]
+            topic_fields: {1: room}
+
+The rules are applied in that order: fields are renamed, converted, checked against the
+``drop_if`` conditions, filtered, and finally topic segments are added. ``compile_transform``
+turns them into a single generated function, so a message costs one call no matter how many
+rules there are.
+"""
+
+import logging
+
+logger = logging.getLogger('keenmqtt')
+
+
+def to_bool(value):
+	"""Convert ``true``/``false``, ``yes``/``no``, ``on``/``off`` and ``1``/``0`` to a boolean."""
+	if isinstance(value, bool):
+		return value
+	text = str(value).strip().lower()
+	if text in ('true', 'yes', 'on', '1'):
+		return True
+	if text in ('false', 'no', 'off', '0'):
+		return False
+	raise ValueError("Cannot convert {!r} to a boolean".format(value))
+
+
+COERCIONS = {
+	'int': int,
+	'float': float,
+	'str': str,
+	'bool': to_bool,
+}
+
+OPERATORS = {
+	'eq': '==',
+	'ne': '!=',
+	'lt': '<',
+	'le': '<=',
+	'gt': '>',
+	'ge': '>=',
+	'in': 'in',
+	'not_in': 'not in',
+}
+
+RULES = ('rename', 'coerce', 'drop_if', 'include', 'exclude', 'topic_fields')
+
+
+def compile_transform(rules):
+	"""Compile the transform rules of a collection mapping into a function.
+
+	Args:
+		rules (dict): A collection mapping from config.yaml. Keys other than those in
+			``RULES``, such as ``collection``, are ignored.
+	Return:
+		callable: Called with ``(topic, message)``, returning the transformed message or
+		``None`` if it should be dropped, as messages which are not dictionaries are. The
+		message is changed in place. ``None`` is returned instead of a function when there
+		are no rules.
+	Raises:
+		ValueError: When a rule is malformed.
+	"""
+	namespace = {}
+
+	def constant(value):
+		name = '_c{}'.format(len(namespace))
+		namespace[name] = value
+		return name
+
+	body = []
+	checks = []
+	for old, new in (rules.get('rename') or {}).items():
+		body.append('if {old} in message: message[{new}] = message.pop({old})'.format(
+			old=constant(old), new=constant(new)))
+
+	for field, kind in (rules.get('coerce') or {}).items():
+		if kind not in COERCIONS:
+			raise ValueError("Unknown coercion '{}' for field '{}'".format(kind, field))
+		checks.append('if {field} in message: message[{field}] = {convert}(message[{field}])'.format(
+			field=constant(field), convert=constant(COERCIONS[kind])))
+
+	for field, condition in (rules.get('drop_if') or {}).items():
+		if not isinstance(condition, dict):
+			condition = {'eq': condition}
+		for op, value in condition.items():
+			if op == 'exists':
+				checks.append('if ({field} in message) == {value}: return None'.format(
+					field=constant(field), value=bool(value)))
+			elif op in OPERATORS:
+				checks.append('if {field} in message and message[{field}] {op} {value}: return None'.format(
+					field=constant(field), op=OPERATORS[op], value=constant(value)))
+			else:
+				raise ValueError("Unknown drop_if condition '{}' for field '{}'".format(op, field))
+	if checks:
+		# Values which cannot be converted or compared are malformed, drop the message.
+		body.append('try:')
+		body.extend('    ' + check for check in checks)
+		body.append('except (TypeError, ValueError):')
+		body.append('    return None')
+
+	if rules.get('include') is not None:
+		body.append('message = dict((field, message[field]) for field in {fields} if field in message)'.format(
+			fields=constant(tuple(rules['include']))))
+	for field in rules.get('exclude') or ():
+		body.append('message.pop({field}, None)'.format(field=constant(field)))
+
+	topic_fields = rules.get('topic_fields') or {}
+	if topic_fields:
+		body.append('parts = topic.split("/")')
+		for index, field in topic_fields.items():
+			index = int(index)
+			body.append('if len(parts) {check} {bound}: message[{field}] = parts[{index}]'.format(
+				check='>' if index >= 0 else '>=', bound=abs(index), field=constant(field), index=index))
+
+	if not body:
+		return None
+	# Payloads such as MessagePack and CBOR can decode to numbers or strings, which have no
+	# fields to transform.
+	body.insert(0, 'if type(message) is not dict: return None')
+	source = 'def transform(topic, message):\n' + ''.join('    {}\n'.format(line) for line in body) + '    return message\n'
+	exec(compile(source, '<keenmqtt transform>', 'exec'), namespace)
+	transform = namespace['transform']
+	transform.source = source
+	return transform
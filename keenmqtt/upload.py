@@ -0,0 +1,132 @@
+""" Background threads which perform Keen IO uploads off the MQTT network thread """
+
+import logging
+import threading
+
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+logger = logging.getLogger('keenmqtt')
+
+_STOP = object()
+
+
+class UploadWorkerPool(object):
+	"""A bounded queue of pending uploads served by a pool of worker threads.
+
+	Each queued item is a ``{collection: [event, ...]}`` dictionary which a worker passes to
+	``upload_callback``. Exceptions raised by the callback are logged and counted, and the
+	worker carries on.
+
+	Args:
+		upload_callback (callable): Called from a worker thread with each queued batch.
+		workers (int): Number of worker threads.
+		queue_size (int): Maximum number of batches waiting to be uploaded.
+	"""
+
+	def __init__(self, upload_callback, workers=2, queue_size=1000):
+		self.upload_callback = upload_callback
+		self.workers = max(1, workers)
+		self.queue_size = queue_size
+		self._queue = queue.Queue(maxsize=queue_size)
+		self._threads = []
+		self._failures = 0
+		self._lock = threading.Lock()
+
+	@classmethod
+	def from_settings(cls, upload_callback, settings):
+		"""Create a worker pool from the ``upload_workers`` section of a config file.
+
+		Args:
+			upload_callback (callable): See the class documentation.
+			settings (dict): Dictionary with optional ``workers`` and ``queue_size`` keys.
+		Return:
+			UploadWorkerPool: The new, not yet started, pool.
+		"""
+		settings = settings or {}
+		return cls(upload_callback,
+			workers=int(settings.get('workers', 2)),
+			queue_size=int(settings.get('queue_size', 1000)))
+
+	def start(self):
+		"""Start the worker threads."""
+		if self._threads:
+			return
+		for i in range(self.workers):
+			thread = threading.Thread(target=self._run, name='keenmqtt-upload-{}'.format(i))
+			thread.daemon = True
+			thread.start()
+			self._threads.append(thread)
+
+	def submit(self, events, block=True, timeout=None):
+		"""Queue a batch of events for upload.
+
+		Args:
+			events (dict): A dictionary of collection names to lists of events.
+			block (bool): Wait for space in the queue if it is full.
+			timeout Optional[float]: Maximum time to wait for space when blocking.
+		Return:
+			bool: ``True`` if the batch was queued, ``False`` if the queue was full.
+		"""
+		try:
+			self._queue.put(events, block, timeout)
+		except queue.Full:
+			return False
+		return True
+
+	def take_oldest(self):
+		"""Remove the batch which has waited longest for a worker, without blocking.
+
+		Return:
+			dict: The batch, or ``None`` if no batch is waiting.
+		"""
+		try:
+			events = self._queue.get_nowait()
+		except queue.Empty:
+			return None
+		self._queue.task_done()
+		if events is _STOP:
+			# The pool is stopping, leave the marker for a worker.
+			self._queue.put(_STOP)
+			return None
+		return events
+
+	def qsize(self):
+		"""Return the approximate number of batches waiting to be uploaded."""
+		return self._queue.qsize()
+
+	def join(self):
+		"""Wait until every batch queued so far has been uploaded, or has failed to."""
+		self._queue.join()
+
+	def take_failures(self):
+		"""Return the number of batches which failed to upload since the last call."""
+		with self._lock:
+			failures = self._failures
+			self._failures = 0
+		return failures
+
+	def stop(self):
+		"""Upload everything still queued, then stop the worker threads."""
+		for _ in self._threads:
+			self._queue.put(_STOP)
+		for thread in self._threads:
+			thread.join()
+		self._threads = []
+
+	def _run(self):
+		while True:
+			events = self._queue.get()
+			if events is _STOP:
+				self._queue.task_done()
+				return
+			try:
+				self.upload_callback(events)
+			except Exception:
+				logger.exception("Failed to upload events")
+				with self._lock:
+					self._failures += 1
+			finally:
+				self._queue.task_done()
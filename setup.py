@@ -66,6 +66,10 @@ setup(
         ],
     extras_require={
         'testing': ['pytest', 'pytest-mock', 'iso8601'],
+        'fast': ['orjson'],
+        'rollups': ['numpy'],
+        'msgpack': ['msgpack'],
+        'cbor': ['cbor2'],
     },
     entry_points={
         'console_scripts': [
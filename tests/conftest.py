@@ -0,0 +1,4 @@
+import sys
+
+# The asyncio relay uses Python 3.5 syntax.
+collect_ignore = ['test_aio.py'] if sys.version_info < (3, 5) else []
@@ -0,0 +1,159 @@
+import asyncio
+import json
+import time
+import pytest
+from keenmqtt import BackgroundRunningException, UploadError
+from keenmqtt.aio import AsyncKeenMQTT, AsyncKeenUploader
+from benchmarks.broker import Broker
+from benchmarks.keen_server import FakeKeenServer
+
+def run(coroutine):
+	loop = asyncio.new_event_loop()
+	try:
+		return loop.run_until_complete(coroutine)
+	finally:
+		loop.close()
+
+async def wait_for(condition, timeout=5.0):
+	deadline = time.time() + timeout
+	while not condition():
+		assert time.time() < deadline
+		await asyncio.sleep(0.01)
+
+def subscribed(broker):
+	return any(client.subscriptions for client in list(broker._clients))
+
+@pytest.fixture
+def server():
+	server = FakeKeenServer(latency=0.05, write_key='secret').start()
+	yield server
+	server.stop()
+
+class TestAsyncKeenUploader:
+	"""Test the non-blocking Keen IO uploader"""
+
+	def test_concurrent_uploads_reuse_connections(self, server):
+		uploader = AsyncKeenUploader('project', 'secret', base_url=server.base_url, max_idle=10)
+
+		async def upload():
+			results = await asyncio.gather(*[uploader.add_events({'c': [{'v': i}]}) for i in range(10)])
+			await asyncio.gather(*[uploader.add_events({'c': [{'v': i}]}) for i in range(10)])
+			uploader.close()
+			return results
+
+		start = time.time()
+		results = run(upload())
+		# Twenty requests of 50ms each, ten at a time.
+		assert time.time() - start < 0.5
+		assert results[0] == {'c': [{'success': True}]}
+		assert server.event_count() == 20
+		assert uploader.requests == 20
+		assert uploader.connections_opened == 10
+		assert server.connections == 10
+
+	def test_error_status(self, server):
+		uploader = AsyncKeenUploader('project', 'wrong', base_url=server.base_url)
+
+		async def upload():
+			try:
+				await uploader.add_events({'c': [{'v': 1}]})
+			finally:
+				uploader.close()
+
+		with pytest.raises(UploadError) as error:
+			run(upload())
+		assert error.value.status == 401
+
+class TestAsyncKeenMQTT:
+	"""Test the asyncio relay against a local broker and Keen IO stand-in"""
+
+	def settings(self, broker, server, **extra):
+		settings = {
+			'mqtt': {'host': broker.host, 'port': broker.port},
+			'keen': {'project_id': 'project', 'write_key': 'secret', 'base_url': server.base_url},
+			'collection_mappings': {'home/+': 'home'},
+			'async': {'max_in_flight': 16},
+		}
+		settings.update(extra)
+		return settings
+
+	@pytest.fixture
+	def broker(self):
+		broker = Broker()
+		broker.start()
+		yield broker
+		broker.stop()
+
+	def test_relay(self, broker, server):
+		class Relay(AsyncKeenMQTT):
+			def process_topic(self, event, topic):
+				event['room'] = topic.split('/')[1]
+				return True
+
+		relay = Relay()
+		relay.setup(settings=self.settings(broker, server))
+
+		async def main():
+			await relay.start()
+			await wait_for(lambda: subscribed(broker))
+			for i in range(40):
+				broker.publish('home/room{}'.format(i % 4), json.dumps({'v': i}).encode('utf-8'))
+			await wait_for(lambda: relay.stats.counters.get('events_pushed') == 40)
+			in_flight = len(relay._uploads)
+			await relay.stop()
+			return in_flight
+
+		start = time.time()
+		in_flight = run(main())
+		assert in_flight > 1
+		assert time.time() - start < 2.0
+		assert server.event_count() == 40
+		assert sorted(event['v'] for event in server.events['home']) == list(range(40))
+		assert server.events['home'][0]['room'].startswith('room')
+		assert relay.get_stats()['counters']['events_uploaded'] == 40
+
+	def test_failed_uploads_are_spooled(self, broker, server, tmpdir):
+		server.fail = True
+		relay = AsyncKeenMQTT()
+		relay.setup(settings=self.settings(broker, server, batching={'max_events': 5},
+			spool={'directory': str(tmpdir), 'replay_interval': 60}))
+
+		async def main():
+			await relay.start()
+			await wait_for(lambda: subscribed(broker))
+			for i in range(10):
+				broker.publish('home/kitchen', json.dumps({'v': i}).encode('utf-8'))
+			await wait_for(lambda: relay.stats.counters.get('events_pushed') == 10)
+			await relay.stop()
+
+		run(main())
+		assert server.event_count() == 0
+		assert relay.stats.counters['events_failed'] == 10
+		server.fail = False
+		assert relay.spool.replay(lambda events: server.record(events, 0)) == 10
+
+	def test_stop_during_spool_replay(self, broker, server, tmpdir):
+		class Relay(AsyncKeenMQTT):
+			replaying = False
+			replayed = 0
+
+			async def upload_events(self, events):
+				self.replaying = True
+				await asyncio.sleep(0.2)
+				self.replayed += sum(len(batch) for batch in events.values())
+
+		relay = Relay()
+		relay.setup(settings=self.settings(broker, server, spool={'directory': str(tmpdir), 'replay_interval': 0.01}))
+		relay.spool.append({'home': [{'v': i} for i in range(5)]})
+
+		async def main():
+			await relay.start()
+			await wait_for(lambda: relay.replaying)
+			# The replay thread is blocked on an upload run by the loop being stopped.
+			await asyncio.wait_for(relay.stop(), 5)
+
+		run(main())
+		assert relay.replayed == 5
+		assert relay.spool_replayer._thread is None
+		with pytest.raises(BackgroundRunningException):
+			relay.step()
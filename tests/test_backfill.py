@@ -0,0 +1,160 @@
+import gzip
+import json
+import yaml
+import pytest
+from click.testing import CliRunner
+from keenmqtt import KeenMQTT
+from keenmqtt.app import main
+from keenmqtt.backfill import Backfill, decode_records, detect_format
+from benchmarks.keen_server import FakeKeenServer
+
+@pytest.fixture
+def server():
+	server = FakeKeenServer(write_key='secret').start()
+	yield server
+	server.stop()
+
+def settings(server, **extra):
+	settings = {
+		'keen': {'project_id': 'project', 'write_key': 'secret', 'base_url': server.base_url},
+		'collection_mappings': {'home/#': 'home'},
+		'timestamps': {'source': 'receive'},
+		'batching': {'max_events': 50},
+	}
+	settings.update(extra)
+	return settings
+
+def relay(settings):
+	keenmqtt = KeenMQTT()
+	keenmqtt.setup(mqtt_client=keenmqtt.create_mqtt_client({}), settings=settings)
+	return keenmqtt
+
+def write_jsonl(path, count, opener=open):
+	with opener(path, 'wb') as dump:
+		for i in range(count):
+			payload = {'v': i} if i % 2 else json.dumps({'v': i})
+			dump.write(json.dumps({'topic': 'home/{}'.format(i % 3), 'payload': payload, 'time': 1451649600 + i}).encode() + b'\n')
+		dump.write(b'not json\n')
+
+class TestBackfill:
+	"""Test the offline backfill of recorded messages"""
+
+	def test_decode_records(self):
+		decoded, failed = decode_records('csv', (0, 1, None), [['a', '{"v": 1}'], ['a', '{'], ['b']],
+			lambda topic, payload: [json.loads(payload.decode())])
+		assert decoded[0][:3] == ('a', [{'v': 1}], None)
+		assert failed == 2
+		assert detect_format('dump.csv.gz') == 'csv'
+		assert detect_format('dump.jsonl') == 'jsonl'
+
+	@pytest.mark.parametrize('workers', [0, 2])
+	def test_gzipped_jsonl(self, server, tmpdir, workers):
+		path = str(tmpdir.join('dump.jsonl.gz'))
+		write_jsonl(path, 300, gzip.open)
+		progress = []
+		keenmqtt = relay(settings(server))
+		job = Backfill(keenmqtt, path, workers=workers, chunk_size=64, progress=progress.append, progress_interval=0)
+		result = job.run()
+		keenmqtt.stop()
+		assert (result['records'], result['failed']) == (300, 1)
+		assert result['percent'] == 100.0
+		assert len(progress) > 1
+		assert server.event_count() == 300
+		events = sorted(server.events['home'], key=lambda event: event['v'])
+		assert [event['v'] for event in events] == list(range(300))
+		assert events[1]['keen']['timestamp'] == '2016-01-01T12:00:01.000000+00:00'
+		assert events[1]['mqtt_topic'] == 'home/1'
+		assert keenmqtt.get_stats()['counters']['records_decoded'] == 300
+
+	def test_csv_checkpoint(self, server, tmpdir):
+		path = str(tmpdir.join('dump.csv'))
+		with open(path, 'w') as dump:
+			dump.write('time,topic,payload\n')
+			for i in range(100):
+				dump.write('{},home/1,"{{""v"": {}}}"\n'.format(1451649600 + i, i))
+		checkpoint = str(tmpdir.join('checkpoint.json'))
+		keenmqtt = relay(settings(server))
+		job = Backfill(keenmqtt, path, checkpoint=checkpoint, chunk_size=10, checkpoint_interval=0)
+		job.run()
+		keenmqtt.stop()
+		assert server.event_count() == 100
+		with open(checkpoint) as saved:
+			assert json.load(saved)['records'] == 100
+
+		# Resume part way through, as if the run had stopped after the 60th record.
+		with open(path, 'rb') as dump:
+			offset = sum(len(line) for line in dump.readlines()[:61])
+		keenmqtt = relay(settings(server))
+		job = Backfill(keenmqtt, path, chunk_size=10)
+		assert job.run(offset)['records'] == 40
+		keenmqtt.stop()
+		assert sorted(event['v'] for event in server.events['home'][100:]) == list(range(60, 100))
+
+	def test_command(self, server, tmpdir):
+		path = str(tmpdir.join('dump.jsonl'))
+		write_jsonl(path, 20)
+		config = str(tmpdir.join('config.yaml'))
+		with open(config, 'w') as config_file:
+			yaml.safe_dump(settings(server, mqtt={'host': 'localhost', 'port': 1},
+				recording={'directory': str(tmpdir.join('recording'))}), config_file)
+		checkpoint = str(tmpdir.join('checkpoint.json'))
+		runner = CliRunner()
+		result = runner.invoke(main, ['-c', config, 'backfill', path, '-d', '0', '--checkpoint', checkpoint])
+		assert result.exit_code == 0, result.output
+		assert '20 records, 1 failed' in result.output
+		assert server.event_count() == 20
+		# Running again resumes from the checkpoint at the end of the file.
+		result = runner.invoke(main, ['-c', config, 'backfill', path, '-d', '0', '--checkpoint', checkpoint])
+		assert 'resuming' in result.output
+		assert server.event_count() == 20
+		# A dump is not live traffic, so it is not recorded again.
+		assert not tmpdir.join('recording').check()
+
+	def test_failed_uploads_hold_the_checkpoint(self, server, tmpdir):
+		path = str(tmpdir.join('dump.jsonl'))
+		write_jsonl(path, 100)
+		checkpoint = str(tmpdir.join('checkpoint.json'))
+		keenmqtt = relay(settings(server, upload_workers={'workers': 1}, batching={'max_events': 10}))
+		job = Backfill(keenmqtt, path, checkpoint=checkpoint, chunk_size=10, checkpoint_interval=0)
+		job.run()
+		with open(checkpoint) as saved:
+			assert json.load(saved)['records'] == 100
+
+		server.fail = True
+		job = Backfill(keenmqtt, path, checkpoint=checkpoint, chunk_size=10, checkpoint_interval=0)
+		progress = job.run(job.read_checkpoint() - 200)
+		keenmqtt.stop()
+		assert progress['upload_failures'] > 0
+		with open(checkpoint) as saved:
+			assert json.load(saved)['records'] == 100
+
+	def test_rollup_checkpoint(self, server, tmpdir):
+		path = str(tmpdir.join('dump.jsonl'))
+		write_jsonl(path, 100)
+		checkpoint = str(tmpdir.join('checkpoint.json'))
+		config = settings(server, collection_mappings={'home/#': {'collection': 'home', 'rollup': {'window': 10}}})
+
+		def interrupt(progress):
+			if progress['records'] == 50:
+				raise KeyboardInterrupt()
+		keenmqtt = relay(config)
+		job = Backfill(keenmqtt, path, checkpoint=checkpoint, chunk_size=10, checkpoint_interval=0,
+			progress=interrupt, progress_interval=0)
+		with pytest.raises(KeyboardInterrupt):
+			job.run()
+		keenmqtt.drain()
+		# Records 40 to 49 are in windows still open, so the checkpoint stops before them.
+		with open(checkpoint) as saved:
+			assert json.load(saved)['records'] == 40
+		assert len(server.events['home']) == 12
+
+		keenmqtt = relay(config)
+		job = Backfill(keenmqtt, path, checkpoint=checkpoint, chunk_size=10, checkpoint_interval=0)
+		job.run(job.read_checkpoint())
+		keenmqtt.stop()
+		# Each topic's ten second windows give one rollup event each, however often the
+		# checkpoint was written.
+		events = server.events['home']
+		assert len(events) == 30
+		assert len(set((event['mqtt_topic'], event['window_start']) for event in events)) == 30
+		assert sum(event['v']['count'] for event in events) == 100
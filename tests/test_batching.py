@@ -0,0 +1,73 @@
+import time
+from keenmqtt import KeenMQTT
+from keenmqtt.batching import EventBatcher
+
+class TestEventBatcher:
+	"""Test grouping events into bulk uploads"""
+
+	def setup_method(self, _):
+		self.batches = []
+
+	def test_max_events(self):
+		batcher = EventBatcher(self.batches.append, max_events=3, max_age=0)
+		batcher.add('a', {'v': 1})
+		batcher.add('b', {'v': 2})
+		assert self.batches == []
+		assert batcher.pending() == 2
+		batcher.add('a', {'v': 3})
+		assert self.batches == [{'a': [{'v': 1}, {'v': 3}], 'b': [{'v': 2}]}]
+		assert batcher.pending() == 0
+
+	def test_max_bytes(self):
+		batcher = EventBatcher(self.batches.append, max_events=0, max_bytes=20, max_age=0)
+		batcher.add('a', {'v': 1})
+		assert self.batches == []
+		batcher.add('a', {'value': 'long enough'})
+		assert len(self.batches) == 1
+
+	def test_max_age(self):
+		batcher = EventBatcher(self.batches.append, max_events=0, max_age=0.01)
+		batcher.add('a', {'v': 1})
+		batcher.flush_expired()
+		assert self.batches == []
+		time.sleep(0.02)
+		batcher.flush_expired()
+		assert self.batches == [{'a': [{'v': 1}]}]
+
+	def test_stop_flushes(self):
+		batcher = EventBatcher(self.batches.append, max_events=0, max_age=10)
+		batcher.start()
+		batcher.add('a', {'v': 1})
+		batcher.stop()
+		assert self.batches == [{'a': [{'v': 1}]}]
+
+	def test_from_settings(self):
+		batcher = EventBatcher.from_settings(self.batches.append, {'max_events': 10, 'max_age': 2})
+		assert batcher.max_events == 10
+		assert batcher.max_bytes == 0
+		assert batcher.max_age == 2.0
+
+class TestKeenMQTTBatching:
+	"""Test the KeenMQTT integration of the batcher"""
+
+	def setup_method(self, _):
+		self.keenmqtt = KeenMQTT()
+		self.keenmqtt.ready = True
+
+	def test_push_event_batches(self, mocker):
+		self.keenmqtt.keen_client = mocker.Mock()
+		self.keenmqtt.setup_batching({'max_events': 2, 'max_age': 0})
+		self.keenmqtt.push_event('a', {'v': 1})
+		assert not self.keenmqtt.keen_client.add_events.called
+		self.keenmqtt.push_event('a', {'v': 2})
+		self.keenmqtt.keen_client.add_events.assert_called_once_with({'a': [{'v': 1}, {'v': 2}]})
+		assert not self.keenmqtt.keen_client.add_event.called
+
+	def test_stop_flushes(self, mocker):
+		self.keenmqtt.keen_client = mocker.Mock()
+		self.keenmqtt.mqtt_client = mocker.Mock()
+		self.keenmqtt.setup_batching({'max_events': 10, 'max_age': 10})
+		self.keenmqtt.start()
+		self.keenmqtt.push_event('a', {'v': 1})
+		self.keenmqtt.stop()
+		self.keenmqtt.keen_client.add_events.assert_called_once_with({'a': [{'v': 1}]})
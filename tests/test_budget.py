@@ -0,0 +1,153 @@
+import json
+import threading
+import time
+import pytest
+from keenmqtt import KeenMQTT
+from keenmqtt.budget import MemoryBudget, event_size
+
+EVENT = {'room': 'kitchen', 'temperature': 20.5}
+
+class Struct:
+	pass
+
+def message(topic, payload):
+	mqtt_message = Struct()
+	mqtt_message.topic = topic
+	mqtt_message.payload = payload
+	mqtt_message.qos = 0
+	mqtt_message.retain = False
+	return mqtt_message
+
+class TestMemoryBudget:
+	"""Test the memory budget overload policies"""
+
+	def test_event_size(self):
+		assert event_size(EVENT) > event_size({})
+		assert event_size({'a': ['x' * 1000]}) > 1000
+
+	def test_drop_newest(self):
+		drops = []
+		budget = MemoryBudget(event_size(EVENT) * 2, policy='drop-newest', on_drop=lambda c, n: drops.append((c, n)))
+		assert budget.acquire('a', EVENT)
+		assert budget.acquire('a', EVENT)
+		assert not budget.acquire('b', EVENT)
+		assert budget.dropped == {'b': 1}
+		assert drops == [('b', 1)]
+		budget.release({'a': [EVENT, EVENT]})
+		assert budget.stats()['bytes'] == 0
+		assert budget.acquire('b', EVENT)
+
+	def test_first_event_always_fits(self):
+		budget = MemoryBudget(1, policy='drop-newest')
+		assert budget.acquire('a', EVENT)
+		assert not budget.acquire('a', EVENT)
+
+	def test_drop_oldest(self):
+		waiting = [{'old': [EVENT]}, {'older': [EVENT]}]
+		budget = MemoryBudget(event_size(EVENT) * 2, policy='drop-oldest',
+			evict=lambda: waiting.pop() if waiting else None)
+		assert budget.acquire('old', EVENT)
+		assert budget.acquire('older', EVENT)
+		assert budget.acquire('new', EVENT)
+		assert budget.dropped == {'older': 1}
+		assert budget.acquire('new', EVENT)
+		assert budget.acquire('new', EVENT) is False
+		assert budget.dropped == {'older': 1, 'old': 1, 'new': 1}
+
+	def test_sample(self):
+		budget = MemoryBudget(event_size(EVENT) * 2, policy='sample', sample_every=3)
+		kept = [budget.acquire('a', EVENT) for i in range(11)]
+		# One in three is kept, until twice the budget is held.
+		assert kept == [True, True, False, False, True, False, False, True, False, False, False]
+		assert budget.dropped == {'a': 7}
+
+	def test_block(self):
+		budget = MemoryBudget(event_size(EVENT), policy='block', block_timeout=5)
+		assert budget.acquire('a', EVENT)
+		timer = threading.Timer(0.1, budget.release, [{'a': [EVENT]}])
+		timer.start()
+		start = time.time()
+		assert budget.acquire('a', EVENT)
+		assert 0.05 < time.time() - start < 2
+		stats = budget.stats()
+		assert stats['blocked'] == 1
+		assert stats['events'] == 1
+		timer.join()
+
+	def test_block_timeout(self):
+		budget = MemoryBudget(event_size(EVENT), policy='block', block_timeout=0.05)
+		assert budget.acquire('a', EVENT)
+		assert not budget.acquire('a', EVENT)
+		assert budget.acquire('a', EVENT, block=False)
+		assert budget.exceeded()
+		assert budget.dropped == {'a': 1}
+
+	def test_unknown_policy(self):
+		with pytest.raises(ValueError):
+			MemoryBudget(100, policy='panic')
+
+class TestKeenMQTTMemoryBudget:
+	"""Test the KeenMQTT integration of the memory budget"""
+
+	def test_slow_uploads(self, mocker):
+		gate = threading.Event()
+		keen_client = mocker.Mock()
+		keen_client.add_events.side_effect = lambda events: gate.wait()
+		keenmqtt = KeenMQTT()
+		keenmqtt.setup(mqtt_client=mocker.Mock(), keen_client=keen_client, settings={
+			'upload_workers': {'workers': 1, 'queue_size': 100},
+			'memory_budget': {'max_bytes': event_size(EVENT) * 5, 'policy': 'drop-oldest'},
+		})
+		for i in range(20):
+			keenmqtt.push_event('home', dict(EVENT, v=i))
+		stats = keenmqtt.get_stats()
+		assert stats['memory_budget']['events'] <= 5
+		assert stats['counters']['dropped_by_budget'] == 20 - stats['memory_budget']['events']
+		assert stats['collections']['home']['counters']['dropped_by_budget'] > 0
+		gate.set()
+		keenmqtt.stop()
+		uploaded = [call[0][0]['home'][0]['v'] for call in keen_client.add_events.call_args_list]
+		# The newest events survive, as well as the one the worker was uploading.
+		assert uploaded[-3:] == [17, 18, 19]
+		assert keenmqtt.budget.stats()['bytes'] == 0
+
+	def test_block_with_batching(self, mocker):
+		gate = threading.Event()
+		gate.set()
+		keen_client = mocker.Mock()
+		keen_client.add_events.side_effect = lambda events: gate.wait()
+		keenmqtt = KeenMQTT()
+		mqtt_client = mocker.Mock()
+		mqtt_client.subscribe.return_value = (0, 1)
+		keenmqtt.setup(mqtt_client=mqtt_client, keen_client=keen_client, settings={
+			'collection_mappings': {'home/#': 'home', 'away/#': 'away'},
+			'batching': {'max_events': 1000, 'max_age': 60},
+			'upload_workers': {'workers': 1},
+			'memory_budget': {'max_bytes': event_size(EVENT) * 5, 'policy': 'block', 'block_timeout': 5},
+		})
+		start = time.time()
+		for i in range(20):
+			keenmqtt.on_mqtt_message(None, None, message('home/a', json.dumps(dict(EVENT, v=i)).encode()))
+		# Batched events are flushed to make room, rather than waiting out the timeout.
+		assert time.time() - start < 2
+		keenmqtt.drain()
+		assert sum(len(call[0][0]['home']) for call in keen_client.add_events.call_args_list) == 20
+
+		# While a message waits for uploads to make room, the mappings can still be reloaded.
+		gate.clear()
+		while not keenmqtt.budget.exceeded():
+			keenmqtt.on_mqtt_message(None, None, message('home/a', json.dumps(EVENT).encode()))
+		waiting = threading.Thread(target=keenmqtt.on_mqtt_message,
+			args=(None, None, message('home/a', json.dumps(EVENT).encode())))
+		waiting.start()
+		time.sleep(0.1)
+		assert waiting.is_alive()
+		reloading = threading.Thread(target=keenmqtt.reload_collection_mappings, args=({'home/#': 'home'},))
+		reloading.start()
+		reloading.join(2)
+		assert not reloading.is_alive()
+		gate.set()
+		waiting.join(5)
+		keenmqtt.stop()
+		assert keenmqtt.budget.stats()['blocked'] >= 1
+		assert keenmqtt.budget.stats()['bytes'] == 0
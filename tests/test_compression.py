@@ -0,0 +1,79 @@
+import asyncio
+import gzip
+import json
+import keen
+import pytest
+from keenmqtt import KeenMQTT
+from keenmqtt.aio import AsyncKeenUploader
+from keenmqtt.compression import GzipCompressor
+from keenmqtt.pool import HTTPPool
+from benchmarks.keen_server import FakeKeenServer
+
+@pytest.fixture
+def server():
+	server = FakeKeenServer(write_key='secret').start()
+	yield server
+	server.stop()
+
+def batch(count):
+	return {'home': [{'room': 'kitchen', 'temperature': 20.5, 'v': i} for i in range(count)]}
+
+class TestGzipCompressor:
+	"""Test compression of upload request bodies"""
+
+	def test_compress(self):
+		compressor = GzipCompressor(level=1, min_size=100)
+		body = json.dumps(batch(50))
+		compressed = compressor.compress(body)
+		assert json.loads(gzip.decompress(compressed).decode('utf-8')) == batch(50)
+		assert compressor.compress(b'{"home": []}') is None
+		stats = compressor.stats()
+		assert stats['compressed'] == 1
+		assert stats['skipped'] == 1
+		assert stats['bytes_in'] == len(body)
+		assert stats['bytes_out'] == len(compressed)
+
+	def test_level(self):
+		with pytest.raises(ValueError):
+			GzipCompressor(level=0)
+		compressor = GzipCompressor.from_settings({'level': 9, 'min_size': 10})
+		assert (compressor.level, compressor.min_size) == (9, 10)
+
+	def test_pool_compresses_uploads(self, server):
+		client = keen.KeenClient(project_id='project', write_key='secret', base_url=server.base_url)
+		compressor = GzipCompressor(min_size=100)
+		pool = HTTPPool(compressor=compressor)
+		pool.attach(client)
+		client.add_events(batch(100))
+		client.add_events(batch(1))
+		assert server.event_count() == 101
+		assert compressor.stats()['compressed'] == 1
+		assert compressor.stats()['skipped'] == 1
+		assert server.body_bytes < len(json.dumps(batch(100))) / 4
+		pool.close()
+
+	def test_async_uploader_compresses_uploads(self, server):
+		compressor = GzipCompressor(min_size=100)
+		uploader = AsyncKeenUploader('project', 'secret', base_url=server.base_url, compressor=compressor)
+
+		async def upload():
+			try:
+				await uploader.add_events(batch(100))
+			finally:
+				uploader.close()
+
+		asyncio.new_event_loop().run_until_complete(upload())
+		assert server.event_count() == 100
+		assert compressor.stats()['compressed'] == 1
+		assert server.body_bytes < len(json.dumps(batch(100))) / 4
+
+	def test_relay_stats(self, server, mocker):
+		keenmqtt = KeenMQTT()
+		keenmqtt.setup(mqtt_client=mocker.Mock(), settings={
+			'keen': {'project_id': 'project', 'write_key': 'secret', 'base_url': server.base_url},
+			'compression': {'min_size': 10},
+		})
+		keenmqtt.push_event('home', {'room': 'kitchen', 'temperature': 20.5})
+		assert server.event_count() == 1
+		assert keenmqtt.get_stats()['compression']['compressed'] == 1
+		keenmqtt.stop()
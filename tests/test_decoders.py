@@ -0,0 +1,126 @@
+import pickle
+import struct
+import pytest
+from keenmqtt import KeenMQTT
+from keenmqtt import decoders
+from keenmqtt.decoders import (DecoderSelector, StructDecoder, decode_json, decode_json_stdlib, get_decoder,
+	register_decoder)
+
+class Struct:
+	pass
+
+class TestDecoders:
+	"""Test the payload decoders and their selection by topic"""
+
+	def test_json_from_bytes(self):
+		payload = b'{"a": 1, "b": "\\u00e9"}'
+		assert decode_json('t', payload) == [{'a': 1, 'b': u'é'}]
+		assert decode_json_stdlib('t', payload) == [{'a': 1, 'b': u'é'}]
+
+	def test_malformed_json(self):
+		with pytest.raises(ValueError):
+			decode_json('t', b'{"a": ')
+		with pytest.raises(ValueError):
+			decode_json_stdlib('t', b'\xff')
+
+	def test_unknown_decoder(self):
+		with pytest.raises(ValueError):
+			get_decoder('nope')
+
+	def test_msgpack(self):
+		msgpack = pytest.importorskip('msgpack')
+		decode = get_decoder('msgpack')
+		assert decode('t', msgpack.packb({'a': 1, 'b': u'é'})) == [{'a': 1, 'b': u'é'}]
+		assert decode('t', msgpack.packb([{'v': 1}, {'v': 2}])) == [{'v': 1}, {'v': 2}]
+		with pytest.raises(ValueError):
+			decode('t', msgpack.packb({'a': 1})[:-1])
+
+	def test_cbor(self):
+		cbor2 = pytest.importorskip('cbor2')
+		decode = get_decoder('cbor')
+		assert decode('t', cbor2.dumps({'a': 1.5})) == [{'a': 1.5}]
+		assert decode('t', cbor2.dumps([{'v': 1}, {'v': 2}])) == [{'v': 1}, {'v': 2}]
+		with pytest.raises(ValueError):
+			decode('t', cbor2.dumps({'a': 1})[:-1])
+
+	def test_missing_package(self, mocker):
+		mocker.patch.dict(decoders.DECODERS)
+		decoders.DECODERS.pop('msgpack', None)
+		mocker.patch.dict('keenmqtt.imports._modules', {'msgpack': None})
+		with pytest.raises(ValueError, match='needs the msgpack package'):
+			get_decoder('msgpack')
+
+	@pytest.mark.parametrize('numpy', [True, False])
+	def test_struct(self, numpy):
+		if numpy:
+			pytest.importorskip('numpy')
+		decode = StructDecoder('<Ihxxh', ['time', 'temperature', 'humidity'], {'temperature': 0.01},
+			numpy_min_records=2 if numpy else 1000)
+		if numpy:
+			assert decode._dtype is not None
+		payload = struct.pack('<Ihxxh', 1000, 2150, 40) + struct.pack('<Ihxxh', 1001, -5, 41)
+		assert decode('t', payload) == [
+			{'time': 1000, 'temperature': 21.5, 'humidity': 40},
+			{'time': 1001, 'temperature': -0.05, 'humidity': 41},
+		]
+		assert decode('t', payload[:10]) == [{'time': 1000, 'temperature': 21.5, 'humidity': 40}]
+		assert decode('t', b'') == []
+		with pytest.raises(ValueError):
+			decode('t', payload[:-1])
+
+	@pytest.mark.parametrize('numpy', [True, False])
+	def test_struct_integer_scale(self, numpy):
+		if numpy:
+			pytest.importorskip('numpy')
+		fmt = '<hBIQf'
+		fields = ['a', 'b', 'c', 'd', 'e']
+		decode = StructDecoder(fmt, fields, {'a': 1000, 'b': 2, 'c': 1000, 'd': 3, 'e': 2},
+			numpy_min_records=2 if numpy else 1000)
+		values = [(-32768, 255, 4294967295, 2 ** 64 - 1, 0.5), (32767, 128, 4000000, 7, -1.5)]
+		payload = b''.join(struct.pack(fmt, *value) for value in values)
+		# Products too big for the fields' own types are exact, as they are a record at a time.
+		expected = [{'a': a * 1000, 'b': b * 2, 'c': c * 1000, 'd': d * 3, 'e': e * 2} for a, b, c, d, e in values]
+		assert decode('t', payload) == expected
+		assert [decode('t', payload[i:i + decode.size])[0] for i in (0, decode.size)] == expected
+
+	def test_struct_settings(self):
+		selector = DecoderSelector.from_settings({'meters/#': {'struct': '>HB', 'fields': ['watts', 'phase']}})
+		assert selector.for_topic('meters/a')('meters/a', b'\x01\x00\x02') == [{'watts': 256, 'phase': 2}]
+		decode = pickle.loads(pickle.dumps(selector.for_topic('meters/a')))
+		assert decode('meters/a', b'\x00\x01\x02\x00\x02\x03') == [{'watts': 1, 'phase': 2}, {'watts': 2, 'phase': 3}]
+		with pytest.raises(ValueError):
+			StructDecoder('<Ih', ['time'])
+		with pytest.raises(ValueError):
+			StructDecoder('<Q!', ['time'])
+		with pytest.raises(ValueError):
+			StructDecoder('<I', ['time'], {'watts': 2})
+		with pytest.raises(ValueError):
+			DecoderSelector.from_settings({'meters/#': {'fields': ['watts']}})
+
+	def test_selector(self):
+		def decode_int(topic, payload):
+			return [{'value': int(payload)}]
+		register_decoder('test-int', decode_int)
+		selector = DecoderSelector.from_settings({'humidity/+': 'test-int'}, 'json-stdlib')
+		assert selector.for_topic('humidity/kitchen') is decode_int
+		assert selector.for_topic('temperature/kitchen') is decode_json_stdlib
+		selector.add('temperature/#', 'test-int')
+		assert selector.for_topic('temperature/kitchen') is decode_int
+
+	def test_malformed_payload_is_dropped(self, mocker):
+		keenmqtt = KeenMQTT()
+		keenmqtt.stats = None
+		keenmqtt.add_collection_mapping('home/+', 'home')
+		mocker.patch.object(keenmqtt, 'push_event')
+		mqtt_message = Struct()
+		mqtt_message.topic = 'home/a'
+		mqtt_message.payload = b'{not json'
+		keenmqtt.on_mqtt_message(None, None, mqtt_message)
+		assert not keenmqtt.push_event.called
+
+	def test_per_topic_setting(self, mocker):
+		keenmqtt = KeenMQTT()
+		keenmqtt.setup(mqtt_client=mocker.Mock(), keen_client=mocker.Mock(),
+			settings={'decoders': {'raw/#': 'json-stdlib'}, 'default_decoder': 'json'})
+		assert keenmqtt.decoders.for_topic('raw/a') is decode_json_stdlib
+		assert keenmqtt.decode_payload('raw/a', b'{"a": 1}') == [{'a': 1}]
@@ -0,0 +1,83 @@
+import pytest
+from keenmqtt import KeenMQTT
+from keenmqtt.dedup import Deduplicator
+
+class Struct:
+	pass
+
+def message(topic, payload, retain=False, dup=False):
+	mqtt_message = Struct()
+	mqtt_message.topic = topic
+	mqtt_message.payload = payload
+	mqtt_message.retain = retain
+	mqtt_message.dup = dup
+	return mqtt_message
+
+class TestDeduplicator:
+	"""Test the suppression of duplicate messages"""
+
+	def test_payload(self):
+		dedup = Deduplicator(ttl=10)
+		assert not dedup.seen('a', b'{"v": 1}', 0)
+		assert dedup.seen('a', b'{"v": 1}', 1)
+		assert not dedup.seen('b', b'{"v": 1}', 1)
+		assert not dedup.seen('a', b'{"v": 2}', 1)
+		assert dedup.stats() == {'suppressed': 1, 'keys': 3, 'rotations': 0}
+
+	def test_ttl(self):
+		dedup = Deduplicator(ttl=10)
+		assert not dedup.seen('a', b'1', 0)
+		# Remembered for at least half the ttl, and at most the ttl.
+		assert dedup.seen('a', b'1', 4.9)
+		assert not dedup.seen('a', b'2', 6)
+		assert dedup.seen('a', b'2', 14)
+		assert not dedup.seen('a', b'2', 40)
+		assert dedup.stats()['rotations'] == 3
+
+	def test_max_keys(self):
+		dedup = Deduplicator(ttl=1000, max_keys=10)
+		for i in range(100):
+			assert not dedup.seen('a', str(i).encode(), 0)
+		assert dedup.stats()['keys'] <= 10
+		assert dedup.seen('a', b'99', 0)
+		assert not dedup.seen('a', b'0', 0)
+
+	def test_id_field(self):
+		dedup = Deduplicator(id_field='msg_id')
+		assert not dedup.seen('a', b'{"msg_id": "x\\"1", "v": 1}', 0)
+		assert dedup.seen('a', b'{"v": 2, "msg_id" : "x\\"1"}', 0)
+		assert not dedup.seen('a', b'{"msg_id": 17}', 0)
+		assert dedup.seen('a', b'{"msg_id":17, "v": 3}', 0)
+		assert not dedup.seen('a', b'{"msg_id": 170}', 0)
+		assert not dedup.seen('a', b'{"v": 1}', 0)
+		assert dedup.seen('a', b'{"v": 1}', 0)
+
+	def test_redelivered_only(self):
+		dedup = Deduplicator(ttl=10, all_messages=False)
+		assert not dedup.seen('a', b'1', 0, False)
+		# The same reading again is a new event, a retained or DUP copy of it is not.
+		assert not dedup.seen('a', b'1', 1, False)
+		assert dedup.seen('a', b'1', 2, True)
+		assert dedup.stats()['suppressed'] == 1
+		assert not Deduplicator.from_settings({}).all_messages
+		assert Deduplicator.from_settings({'id_field': 'msg_id'}).all_messages
+		assert not Deduplicator.from_settings({'id_field': 'msg_id', 'all_messages': False}).all_messages
+
+	@pytest.mark.parametrize('stats', [True, False])
+	def test_relay(self, mocker, stats):
+		settings = {'collection_mappings': {'a/#': 'a'}, 'dedup': {'ttl': 60}}
+		if not stats:
+			settings['stats'] = {'enabled': False}
+		relay = KeenMQTT()
+		relay.setup(mqtt_client=mocker.Mock(), keen_client=mocker.Mock(), settings=settings)
+		mocker.patch.object(relay, 'push_event')
+		decode = mocker.spy(relay, 'decode_payload')
+		relay.on_mqtt_message(None, None, message('a/1', b'{"v": 1}'))
+		relay.on_mqtt_message(None, None, message('a/1', b'{"v": 1}'))
+		relay.on_mqtt_message(None, None, message('a/1', b'{"v": 1}', retain=True))
+		relay.on_mqtt_message(None, None, message('a/2', b'{"v": 1}', dup=True))
+		assert relay.push_event.call_count == 3
+		assert decode.call_count == 3
+		assert relay.get_stats()['dedup']['suppressed'] == 1
+		if stats:
+			assert relay.stats.counters['duplicates_suppressed'] == 1
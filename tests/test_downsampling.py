@@ -0,0 +1,69 @@
+import pytest
+from keenmqtt import KeenMQTT
+from keenmqtt.downsampling import Downsampler
+
+class Struct:
+	pass
+
+def message(topic, payload):
+	mqtt_message = Struct()
+	mqtt_message.topic = topic
+	mqtt_message.payload = payload
+	return mqtt_message
+
+class TestDownsampler:
+	"""Test the per-topic downsampling rules"""
+
+	def test_every(self):
+		downsampler = Downsampler(every=3)
+		kept = [downsampler.keep('a', {}, 0) for i in range(7)]
+		assert kept == [True, False, False, True, False, False, True]
+		assert downsampler.keep('b', {}, 0)
+		assert downsampler.stats() == {'kept': 4, 'dropped': 4, 'topics': 2}
+
+	def test_interval(self):
+		downsampler = Downsampler(interval=1.0)
+		kept = [downsampler.keep('a', {}, i * 0.25) for i in range(9)]
+		assert kept == [True, False, False, False, True, False, False, False, True]
+
+	def test_deadband(self):
+		downsampler = Downsampler(deadband={'value': 0.5, 'state': 0})
+		values = [(20.0, 'on'), (20.2, 'on'), (20.6, 'on'), (20.3, 'on'), (20.3, 'off'), (None, 'off')]
+		kept = [downsampler.keep('a', {'value': value, 'state': state}, 0) for value, state in values]
+		assert kept == [True, False, True, False, True, True]
+
+	def test_bounded_state(self):
+		downsampler = Downsampler(every=10, max_topics=2)
+		for topic in ('a', 'b', 'c', 'a'):
+			assert downsampler.keep(topic, {}, 0)
+		assert downsampler.stats()['topics'] == 2
+
+	def test_settings(self):
+		assert Downsampler.from_settings(None) is None
+		downsampler = Downsampler.from_settings({'every': 2, 'interval': '0.5', 'deadband': {'v': 1}})
+		assert (downsampler.every, downsampler.interval, downsampler.deadband) == (2, 0.5, (('v', 1.0),))
+		with pytest.raises(ValueError):
+			Downsampler(every=0)
+
+	@pytest.mark.parametrize('stats', [True, False])
+	def test_relay(self, mocker, stats):
+		settings = {'collection_mappings': {
+			'sensors/+/vibration': {
+				'collection': 'vibration',
+				'coerce': {'value': 'float'},
+				'downsample': {'every': 2, 'deadband': {'value': 1}},
+			},
+		}}
+		if not stats:
+			settings['stats'] = {'enabled': False}
+		relay = KeenMQTT()
+		relay.setup(mqtt_client=mocker.Mock(), keen_client=mocker.Mock(), settings=settings)
+		mocker.patch.object(relay, 'push_event')
+		for topic in ('sensors/1/vibration', 'sensors/2/vibration'):
+			for value in ('1', '5', '9', '9', '9', '20'):
+				relay.on_mqtt_message(None, None, message(topic, '{{"value": "{}"}}'.format(value).encode()))
+		values = [call[0][1]['value'] for call in relay.push_event.call_args_list]
+		assert values == [1.0, 9.0, 20.0, 1.0, 9.0, 20.0]
+		assert relay.get_stats()['downsampling'] == {'kept': 6, 'dropped': 6, 'topics': 2}
+		if stats:
+			assert relay.stats.counters['dropped_by_downsampling'] == 6
@@ -20,10 +20,10 @@ class TestKeenMQTTMethods:
 			pass
 		self.keenmqtt.mqtt_client = Struct()
 		self.keenmqtt.mqtt_client.subscribe = dummy_sub
-		mocker.patch.object(self.keenmqtt.mqtt_client, "subscribe")
+		mocker.patch.object(self.keenmqtt.mqtt_client, "subscribe", return_value=(0, 1))
 		self.keenmqtt.add_collection_mapping('foo', 'bar')
 		self.keenmqtt.register_subscriptions()
-		self.keenmqtt.mqtt_client.subscribe.assert_called_once_with('foo')
+		self.keenmqtt.mqtt_client.subscribe.assert_called_once_with([('foo', 0)])
 
 	def test_on_mqtt_message(self, mocker):
 		"""Test full message processing, up to keen IO level."""
@@ -48,6 +48,49 @@ class TestKeenMQTTMethods:
 		self.keenmqtt.on_mqtt_message({}, {}, mqtt)
 		self.keenmqtt.push_event.assert_called_once_with(collection, event)
 
+	@pytest.mark.parametrize('stats', [True, False])
+	def test_event_fast_path(self, mocker, stats):
+		"""The decoded dict becomes the event when the event hooks are the defaults."""
+		class Relay(KeenMQTT):
+			def process_payload(self, event, topic, message):
+				return KeenMQTT.process_payload(self, event, topic, message)
+
+		decoded = {'v': 1, 'keen': {'timestamp': 'old'}}
+		events = []
+		for relay in (KeenMQTT(), Relay()):
+			if not stats:
+				relay.stats = None
+			relay.add_collection_mapping('home/+', 'home')
+			mocker.patch.object(relay, 'decode_payload', return_value=[dict(decoded)])
+			mocker.patch.object(relay, 'get_time', return_value='now')
+			mocker.patch.object(relay, 'push_event')
+			message = Struct()
+			message.topic = 'home/kitchen'
+			message.payload = b''
+			relay.on_mqtt_message(None, None, message)
+			events.append(relay.push_event.call_args[0][1])
+		fast, slow = events
+		assert fast == slow == {'v': 1, 'mqtt_topic': 'home/kitchen', 'keen': {'timestamp': 'now'}}
+		assert relay.decode_payload.return_value[0] is not slow
+
+	def test_event_fast_path_identity(self, mocker):
+		decoded = {'v': 1, 'mqtt_topic': 'from payload'}
+		self.keenmqtt.add_collection_mapping('home/+', 'home')
+		mocker.patch.object(self.keenmqtt, 'decode_payload', return_value=[decoded])
+		mocker.patch.object(self.keenmqtt, 'push_event')
+		message = Struct()
+		message.topic = 'home/kitchen'
+		message.payload = b''
+		self.keenmqtt.on_mqtt_message(None, None, message)
+		self.keenmqtt.push_event.assert_called_once_with('home', decoded)
+		assert decoded['mqtt_topic'] == 'from payload'
+		assert 'timestamp' in decoded['keen']
+
+		# Hooks replaced on the instance take the original path.
+		mocker.patch.object(self.keenmqtt, 'process_topic', return_value=False)
+		self.keenmqtt.on_mqtt_message(None, None, message)
+		assert self.keenmqtt.push_event.call_count == 1
+
 	def test_start(self, mocker):
 		def dummy_start():
 			pass
@@ -115,6 +158,16 @@ class TestKeenMQTTMethods:
 		assert topic in self.keenmqtt.collection_mapping
 		assert self.keenmqtt.collection_mapping[topic] == collection
 
+	def test_add_malformed_collection_mapping(self):
+		"""Test that malformed subscriptions are refused before anything changes."""
+		for topic in ("a/#/b", "a+/b", "a/b#", ""):
+			with pytest.raises(ValueError):
+				self.keenmqtt.add_collection_mapping(topic, "test")
+		with pytest.raises(ValueError):
+			self.keenmqtt.add_collection_mapping("a/b", "test", qos=3)
+		assert self.keenmqtt.collection_mapping == {}
+		assert not self.keenmqtt.match_mapping("a/x/b")[0]
+
 	def test_decode_payload(self):
 		"""Test basic json object decoding."""
 		json_string = '{"test1": 120, "test2": "Hello World!", "test3":true, "test4":null}'
@@ -0,0 +1,132 @@
+import itertools
+import random
+import paho.mqtt.client as mqtt
+from keenmqtt import KeenMQTT
+from keenmqtt.matching import TopicTrie, TopicCache
+
+def linear_match(subscriptions, topic):
+	for sub, value in subscriptions:
+		if mqtt.topic_matches_sub(sub, topic):
+			return value
+	return None
+
+class TestTopicTrie:
+	"""Test the subscription index against paho's matching"""
+
+	def setup_method(self, _):
+		self.trie = TopicTrie()
+
+	def test_exact_and_wildcards(self):
+		self.trie.add('home/exact', 'exact')
+		self.trie.add('away/+', 'away')
+		self.trie.add('wayaway/#', 'wayaway')
+		assert self.trie.match('home/exact') == 'exact'
+		assert self.trie.match('away/nonexact') == 'away'
+		assert self.trie.match('away/non/exact') is None
+		assert self.trie.match('wayaway') == 'wayaway'
+		assert self.trie.match('wayaway/non/exact/test') == 'wayaway'
+		assert self.trie.match('home/sdfsdfdf', False) == False
+
+	def test_first_added_wins(self):
+		self.trie.add('home/#', 'all')
+		self.trie.add('home/exact', 'exact')
+		assert self.trie.match('home/exact') == 'all'
+		self.trie.add('home/#', 'replaced')
+		assert self.trie.match('home/exact') == 'replaced'
+
+	def test_system_topics(self):
+		self.trie.add('#', 'all')
+		self.trie.add('+/broker', 'plus')
+		assert self.trie.match('$SYS/broker') is None
+		self.trie.add('$SYS/#', 'sys')
+		assert self.trie.match('$SYS/broker') == 'sys'
+
+	def test_remove(self):
+		self.trie.add('a/+', 'plus')
+		self.trie.add('a/b', 'exact')
+		self.trie.remove('a/+')
+		assert 'a/+' not in self.trie
+		assert self.trie.match('a/c') is None
+		assert self.trie.match('a/b') == 'exact'
+		self.trie.remove('a/b')
+		self.trie.remove('missing')
+		assert len(self.trie) == 0
+		assert self.trie.match('a/b') is None
+
+	def test_matches_linear_scan(self):
+		rng = random.Random(1)
+		words = ['a', 'b', 'c', '']
+		def level(wildcards):
+			return rng.choice(words + wildcards)
+		subscriptions = []
+		for i in range(200):
+			depth = rng.randint(1, 4)
+			levels = [level(['+']) for _ in range(depth)]
+			if rng.random() < 0.3:
+				levels.append('#')
+			sub = '/'.join(levels)
+			if sub not in self.trie:
+				subscriptions.append((sub, i))
+				self.trie.add(sub, i)
+		for _ in range(1000):
+			topic = '/'.join(level(['$SYS']) for _ in range(rng.randint(1, 5)))
+			assert self.trie.match(topic) == linear_match(subscriptions, topic), topic
+
+	def test_covering(self):
+		for sub in ('home/#', 'home/+/temp', 'home/kitchen/temp', '#', '$SYS/#', 'away/+'):
+			self.trie.add(sub, sub)
+		assert sorted(self.trie.covering('home/kitchen/temp')) == ['#', 'home/#', 'home/+/temp']
+		assert sorted(self.trie.covering('home/+/temp')) == ['#', 'home/#']
+		assert self.trie.covering('home') == ['#', 'home/#']
+		assert self.trie.covering('away/#') == ['#']
+		assert self.trie.covering('#') == []
+		assert self.trie.covering('$SYS/broker') == ['$SYS/#']
+
+	def test_covering_matches_topics(self):
+		# One filter covers another when it matches every topic the other matches. Topics
+		# deeper than any filter without '#', and a word no filter uses, make this exact.
+		rng = random.Random(2)
+		words = ['a', 'b', '$SYS']
+		subscriptions = set()
+		while len(subscriptions) < 60:
+			levels = [rng.choice(words + ['+']) for _ in range(rng.randint(1, 3))]
+			if rng.random() < 0.3:
+				levels.append('#')
+			subscriptions.add('/'.join(levels))
+		topics = ['/'.join(levels) for depth in range(1, 6)
+			for levels in itertools.product(words + ['z'], repeat=depth)]
+		matched = dict((sub, set(t for t in topics if mqtt.topic_matches_sub(sub, t))) for sub in subscriptions)
+		for sub in subscriptions:
+			self.trie.add(sub, sub)
+		for sub in subscriptions:
+			expected = sorted(other for other in subscriptions if other != sub and matched[sub] <= matched[other])
+			assert sorted(self.trie.covering(sub)) == expected, sub
+
+class TestTopicCache:
+	"""Test the LRU cache of topic lookups"""
+
+	def test_lru_eviction(self):
+		cache = TopicCache(2)
+		cache.put('a', 1)
+		cache.put('b', False)
+		assert cache.get('a') == 1
+		cache.put('c', 3)
+		assert cache.get('b', 'miss') == 'miss'
+		assert cache.get('a') == 1
+		assert cache.get('c') == 3
+		assert cache.stats() == {'size': 2, 'maxsize': 2, 'hits': 3, 'misses': 1, 'evictions': 1}
+
+	def test_disabled(self):
+		cache = TopicCache(0)
+		cache.put('a', 1)
+		assert len(cache) == 0
+
+	def test_process_collection_invalidation(self):
+		keenmqtt = KeenMQTT()
+		keenmqtt.add_collection_mapping('home/+', 'home')
+		assert keenmqtt.process_collection('away/x', {}) == False
+		assert keenmqtt.process_collection('away/x', {}) == False
+		assert keenmqtt.collection_cache.hits == 1
+		keenmqtt.add_collection_mapping('away/#', 'away')
+		assert keenmqtt.process_collection('away/x', {}) == 'away'
+		assert keenmqtt.process_collection('home/x', {}) == 'home'
@@ -0,0 +1,64 @@
+import threading
+import keen
+import pytest
+from keenmqtt import KeenMQTT
+from keenmqtt.pool import HTTPPool
+from benchmarks.keen_server import FakeKeenServer
+
+class Struct:
+	pass
+
+@pytest.fixture
+def server():
+	server = FakeKeenServer(write_key='secret').start()
+	yield server
+	server.stop()
+
+class TestHTTPPool:
+	"""Test the shared keep-alive connection pool"""
+
+	def test_connections_are_reused(self, server):
+		client = keen.KeenClient(project_id='project', write_key='secret', base_url=server.base_url)
+		pool = HTTPPool(pool_size=2, connect_timeout=1, read_timeout=2)
+		pool.attach(client)
+		assert client.api.post_timeout == (1, 2)
+		for i in range(5):
+			client.add_events({'c': [{'v': i}]})
+		assert server.event_count() == 5
+		assert server.connections == 1
+		assert pool.stats() == {'size': 2, 'requests': 5, 'connections_opened': 1, 'connections_reused': 4}
+		pool.close()
+
+	def test_pool_size_bounds_connections(self, server):
+		server.latency = 0.02
+		client = keen.KeenClient(project_id='project', write_key='secret', base_url=server.base_url)
+		pool = HTTPPool(pool_size=3)
+		pool.attach(client)
+
+		def upload():
+			for i in range(5):
+				client.add_events({'c': [{'v': i}]})
+
+		threads = [threading.Thread(target=upload) for i in range(6)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		assert server.event_count() == 30
+		assert server.connections <= 3
+		assert pool.stats()['connections_reused'] >= 27
+		pool.close()
+
+	def test_relay_uses_pool(self, server, mocker):
+		keenmqtt = KeenMQTT()
+		keenmqtt.setup(mqtt_client=mocker.Mock(), settings={
+			'keen': {'project_id': 'project', 'write_key': 'secret', 'base_url': server.base_url},
+			'http_pool': {'pool_size': 4, 'read_timeout': 10},
+		})
+		assert keenmqtt.keen_client.api.session is keenmqtt.http_pool.session
+		assert keenmqtt.keen_client.api.post_timeout == (5.0, 10.0)
+		keenmqtt.push_event('c', {'v': 1})
+		keenmqtt.push_event('c', {'v': 2})
+		stats = keenmqtt.get_stats()
+		assert stats['http_pool'] == {'size': 4, 'requests': 2, 'connections_opened': 1, 'connections_reused': 1}
+		assert stats['counters']['events_uploaded'] == 2
@@ -0,0 +1,132 @@
+import os
+import pytest
+from keenmqtt import KeenMQTT
+from keenmqtt.recording import Recorder, Replayer, read_log, segment_paths
+from benchmarks.bench_relay import main as bench_relay
+
+class Struct:
+	pass
+
+def message(topic, payload, qos=0, retain=False):
+	mqtt_message = Struct()
+	mqtt_message.topic = topic
+	mqtt_message.payload = payload
+	mqtt_message.qos = qos
+	mqtt_message.retain = retain
+	return mqtt_message
+
+class TestRecording:
+	"""Test recording traffic to a binary log and replaying it"""
+
+	def test_round_trip(self, tmpdir):
+		directory = str(tmpdir.join('log'))
+		recorder = Recorder(directory)
+		recorder.record('a/1', b'{"v": 1}', 0, False, 100.25)
+		recorder.record('a/2', b'', 1, True, 100.5)
+		recorder.record('a/1', b'\x00\xff', 2, False, 101.0)
+		recorder.close()
+		messages = list(read_log(directory))
+		assert [(m.topic, m.payload, m.qos, m.retain, m.timestamp) for m in messages] == [
+			('a/1', b'{"v": 1}', 0, False, 100.25),
+			('a/2', b'', 1, True, 100.5),
+			('a/1', b'\x00\xff', 2, False, 101.0),
+		]
+		# The repeated topic is written once: a 5 byte header, 2 topic records and 3 messages.
+		size = 5 + 2 * (7 + 3) + 3 * 18 + 8 + 0 + 2
+		assert os.path.getsize(segment_paths(directory)[0]) == size
+		assert recorder.stats() == {'messages': 3, 'bytes': size - 5, 'rotations': 0, 'segments': 1}
+
+	def test_rotation(self, tmpdir):
+		directory = str(tmpdir.join('log'))
+		recorder = Recorder(directory, segment_size=100, max_segments=3)
+		for i in range(20):
+			recorder.record('a/{}'.format(i % 2), str(i).encode(), now=i)
+		recorder.close()
+		segments = segment_paths(directory)
+		assert len(segments) == 3
+		assert recorder.stats()['rotations'] > 3
+		# Every segment repeats the topics it uses, so the oldest can be deleted.
+		payloads = [int(m.payload) for m in read_log(directory)]
+		assert payloads == list(range(payloads[0], 20))
+		assert list(read_log(segments[-1]))[-1].topic == 'a/1'
+
+		# A new recorder carries on after the existing segments.
+		recorder = Recorder(directory, segment_size=100, max_segments=3)
+		recorder.record('b', b'20', now=20)
+		recorder.close()
+		assert segment_paths(directory)[-1] > segments[-1]
+		assert list(read_log(directory))[-1].topic == 'b'
+
+	def test_torn_record(self, tmpdir):
+		directory = str(tmpdir.join('log'))
+		recorder = Recorder(directory)
+		recorder.record('a', b'12345', now=1)
+		recorder.record('a', b'67890', now=2)
+		recorder.close()
+		path = segment_paths(directory)[0]
+		with open(path, 'rb+') as segment:
+			segment.truncate(os.path.getsize(path) - 3)
+		assert [m.payload for m in read_log(directory)] == [b'12345']
+		with open(path, 'wb') as segment:
+			segment.write(b'not a recording')
+		with pytest.raises(ValueError):
+			list(read_log(directory))
+
+	@pytest.mark.parametrize('stats', [True, False])
+	def test_relay(self, mocker, tmpdir, stats):
+		directory = str(tmpdir.join('log'))
+		settings = {'collection_mappings': {'a/#': 'a'}, 'dedup': {}, 'recording': {'directory': directory}}
+		if not stats:
+			settings['stats'] = {'enabled': False}
+		relay = KeenMQTT()
+		relay.setup(mqtt_client=mocker.Mock(), keen_client=mocker.Mock(), settings=settings)
+		mocker.patch.object(relay, 'push_event')
+		for payload in (b'{"v": 1}', b'{"v": 1}', b'not json'):
+			relay.on_mqtt_message(None, None, message('a/1', payload, 1, True))
+		assert relay.get_stats()['recording']['messages'] == 3
+		relay.stop()
+		# Duplicates and undecodable payloads are recorded as they arrived.
+		recorded = list(read_log(directory))
+		assert [(m.payload, m.qos, m.retain) for m in recorded] == [
+			(b'{"v": 1}', 1, True), (b'{"v": 1}', 1, True), (b'not json', 1, True)]
+
+		replayed = KeenMQTT()
+		replayed.setup(mqtt_client=mocker.Mock(), keen_client=mocker.Mock(), settings={'collection_mappings': {'a/#': 'a'}})
+		mocker.patch.object(replayed, 'push_event')
+		result = Replayer(replayed, directory, speed=0).run()
+		assert result['messages'] == 3
+		assert replayed.push_event.call_count == 2
+
+	def test_pace(self, mocker, tmpdir):
+		directory = str(tmpdir.join('log'))
+		recorder = Recorder(directory)
+		for i in range(5):
+			recorder.record('a', b'{}', now=1000 + i * 0.1)
+		recorder.close()
+		relay = mocker.Mock()
+		clock = [0.0]
+		mocker.patch('keenmqtt.recording.time.time', side_effect=lambda: clock[0])
+		replayer = Replayer(relay, directory, speed=2)
+		waits = []
+
+		def wait(delay):
+			waits.append(delay)
+			clock[0] += delay
+			return False
+		mocker.patch.object(replayer._stopping, 'wait', side_effect=wait)
+		assert replayer.run()['messages'] == 5
+		assert waits == pytest.approx([0.05] * 4)
+		assert relay.on_mqtt_message.call_count == 5
+		with pytest.raises(ValueError):
+			Replayer(relay, directory, speed=-1)
+
+	def test_benchmark(self, tmpdir, capsys):
+		directory = str(tmpdir.join('log'))
+		recorder = Recorder(directory)
+		for i in range(200):
+			recorder.record('home/{}'.format(i % 7), '{{"v": {}}}'.format(i).encode())
+		recorder.close()
+		result = bench_relay(['--replay', directory, '--replay-messages', '150', '--alloc-messages', '0'])
+		assert result['messages'] == 150
+		assert result['stages']['push']['calls'] == 150
+		assert capsys.readouterr().out.startswith('replay: 150 messages')
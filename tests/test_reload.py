@@ -0,0 +1,129 @@
+import threading
+import pytest
+import yaml
+from keenmqtt import KeenMQTT
+from keenmqtt.app import ConfigReloader
+
+class Struct:
+	pass
+
+def message(topic, payload):
+	mqtt_message = Struct()
+	mqtt_message.topic = topic
+	mqtt_message.payload = payload
+	mqtt_message.qos = 0
+	mqtt_message.retain = False
+	return mqtt_message
+
+MAPPINGS = {
+	'a/#': 'a',
+	'b/+': {'collection': 'b', 'rollup': {'window': 3600}},
+	'c/#': 'c',
+}
+
+def relay(mocker, stats=True):
+	settings = {'collection_mappings': MAPPINGS}
+	if not stats:
+		settings['stats'] = {'enabled': False}
+	keenmqtt = KeenMQTT()
+	mqtt_client = mocker.Mock()
+	mqtt_client.subscribe.return_value = (0, 1)
+	keenmqtt.setup(mqtt_client=mqtt_client, keen_client=mocker.Mock(), settings=settings)
+	keenmqtt.on_mqtt_connect(None, None, None, 0)
+	mocker.patch.object(keenmqtt, 'push_event')
+	return keenmqtt
+
+class TestReload:
+	"""Test replacing the collection mappings of a running relay"""
+
+	@pytest.mark.parametrize('stats', [True, False])
+	def test_reload_mappings(self, mocker, stats):
+		keenmqtt = relay(mocker, stats)
+		keenmqtt.on_mqtt_message(None, None, message('b/1', b'{"v": 1}'))
+		kept = keenmqtt.match_mapping('a/1')
+		mappings = dict(MAPPINGS, **{'b/+': {'collection': 'b', 'rollup': {'window': 60}}, 'd/#': 'd'})
+		del mappings['c/#']
+		assert keenmqtt.reload_collection_mappings(mappings) == (['d/#'], ['c/#'])
+		keenmqtt.mqtt_client.unsubscribe.assert_called_once_with(['c/#'])
+		keenmqtt.mqtt_client.subscribe.assert_called_with([('d/#', 0)])
+		assert keenmqtt.collection_mapping == {'a/#': 'a', 'b/+': 'b', 'd/#': 'd'}
+		# Unchanged mappings keep their state, the changed rollup pushed its open window.
+		assert keenmqtt.match_mapping('a/1') is kept
+		assert keenmqtt.push_event.call_count == 1
+		assert keenmqtt.push_event.call_args[0][1]['v']['count'] == 1
+		assert list(keenmqtt.rollups) == ['b/+']
+		assert keenmqtt.rollups['b/+'].window == 60
+
+		keenmqtt.push_event.reset_mock()
+		for topic in ('c/1', 'd/1', 'a/1'):
+			keenmqtt.on_mqtt_message(None, None, message(topic, b'{"v": 1}'))
+		assert [c[0][0] for c in keenmqtt.push_event.call_args_list] == ['d', 'a']
+
+		# Nothing changes, nothing is sent.
+		keenmqtt.mqtt_client.reset_mock()
+		assert keenmqtt.reload_collection_mappings(mappings) == ([], [])
+		assert not keenmqtt.mqtt_client.subscribe.called
+		assert not keenmqtt.mqtt_client.unsubscribe.called
+
+	def test_reload_invalid(self, mocker):
+		keenmqtt = relay(mocker)
+		for mappings in ({'a/#/b': 'a'}, {'b/+': {'collection': 'b', 'rollup': {'window': 0}}}):
+			with pytest.raises(ValueError):
+				keenmqtt.reload_collection_mappings(mappings)
+		assert keenmqtt.collection_mapping == {'a/#': 'a', 'b/+': 'b', 'c/#': 'c'}
+		assert not keenmqtt.mqtt_client.unsubscribe.called
+
+	def test_in_flight(self, mocker):
+		keenmqtt = relay(mocker)
+		pushing = threading.Event()
+		release = threading.Event()
+
+		def push_event(collection, event):
+			pushing.set()
+			release.wait(5)
+		keenmqtt.push_event.side_effect = push_event
+		receiving = threading.Thread(target=keenmqtt.on_mqtt_message, args=(None, None, message('c/1', b'{}')))
+		receiving.start()
+		assert pushing.wait(5)
+		reloading = threading.Thread(target=keenmqtt.reload_collection_mappings, args=({'a/#': 'a'},))
+		reloading.start()
+		# The reload waits for the message to be handled by the old mappings.
+		reloading.join(0.2)
+		assert reloading.is_alive()
+		assert keenmqtt.collection_mapping == {'a/#': 'a', 'b/+': 'b', 'c/#': 'c'}
+		release.set()
+		receiving.join(5)
+		reloading.join(5)
+		assert keenmqtt.push_event.call_args[0][0] == 'c'
+		assert keenmqtt.collection_mapping == {'a/#': 'a'}
+
+	def test_config_reloader(self, mocker, tmpdir, caplog):
+		path = str(tmpdir.join('config.yaml'))
+		config = {'mqtt': {'host': 'localhost', 'port': 1883}, 'collection_mappings': {'a/#': 'a'}}
+		with open(path, 'w') as config_file:
+			yaml.safe_dump(config, config_file)
+		apply = mocker.Mock()
+		reloader = ConfigReloader(path, config, apply, watch=True)
+		assert not reloader.wait(0)
+
+		with open(path, 'w') as config_file:
+			yaml.safe_dump(dict(config, collection_mappings={'a/#': 'a', 'bb/#': 'b'}, dedup={}), config_file)
+		assert reloader.wait(0)
+		apply.assert_called_once_with({'a/#': 'a', 'bb/#': 'b'})
+		assert 'Restart to apply the changes to dedup' in caplog.text
+		assert not reloader.wait(0)
+
+		with open(path, 'w') as config_file:
+			yaml.safe_dump(dict(config, collection_mappings={'a/#/b': 'a'}), config_file)
+		assert not reloader.wait(0)
+		assert apply.call_count == 1
+
+		# Without watching, only a request reloads.
+		reloader = ConfigReloader(path, config, apply)
+		with open(path, 'w') as config_file:
+			yaml.safe_dump(config, config_file)
+		assert not reloader.wait(0)
+		reloader.request()
+		assert reloader.wait(0)
+		assert apply.call_count == 2
+		assert reloader.reloads == 1
@@ -0,0 +1,128 @@
+import math
+import pytest
+from keenmqtt import KeenMQTT
+from keenmqtt import rollups
+from keenmqtt.rollups import Rollup, summarise
+from keenmqtt.timestamps import Timestamper
+from array import array
+
+class Struct:
+	pass
+
+def message(topic, payload):
+	mqtt_message = Struct()
+	mqtt_message.topic = topic
+	mqtt_message.payload = payload
+	return mqtt_message
+
+def event(seconds, **fields):
+	fields['keen'] = {'timestamp': Timestamper().format(seconds)}
+	return fields
+
+class TestRollups:
+	"""Test the windowed rollups of numeric fields"""
+
+	def test_summarise(self, mocker):
+		mocker.patch.object(rollups, 'numpy', None)
+		summary = summarise(array('d', [2.0, 4.0, 4.0, 4.0, 5.0, 5.0, 7.0, 9.0]))
+		assert summary == {'count': 8, 'min': 2.0, 'max': 9.0, 'mean': 5.0, 'last': 9.0, 'stddev': 2.0}
+		assert summarise(array('d', [1.0]), ('count', 'last')) == {'count': 1, 'last': 1.0}
+
+	def test_summarise_numpy(self, mocker):
+		pytest.importorskip('numpy')
+		values = array('d', [1.5, -2.0, 8.25, 3.0])
+		summary = summarise(values)
+		mocker.patch.object(rollups, 'numpy', None)
+		expected = summarise(values)
+		for name in expected:
+			assert math.isclose(summary[name], expected[name])
+
+	def test_windows(self):
+		emitted = []
+		rollup = Rollup('power', lambda collection, event: emitted.append((collection, event)), window=10,
+			statistics=('count', 'mean', 'last'))
+		for seconds, watts in ((1000.5, 10), (1003, 20.5), (1009.9, 30), (1001, 99), (1010, 5)):
+			rollup.add('meter/1', event(seconds, watts=watts, state='on', ok=True))
+		rollup.add('meter/2', event(1002, volts=230))
+		assert len(emitted) == 1
+		collection, summary = emitted[0]
+		assert collection == 'power'
+		assert summary == {
+			'mqtt_topic': 'meter/1',
+			'window_start': '1970-01-01T00:16:40.000000+00:00',
+			'window_end': '1970-01-01T00:16:50.000000+00:00',
+			'keen': {'timestamp': '1970-01-01T00:16:40.000000+00:00'},
+			'watts': {'count': 4, 'mean': 39.875, 'last': 99.0},
+		}
+		# A window closes once it has ended, and grace has passed.
+		assert rollup.close_expired(now=1010.5) == 0
+		assert rollup.close_expired(now=1011) == 1
+		assert emitted[1][1]['volts']['count'] == 1
+		rollup.add('meter/1', event(1005, watts=1))
+		rollup.close_all()
+		assert emitted[2][1]['watts'] == {'count': 1, 'mean': 5.0, 'last': 5.0}
+		assert rollup.stats() == {'events': 6, 'late': 1, 'unparsed': 0, 'windows': 3, 'open': 0}
+
+	def test_other_timestamps(self, mocker):
+		emitted = []
+		rollup = Rollup('power', lambda collection, event: emitted.append(event), window=10)
+		mocker.patch.object(rollups.time, 'time', return_value=2005.0)
+		rollup.add('a', {'watts': 1, 'keen': {'timestamp': 1001}})
+		rollup.add('b', {'watts': 2, 'keen': {'timestamp': 'yesterday'}})
+		rollup.add('b', {'watts': 3, 'keen': {'timestamp': ['not', 'a', 'time']}})
+		rollup.close_all()
+		windows = dict((summary['mqtt_topic'], summary) for summary in emitted)
+		assert windows['a']['window_start'] == '1970-01-01T00:16:40.000000+00:00'
+		# Timestamps which cannot be read fall back to the time the event was added.
+		assert windows['b']['window_start'] == '1970-01-01T00:33:20.000000+00:00'
+		assert windows['b']['watts']['count'] == 2
+		assert rollup.stats()['unparsed'] == 2
+
+	def test_fields_and_max_topics(self):
+		emitted = []
+		rollup = Rollup('power', lambda collection, event: emitted.append(event), fields=['watts'], max_topics=2)
+		for topic in ('a', 'b', 'c'):
+			rollup.add(topic, event(0, watts=1, volts=230))
+		assert [summary['mqtt_topic'] for summary in emitted] == ['a']
+		assert 'volts' not in emitted[0]
+
+	def test_bad_settings(self):
+		assert Rollup.from_settings('c', None, None) is None
+		with pytest.raises(ValueError):
+			Rollup('c', None, window=0)
+		with pytest.raises(ValueError):
+			Rollup('c', None, statistics=['median'])
+
+	@pytest.mark.parametrize('stats', [True, False])
+	def test_relay(self, mocker, stats):
+		settings = {'collection_mappings': {
+			'meters/+/power': {'collection': 'power', 'rollup': {'window': 60, 'statistics': ['count', 'max']}},
+			'meters/#': 'meters',
+		}}
+		if not stats:
+			settings['stats'] = {'enabled': False}
+		relay = KeenMQTT()
+		relay.setup(mqtt_client=mocker.Mock(), keen_client=mocker.Mock(), settings=settings)
+		mocker.patch.object(relay, 'push_event')
+		times = iter([120.0, 130.0, 185.0, 190.0])
+		mocker.patch.object(relay, 'get_time', side_effect=lambda topic, message: relay.timestamper.format(next(times)))
+		for watts in (10, 40, 30):
+			relay.on_mqtt_message(None, None, message('meters/1/power', '{{"watts": {}}}'.format(watts).encode()))
+		relay.on_mqtt_message(None, None, message('meters/1/status', b'{"on": true}'))
+		relay.stop()
+		events = [call[0] for call in relay.push_event.call_args_list]
+		assert [collection for collection, event in events] == ['power', 'meters', 'power']
+		assert events[0][1]['watts'] == {'count': 2, 'max': 40.0}
+		assert events[2][1]['watts'] == {'count': 1, 'max': 30.0}
+		assert relay.get_stats()['rollups']['windows'] == 2
+
+		if stats:
+			assert relay.stats.counters['events_rolled_up'] == 3
+
+		# A subclass timestamping events some other way still has its messages relayed.
+		relay.push_event.reset_mock()
+		relay.get_time = lambda topic, message: 'sometime'
+		relay.on_mqtt_message(None, None, message('meters/1/power', b'{"watts": 5}'))
+		relay.close_rollups(expired_only=False)
+		assert relay.push_event.call_args[0][1]['watts'] == {'count': 1, 'max': 5.0}
+		assert relay.get_stats()['rollups']['unparsed'] == 1
@@ -0,0 +1,111 @@
+import os
+import queue
+import signal
+import time
+from keenmqtt import KeenMQTT
+from keenmqtt import sharding
+from keenmqtt.sharding import Supervisor, shared_subscription, topic_shard
+from keenmqtt.stats import Stats, merge_stats
+
+class Struct:
+	pass
+
+def crashing_worker(settings, index, count, mode, group, stats_queue, stop_event, reload_queue=None):
+	stats_queue.put((index, {'enabled': True, 'counters': {'messages_received': 1}}))
+	raise SystemExit(1)
+
+def stopping_worker(settings, index, count, mode, group, stats_queue, stop_event, reload_queue=None):
+	stop_event.wait(10)
+	# More than a pipe holds, so the worker cannot exit until the supervisor reads it.
+	stats_queue.put((index, {'enabled': True, 'counters': dict(('c{}'.format(i), 1) for i in range(20000))}))
+
+class TestSharding:
+	"""Test splitting messages between relay processes"""
+
+	def test_topic_shard(self):
+		shards = [topic_shard('home/sensor{}'.format(i), 4) for i in range(100)]
+		assert shards == [topic_shard('home/sensor{}'.format(i), 4) for i in range(100)]
+		assert set(shards) == set([0, 1, 2, 3])
+
+	def test_shared_subscriptions(self, mocker):
+		keenmqtt = KeenMQTT()
+		keenmqtt.mqtt_client = mocker.Mock()
+		keenmqtt.mqtt_client.subscribe.return_value = (0, 1)
+		keenmqtt.setup_sharding(0, 2, 'shared', 'relays')
+		keenmqtt.add_collection_mapping('home/+', 'home')
+		keenmqtt.register_subscriptions()
+		keenmqtt.mqtt_client.subscribe.assert_called_once_with([('$share/relays/home/+', 0)])
+		assert shared_subscription('a/#', 'g') == '$share/g/a/#'
+
+	def test_hash_partition(self, mocker):
+		relays = []
+		for index in range(3):
+			keenmqtt = KeenMQTT()
+			keenmqtt.setup_sharding(index, 3, 'hash')
+			keenmqtt.add_collection_mapping('home/+', 'home')
+			mocker.patch.object(keenmqtt, 'push_event')
+			relays.append(keenmqtt)
+		for i in range(30):
+			mqtt_message = Struct()
+			mqtt_message.topic = 'home/sensor{}'.format(i)
+			mqtt_message.payload = b'{}'
+			for keenmqtt in relays:
+				keenmqtt.on_mqtt_message(None, None, mqtt_message)
+		counts = [keenmqtt.push_event.call_count for keenmqtt in relays]
+		assert sum(counts) == 30
+		assert all(counts)
+
+	def test_merge_stats(self):
+		first, second = Stats(sample_every=1), Stats(sample_every=1)
+		first.record_decode(0.001, 1)
+		second.record_decode(0.002, 2)
+		second.record_event('col', 'events_pushed', 0, 1, 2, 3, 4, 5)
+		merged = merge_stats([dict(first.snapshot(), spool={'bytes': 10}), dict(second.snapshot(), spool={'bytes': 5})])
+		assert merged['counters']['records_decoded'] == 3
+		assert merged['stages']['decode']['count'] == 2
+		assert merged['collections']['col']['counters']['events_pushed'] == 1
+		assert merged['spool'] == {'bytes': 15}
+
+	def test_supervisor_restarts_workers(self, mocker):
+		mocker.patch.object(sharding, 'run_worker', crashing_worker)
+		supervisor = Supervisor({}, 2, restart_delay=0)
+		supervisor.start()
+		deadline = time.time() + 10
+		while supervisor.restarts < 2 and time.time() < deadline:
+			time.sleep(0.05)
+			supervisor.check()
+		supervisor.stop()
+		assert supervisor.restarts >= 2
+		stats = supervisor.get_stats()
+		assert stats['counters']['messages_received'] >= 3
+		assert stats['supervisor']['workers'] == 2
+
+	def test_supervisor_terminated(self, mocker):
+		mocker.patch.object(sharding, 'run_worker', stopping_worker)
+		supervisor = Supervisor({}, 2)
+
+		def wait(interval):
+			os.kill(os.getpid(), signal.SIGTERM)
+			time.sleep(0.1)
+		previous = signal.getsignal(signal.SIGTERM)
+		start = time.time()
+		supervisor.run(wait=wait)
+		assert time.time() - start < 10
+		assert signal.getsignal(signal.SIGTERM) == previous
+		assert [process.exitcode for process in supervisor._processes] == [0, 0]
+		assert supervisor.get_stats()['counters']['c0'] == 2
+
+	def test_reload_workers(self, mocker):
+		supervisor = Supervisor({'collection_mappings': {'a/#': 'a'}}, 2)
+		supervisor.reload_collection_mappings({'b/#': 'b'})
+		assert supervisor.settings['collection_mappings'] == {'b/#': 'b'}
+		assert supervisor._reload_queues[1].get(timeout=5) == {'b/#': 'b'}
+
+		relay = mocker.Mock()
+		relay.reload_collection_mappings.side_effect = [ValueError('bad'), None]
+		reload_queue = queue.Queue()
+		reload_queue.put({'c/#': {}})
+		reload_queue.put({'c/#': 'c'})
+		sharding._reload_worker(relay, 0, reload_queue)
+		assert relay.reload_collection_mappings.call_count == 2
+		assert reload_queue.empty()
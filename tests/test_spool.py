@@ -0,0 +1,103 @@
+import os
+import pytest
+from keenmqtt import KeenMQTT
+from keenmqtt.spool import Spool, SpoolReplayer
+
+class TestSpool:
+	"""Test the on-disk event spool"""
+
+	def test_append_and_replay(self, tmpdir):
+		spool = Spool(str(tmpdir), segment_size=100)
+		for i in range(10):
+			assert spool.append({'a': [{'v': i}]})
+		assert len(os.listdir(str(tmpdir))) > 1
+		batches = []
+		assert spool.replay(batches.append, max_events=4) == 10
+		assert [len(batch['a']) for batch in batches][:2] == [4, 4]
+		assert [event['v'] for batch in batches for event in batch['a']] == list(range(10))
+		assert spool.size() == 0
+		assert os.listdir(str(tmpdir)) == []
+
+	def test_torn_tail_and_resync(self, tmpdir):
+		spool = Spool(str(tmpdir))
+		spool.append({'a': [{'v': 1}]})
+		spool.append({'a': [{'v': 2}]})
+		spool.close()
+		path = os.path.join(str(tmpdir), os.listdir(str(tmpdir))[0])
+		with open(path, 'rb') as segment:
+			data = segment.read()
+		# Corrupt the first record and tear the end of a third one.
+		data = data[:12] + b'X' + data[13:] + data[:15]
+		with open(path, 'wb') as segment:
+			segment.write(data)
+		assert list(Spool.read_segment(path)) == [{'a': [{'v': 2}]}]
+
+	def test_reopen_replays_previous_segments(self, tmpdir):
+		spool = Spool(str(tmpdir))
+		spool.append({'a': [{'v': 1}]})
+		spool.close()
+		spool = Spool(str(tmpdir))
+		spool.append({'b': [{'v': 2}]})
+		batches = []
+		spool.replay(batches.append)
+		assert batches == [{'a': [{'v': 1}]}, {'b': [{'v': 2}]}]
+
+	def test_stray_files_are_ignored(self, tmpdir, caplog):
+		tmpdir.join('backup.spool').write(b'not a segment')
+		tmpdir.join('notes.txt').write(b'')
+		spool = Spool(str(tmpdir))
+		assert 'Ignoring backup.spool' in caplog.text
+		spool.append({'a': [{'v': 1}]})
+		batches = []
+		assert spool.replay(batches.append) == 1
+		assert sorted(os.listdir(str(tmpdir))) == ['backup.spool', 'notes.txt']
+
+	def test_failed_replay_keeps_segment(self, tmpdir):
+		spool = Spool(str(tmpdir))
+		spool.append({'a': [{'v': 1}]})
+		def fail(events):
+			raise IOError()
+		with pytest.raises(IOError):
+			spool.replay(fail)
+		assert SpoolReplayer(spool, fail).replay_once() == 0
+		batches = []
+		spool.replay(batches.append)
+		assert batches == [{'a': [{'v': 1}]}]
+
+	def test_drop_newest(self, tmpdir):
+		spool = Spool(str(tmpdir), max_bytes=40, drop_policy='drop-newest')
+		assert spool.append({'a': [{'v': 1}]})
+		assert not spool.append({'a': [{'v': 2}]})
+		assert spool.dropped_batches == 1
+		batches = []
+		spool.replay(batches.append)
+		assert batches == [{'a': [{'v': 1}]}]
+
+	def test_drop_oldest(self, tmpdir):
+		spool = Spool(str(tmpdir), segment_size=1, max_bytes=40, drop_policy='drop-oldest')
+		assert spool.append({'a': [{'v': 1}]})
+		assert spool.append({'a': [{'v': 2}]})
+		assert spool.dropped_segments == 1
+		assert spool.size() <= 40
+		batches = []
+		spool.replay(batches.append)
+		assert batches == [{'a': [{'v': 2}]}]
+
+	def test_bad_policy(self, tmpdir):
+		with pytest.raises(ValueError):
+			Spool(str(tmpdir), drop_policy='nope')
+
+class TestKeenMQTTSpool:
+	"""Test the KeenMQTT integration of the spool"""
+
+	def test_failed_upload_is_spooled(self, tmpdir, mocker):
+		keenmqtt = KeenMQTT()
+		keenmqtt.ready = True
+		keenmqtt.keen_client = mocker.Mock()
+		keenmqtt.keen_client.add_events.side_effect = IOError()
+		keenmqtt.setup_spool({'directory': str(tmpdir), 'replay_interval': 60})
+		keenmqtt.push_event('a', {'v': 1})
+		keenmqtt.keen_client.add_events.side_effect = None
+		assert keenmqtt.spool_replayer.replay_once() == 1
+		keenmqtt.keen_client.add_events.assert_called_with({'a': [{'v': 1}]})
+		keenmqtt.spool_replayer.stop()
@@ -0,0 +1,64 @@
+from click.testing import CliRunner
+import yaml
+from keenmqtt.app import main, check_config
+from benchmarks.bench_startup import CASES, heavy_imports, startup_time
+
+# The most a command may add to the start of a bare interpreter. Importing keen and paho
+# eagerly, as the package once did, takes longer than this on its own.
+STARTUP_BUDGET = 0.25
+
+class TestStartup:
+	"""Test that starting the relay stays quick"""
+
+	def test_heavy_imports(self, tmpdir):
+		config = str(tmpdir.join('config.yaml'))
+		with open(config, 'w') as config_file:
+			yaml.safe_dump({'mqtt': {'host': 'localhost', 'port': 1883}}, config_file)
+		for name, code in CASES:
+			imported = heavy_imports(code.format(config=config))
+			if name == 'keenmqtt check-config':
+				assert imported == ['yaml']
+			else:
+				assert imported == [], name
+
+	def test_startup_time(self):
+		baseline = min(startup_time('pass', 1) for _ in range(3))
+		code = dict(CASES)['keenmqtt --help']
+		elapsed = min(startup_time(code, 1) for _ in range(3))
+		assert elapsed - baseline < STARTUP_BUDGET
+
+	def test_check_config(self, tmpdir):
+		assert check_config({'mqtt': {'host': 'localhost', 'port': 1883}, 'spool': {'directory': 'x'},
+			'collection_mappings': {'a/#': 'a', 'b/+': {'collection': 'b', 'rollup': {'window': 10}}}}) == []
+		assert check_config([]) == ["The config file must hold a mapping of settings"]
+		problems = check_config({
+			'mqtt': {'host': 'localhost'},
+			'keen': {'write_key': 'k'},
+			'collection_mappings': {'a/#/b': 'a', 'c/+': {'collection': 'c', 'rollup': {'window': 0}}},
+			'memory_budget': {'max_bytes': 100, 'policy': 'never'},
+			'recording': {},
+		})
+		assert problems == [
+			"mqtt: missing 'port'",
+			"keen: missing 'project_id'",
+			"memory_budget: Unknown memory budget policy 'never'",
+			"recording: missing 'directory'",
+			"collection_mappings: 'a/#/b': '#' must be the last level of the subscription 'a/#/b'",
+			"collection_mappings: 'c/+': A rollup window must be longer than 0 seconds, not 0.0",
+		]
+		assert not tmpdir.listdir()
+
+	def test_check_config_command(self, tmpdir):
+		config = str(tmpdir.join('config.yaml'))
+		with open(config, 'w') as config_file:
+			yaml.safe_dump({'mqtt': {'host': 'localhost', 'port': 1883}, 'batching': {'max_age': 'soon'}}, config_file)
+		result = CliRunner().invoke(main, ['-c', config, 'check-config'])
+		assert result.exit_code == 1
+		assert 'batching: could not convert' in result.output
+		with open(config, 'w') as config_file:
+			yaml.safe_dump({'mqtt': {'host': 'localhost', 'port': 1883}}, config_file)
+		result = CliRunner().invoke(main, ['-c', config, 'check-config'])
+		assert result.exit_code == 0
+		assert result.output == "{} is valid\n".format(config)
+		result = CliRunner().invoke(main, ['-c', str(tmpdir.join('missing.yaml')), 'check-config'])
+		assert result.exit_code == 2
@@ -0,0 +1,139 @@
+import json
+import pytest
+from keenmqtt import KeenMQTT
+from keenmqtt.stats import Histogram, Stats, StatsServer, format_prometheus
+
+try:
+	from urllib.request import urlopen
+except ImportError:
+	from urllib2 import urlopen
+
+class Struct:
+	pass
+
+def message(topic, payload):
+	mqtt_message = Struct()
+	mqtt_message.topic = topic
+	mqtt_message.payload = payload
+	return mqtt_message
+
+class TestStats:
+	"""Test the counters and histograms"""
+
+	def test_histogram(self):
+		histogram = Histogram()
+		for _ in range(99):
+			histogram.observe(0.000001)
+		histogram.observe(0.5)
+		assert histogram.count == 100
+		assert histogram.percentile(0.5) == 0.000001
+		assert 0.5 <= histogram.percentile(1.0) < 1.1
+		assert histogram.snapshot()['sum'] == pytest.approx(0.500099)
+
+	def test_counters(self):
+		stats = Stats(sample_every=1)
+		stats.incr('a')
+		stats.incr('a', 'col', 2)
+		stats.record_decode(0.001, 2)
+		stats.record_decode(0.001)
+		stats.record_event('col', 'events_pushed', 0, 1, 2, 3, 4, 5)
+		stats.record_event('col', 'dropped_by_topic', 0, 1, 2)
+		snapshot = stats.snapshot()
+		assert snapshot['counters'] == {'a': 3, 'messages_received': 2, 'messages_decoded': 1,
+			'records_decoded': 2, 'decode_failed': 1, 'events_pushed': 1, 'dropped_by_topic': 1}
+		assert snapshot['collections']['col']['counters'] == {'a': 2, 'events_pushed': 1, 'dropped_by_topic': 1}
+		assert snapshot['collections']['col']['latency']['count'] == 1
+		assert snapshot['collections']['col']['latency']['sum'] == 5
+		assert snapshot['stages']['decode']['count'] == 2
+		assert snapshot['stages']['topic']['count'] == 2
+		assert snapshot['stages']['push']['count'] == 1
+
+	def test_format_prometheus(self):
+		stats = Stats(sample_every=1)
+		stats.incr('events_pushed', 'col')
+		stats.record_decode(0.001, 1)
+		text = format_prometheus(dict(stats.snapshot(), collection_cache={'hits': 3}))
+		assert 'keenmqtt_events_pushed_total 1' in text
+		assert 'keenmqtt_collection_events_pushed_total{collection="col"} 1' in text
+		assert 'keenmqtt_stage_seconds_bucket{stage="decode",le="+Inf"} 1' in text
+		assert 'keenmqtt_stage_seconds_count{stage="decode"} 1' in text
+		assert 'keenmqtt_collection_cache_hits 3' in text
+		# Every series of a metric is labeled, or none is, so summing one never double counts.
+		labeled = {}
+		for line in text.splitlines():
+			if not line.startswith('#'):
+				name = line.split(' ')[0].split('{')[0]
+				assert labeled.setdefault(name, '{' in line) == ('{' in line), name
+
+class TestKeenMQTTStats:
+	"""Test the stats collected by the KeenMQTT pipeline"""
+
+	def setup_method(self, _):
+		self.keenmqtt = KeenMQTT()
+		self.keenmqtt.ready = True
+
+	def test_pipeline_counters(self, mocker):
+		self.keenmqtt.stats = Stats(sample_every=1)
+		self.keenmqtt.keen_client = mocker.Mock()
+		self.keenmqtt.add_collection_mapping('home/+', 'home')
+		mocker.patch.object(self.keenmqtt, 'process_payload', side_effect=lambda event, topic, message: 'drop' not in message)
+		self.keenmqtt.on_mqtt_message(None, None, message('home/a', '{"v": 1}'))
+		self.keenmqtt.on_mqtt_message(None, None, message('home/a', '{"drop": 1}'))
+		self.keenmqtt.on_mqtt_message(None, None, message('away/a', '{"v": 1}'))
+		self.keenmqtt.on_mqtt_message(None, None, message('home/a', 'not json'))
+		stats = self.keenmqtt.get_stats()
+		counters = stats['counters']
+		assert counters['messages_received'] == 4
+		assert counters['messages_decoded'] == 3
+		assert counters['decode_failed'] == 1
+		assert counters['dropped_no_collection'] == 1
+		assert counters['dropped_by_payload'] == 1
+		assert counters['events_pushed'] == 1
+		assert counters['events_uploaded'] == 1
+		assert stats['collections']['home']['counters']['events_pushed'] == 1
+		assert stats['stages']['push']['count'] == 1
+		assert stats['stages']['decode']['count'] == 4
+
+	def test_upload_errors(self, mocker):
+		self.keenmqtt.keen_client = mocker.Mock()
+		self.keenmqtt.keen_client.add_events.return_value = {'a': [{'success': True}, {'success': False}]}
+		self.keenmqtt.upload_events({'a': [{}, {}]})
+		self.keenmqtt.keen_client.add_events.side_effect = IOError()
+		with pytest.raises(IOError):
+			self.keenmqtt.upload_events({'a': [{}]})
+		counters = self.keenmqtt.get_stats()['counters']
+		assert counters['events_uploaded'] == 1
+		assert counters['events_rejected'] == 1
+		assert counters['upload_errors'] == 1
+		assert counters['events_failed'] == 1
+
+	def test_sampling(self, mocker):
+		self.keenmqtt.setup(mqtt_client=mocker.Mock(), keen_client=mocker.Mock(), settings={'stats': {'sample_every': 4}})
+		self.keenmqtt.add_collection_mapping('home/+', 'home')
+		for _ in range(8):
+			self.keenmqtt.on_mqtt_message(None, None, message('home/a', '{"v": 1}'))
+		stats = self.keenmqtt.get_stats()
+		assert stats['counters']['events_pushed'] == 8
+		assert stats['stages']['decode']['count'] == 2
+		assert stats['stages']['push']['count'] == 2
+
+	def test_disabled(self, mocker):
+		self.keenmqtt.setup(mqtt_client=mocker.Mock(), keen_client=mocker.Mock(), settings={'stats': {'enabled': False}})
+		assert self.keenmqtt.stats is None
+		self.keenmqtt.add_collection_mapping('home/+', 'home')
+		self.keenmqtt.on_mqtt_message(None, None, message('home/a', '{"v": 1}'))
+		stats = self.keenmqtt.get_stats()
+		assert stats['enabled'] == False
+		assert 'counters' not in stats
+
+	def test_stats_server(self):
+		self.keenmqtt.add_collection_mapping('home/+', 'home')
+		self.keenmqtt.process_collection('home/a', {})
+		server = StatsServer(self.keenmqtt.get_stats, port=0)
+		server.start()
+		try:
+			url = 'http://127.0.0.1:{}'.format(server.port)
+			assert b'keenmqtt_collection_cache_misses 1' in urlopen(url + '/metrics').read()
+			assert json.loads(urlopen(url + '/stats').read().decode('utf-8'))['collection_cache']['misses'] == 1
+		finally:
+			server.stop()
@@ -0,0 +1,109 @@
+import pytest
+from keenmqtt import KeenMQTT
+from keenmqtt.app import check_config
+from keenmqtt.subscriptions import Subscriber, consolidate, group_packets, check_qos
+from benchmarks.bench_subscribe import main as bench_subscribe
+
+def fake_client(mocker):
+	client = mocker.Mock()
+	mids = iter(range(1, 1000))
+	client.subscribe.side_effect = lambda packet: (0, next(mids))
+	return client
+
+class TestSubscriptions:
+	"""Test subscribing with few packets"""
+
+	def test_consolidate(self):
+		kept, skipped = consolidate([('home/a/+', 0), ('home/#', 1), ('home/b/+', 2), ('away', 0), ('$SYS/x', 0), ('#', 0)])
+		assert kept == [('home/#', 1), ('home/b/+', 2), ('$SYS/x', 0), ('#', 0)]
+		assert skipped == ['home/a/+', 'away']
+		with pytest.raises(ValueError):
+			check_qos(3)
+
+	def test_group_packets(self):
+		filters = [('a' * 10, 0)] * 5
+		# 7 bytes of header and packet id, and 13 bytes a filter.
+		assert [len(p) for p in group_packets(filters, max_packet_size=7 + 13 * 2)] == [2, 2, 1]
+		assert [len(p) for p in group_packets(filters, max_packet_size=0, max_filters=3)] == [3, 2]
+		assert [len(p) for p in group_packets(filters, max_packet_size=10)] == [1] * 5
+		assert group_packets(['a', 'b'], per_filter=2) == [['a', 'b']]
+
+	def test_update(self, mocker):
+		client = fake_client(mocker)
+		subscriber = Subscriber(max_filters=2)
+		subscriber.subscribe_all(client, [('a/+', 0), ('a/b', 0), ('c', 0), ('d', 0), ('e', 0)])
+		assert [c[0][0] for c in client.subscribe.call_args_list] == [[('a/+', 0), ('c', 0)], [('d', 0), ('e', 0)]]
+		assert subscriber.stats()['skipped'] == 1
+
+		client.reset_mock()
+		subscriber.update(client, [('a/+', 0), ('c', 1), ('f/#', 0), ('f/g', 0)])
+		client.subscribe.assert_called_once_with([('c', 1), ('f/#', 0)])
+		client.unsubscribe.assert_called_once_with(['d', 'e'])
+		assert subscriber.subscribed == {'a/+': 0, 'c': 1, 'f/#': 0}
+
+	def test_round_trips(self, mocker):
+		client = fake_client(mocker)
+		clock = mocker.patch('keenmqtt.subscriptions.clock', return_value=10.0)
+		subscriber = Subscriber(max_filters=1)
+		subscriber.subscribe_all(client, [('a', 0), ('b', 1)])
+		clock.return_value = 10.5
+		subscriber.on_subscribe(1, [0])
+		clock.return_value = 11.0
+		subscriber.on_subscribe(2, [0x80])
+		subscriber.on_subscribe(99, [0])
+		stats = subscriber.stats()
+		assert stats['acks'] == 2
+		assert stats['failures'] == 1
+		assert stats['pending'] == 0
+		assert stats['round_trip_last'] == 1.0
+		assert stats['round_trip_max'] == 1.0
+		assert stats['round_trip_sum'] == 1.5
+
+		# A SUBACK arriving before subscribe returns is matched up afterwards.
+		clock.return_value = 12.0
+		client.subscribe.side_effect = lambda packet: (subscriber.on_subscribe(7, [1]), (0, 7))[1]
+		subscriber.update(client, [('a', 0), ('b', 1), ('c', 1)])
+		stats = subscriber.stats()
+		assert stats['acks'] == 3
+		assert stats['pending'] == 0
+		assert stats['round_trip_last'] == 0.0
+
+	@pytest.mark.parametrize('stats', [True, False])
+	def test_relay(self, mocker, stats):
+		settings = {
+			'collection_mappings': {'home/#': 'home', 'home/a/+': {'collection': 'a'}, 'away/+': {'collection': 'away', 'qos': 1}},
+			'subscriptions': {'qos': 1},
+		}
+		if not stats:
+			settings['stats'] = {'enabled': False}
+		keenmqtt = KeenMQTT()
+		keenmqtt.setup(mqtt_client=fake_client(mocker), keen_client=mocker.Mock(), settings=settings)
+		keenmqtt.on_mqtt_connect(None, None, None, 0)
+		keenmqtt.mqtt_client.subscribe.assert_called_once_with([('home/#', 1), ('away/+', 1)])
+		keenmqtt.on_mqtt_subscribe(None, None, 1, [1, 1])
+		assert keenmqtt.get_stats()['subscriptions']['acks'] == 1
+
+		# Only the QoS changed, so only the subscription is sent again.
+		keenmqtt.mqtt_client.reset_mock()
+		settings['collection_mappings']['away/+'] = {'collection': 'away', 'qos': 2}
+		assert keenmqtt.reload_collection_mappings(settings['collection_mappings']) == ([], [])
+		keenmqtt.mqtt_client.subscribe.assert_called_once_with([('away/+', 2)])
+		assert not keenmqtt.mqtt_client.unsubscribe.called
+		with pytest.raises(ValueError):
+			keenmqtt.reload_collection_mappings({'a': {'collection': 'a', 'qos': 5}})
+
+	def test_check_config(self):
+		problems = check_config({'mqtt': {'host': 'localhost', 'port': 1883}, 'subscriptions': {'qos': 3},
+			'collection_mappings': {'a': {'collection': 'a', 'qos': 'high'}, 'b': {'collection': 'b', 'qos': 2}}})
+		assert problems == [
+			"subscriptions: A subscription QoS must be 0, 1 or 2, not 3",
+			"collection_mappings: 'a': invalid literal for int() with base 10: 'high'",
+		]
+
+	def test_benchmark(self, capsys):
+		results = bench_subscribe(['--mappings', '200'])
+		assert results['per-filter']['subscribe_packets'] == 200
+		assert results['batched']['subscribe_packets'] == 1
+		assert results['consolidated']['skipped'] == 50
+		assert all(result['acks'] == result['subscribe_packets'] for result in results.values())
+		assert 'consolidated' in capsys.readouterr().out
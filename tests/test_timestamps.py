@@ -0,0 +1,61 @@
+import random
+from datetime import timedelta
+import iso8601
+import pytest
+from keenmqtt import KeenMQTT
+from keenmqtt.timestamps import Timestamper
+
+class Struct:
+	pass
+
+class TestTimestamper:
+	"""Test the UTC timestamp formatting"""
+
+	def test_format(self):
+		timestamper = Timestamper()
+		assert timestamper.format(0) == '1970-01-01T00:00:00.000000+00:00'
+		assert timestamper.format(1451649600.25) == '2016-01-01T12:00:00.250000+00:00'
+		assert timestamper.format(1451649600.5) == '2016-01-01T12:00:00.500000+00:00'
+		assert timestamper.format(1451649601.000001) == '2016-01-01T12:00:01.000001+00:00'
+
+	def test_matches_datetime(self):
+		timestamper = Timestamper()
+		rng = random.Random(0)
+		epoch = iso8601.parse_date('1970-01-01T00:00:00+00:00')
+		for _ in range(1000):
+			seconds = rng.uniform(0, 2e9)
+			parsed = iso8601.parse_date(timestamper.format(seconds))
+			assert abs((parsed - epoch).total_seconds() - seconds) < 1e-5
+			assert parsed.utcoffset() == timedelta(0)
+
+	def test_parse(self):
+		timestamper = Timestamper()
+		rng = random.Random(0)
+		for _ in range(1000):
+			seconds = rng.uniform(0, 2e9)
+			assert abs(timestamper.parse(timestamper.format(seconds)) - seconds) < 1e-5
+		assert timestamper.parse('2016-01-01T12:00:00Z') == 1451649600
+		assert timestamper.parse('2016-01-01T13:30:00.5+01:30') == 1451649600.5
+		assert timestamper.parse('2016-01-01T10:00:00-0200') == 1451649600
+		with pytest.raises(ValueError):
+			timestamper.parse('2016-01-01T12:00:00 tomorrow')
+
+	def test_unknown_source(self):
+		with pytest.raises(ValueError):
+			Timestamper('later')
+
+	def test_receive_time(self, mocker):
+		keenmqtt = KeenMQTT()
+		keenmqtt.setup(mqtt_client=mocker.Mock(), keen_client=mocker.Mock(), settings={
+			'collection_mappings': {'a': 'a'},
+			'timestamps': {'source': 'receive'},
+		})
+		mocker.patch('keenmqtt.keenmqtt.time', return_value=1451649600.25)
+		message = Struct()
+		message.topic = 'a'
+		message.payload = b'[{"v": 1}, {"v": 2}]'
+		mocker.patch.object(keenmqtt, 'decode_payload', side_effect=lambda topic, payload: [{'v': 1}, {'v': 2}])
+		keenmqtt.on_mqtt_message(None, None, message)
+		for call in keenmqtt.keen_client.add_event.call_args_list:
+			assert call[0][1]['keen'] == {'timestamp': '2016-01-01T12:00:00.250000+00:00'}
+		assert keenmqtt.keen_client.add_event.call_count == 2
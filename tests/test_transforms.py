@@ -0,0 +1,99 @@
+import pytest
+from keenmqtt import KeenMQTT
+from keenmqtt.transforms import compile_transform, to_bool
+
+class Struct:
+	pass
+
+def message(topic, payload):
+	mqtt_message = Struct()
+	mqtt_message.topic = topic
+	mqtt_message.payload = payload
+	return mqtt_message
+
+class TestTransforms:
+	"""Test the compiled per-mapping transforms"""
+
+	def test_no_rules(self):
+		assert compile_transform({'collection': 'a'}) is None
+
+	def test_rules_in_order(self):
+		transform = compile_transform({
+			'rename': {'val': 'value'},
+			'coerce': {'value': 'float', 'ok': 'bool'},
+			'drop_if': {'value': {'lt': -50}, 'status': 'offline', 'test': {'exists': True}},
+			'include': ['value', 'ok', 'unit', 'debug'],
+			'exclude': ['debug'],
+			'topic_fields': {1: 'room', -1: 'kind', 5: 'missing'},
+		})
+		topic = 'home/kitchen/temperature'
+		assert transform(topic, {'val': '21.5', 'ok': 'yes', 'unit': 'C', 'debug': 1, 'other': 2}) == {
+			'value': 21.5, 'ok': True, 'unit': 'C', 'room': 'kitchen', 'kind': 'temperature'}
+		assert transform(topic, {'val': '-60'}) is None
+		assert transform(topic, {'val': 1, 'status': 'offline'}) is None
+		assert transform(topic, {'val': 1, 'test': None}) is None
+		assert transform(topic, {'val': 'hot'}) is None
+		assert transform(topic, {'val': 1, 'ok': 'maybe'}) is None
+		assert transform(topic, {}) == {'room': 'kitchen', 'kind': 'temperature'}
+
+	def test_in_place(self):
+		transform = compile_transform({'exclude': ['a'], 'drop_if': {'b': {'in': [1, 2]}}})
+		original = {'a': 1, 'b': 3}
+		assert transform('t', original) is original
+		assert original == {'b': 3}
+		assert transform('t', {'b': 2}) is None
+
+	def test_bad_rules(self):
+		with pytest.raises(ValueError):
+			compile_transform({'coerce': {'a': 'complex'}})
+		with pytest.raises(ValueError):
+			compile_transform({'drop_if': {'a': {'about': 1}}})
+		with pytest.raises(ValueError):
+			to_bool('maybe')
+
+	def test_not_a_dict(self):
+		# MessagePack and CBOR payloads can decode to numbers or strings.
+		transform = compile_transform({'rename': {'a': 'b'}, 'exclude': ['c']})
+		assert transform('x', 5) is None
+		assert transform('x', 'text') is None
+		assert transform('x', [{'a': 1}]) is None
+
+	def test_field_names_are_not_code(self):
+		transform = compile_transform({'rename': {'a"] = 1; import os #': 'b'}})
+		assert transform('t', {'a"] = 1; import os #': 2}) == {'b': 2}
+
+	@pytest.mark.parametrize('stats', [True, False])
+	def test_relay(self, mocker, stats):
+		class Relay(KeenMQTT):
+			def process_topic(self, event, topic):
+				event['topic'] = topic
+				return True
+
+		settings = {'collection_mappings': {
+			'home/+/temperature': {
+				'collection': 'temperature',
+				'coerce': {'value': 'float'},
+				'drop_if': {'value': {'lt': -50}},
+				'topic_fields': {1: 'room'},
+			},
+			'home/#': 'home',
+		}}
+		if not stats:
+			settings['stats'] = {'enabled': False}
+		for relay in (KeenMQTT(), Relay()):
+			relay.setup(mqtt_client=mocker.Mock(), keen_client=mocker.Mock(), settings=settings)
+			mocker.patch.object(relay, 'push_event')
+			mocker.patch.object(relay, 'get_time', return_value=None)
+			relay.on_mqtt_message(None, None, message('home/kitchen/temperature', b'{"value": "20"}'))
+			relay.on_mqtt_message(None, None, message('home/kitchen/temperature', b'{"value": -60}'))
+			relay.on_mqtt_message(None, None, message('home/kitchen/light', b'{"value": "on"}'))
+			relay.on_mqtt_message(None, None, message('home/kitchen/temperature', b'"warm"'))
+			assert relay.collection_mapping == {'home/+/temperature': 'temperature', 'home/#': 'home'}
+			events = [call[0] for call in relay.push_event.call_args_list]
+			assert len(events) == 2
+			assert events[0][0] == 'temperature'
+			assert events[0][1]['value'] == 20.0
+			assert events[0][1]['room'] == 'kitchen'
+			assert events[1] == ('home', dict(events[1][1], value='on'))
+			if stats:
+				assert relay.stats.counters['dropped_by_payload'] == 2
@@ -0,0 +1,52 @@
+import threading
+from keenmqtt import KeenMQTT
+from keenmqtt.upload import UploadWorkerPool
+
+class TestUploadWorkerPool:
+	"""Test uploading from background threads"""
+
+	def test_stop_drains_queue(self):
+		uploaded = []
+		pool = UploadWorkerPool(uploaded.append, workers=2, queue_size=10)
+		pool.start()
+		for i in range(5):
+			assert pool.submit({'a': [{'v': i}]})
+		pool.stop()
+		assert sorted(batch['a'][0]['v'] for batch in uploaded) == list(range(5))
+
+	def test_full_queue(self):
+		release = threading.Event()
+		pool = UploadWorkerPool(lambda events: release.wait(), workers=1, queue_size=1)
+		pool.start()
+		assert pool.submit({'a': [{}]})
+		assert pool.submit({'a': [{}]}, timeout=1)
+		assert not pool.submit({'a': [{}]}, block=False)
+		release.set()
+		pool.stop()
+
+	def test_errors_do_not_kill_workers(self):
+		uploaded = []
+		def upload(events):
+			if events['a'][0] == 'bad':
+				raise IOError()
+			uploaded.append(events)
+		pool = UploadWorkerPool(upload, workers=1)
+		pool.start()
+		pool.submit({'a': ['bad']})
+		pool.submit({'a': ['good']})
+		pool.stop()
+		assert uploaded == [{'a': ['good']}]
+
+class TestKeenMQTTUploadWorkers:
+	"""Test the KeenMQTT integration of the upload workers"""
+
+	def test_push_event_uses_workers(self, mocker):
+		keenmqtt = KeenMQTT()
+		keenmqtt.ready = True
+		keenmqtt.keen_client = mocker.Mock()
+		keenmqtt.mqtt_client = mocker.Mock()
+		keenmqtt.setup_upload_workers({'workers': 1})
+		keenmqtt.push_event('a', {'v': 1})
+		keenmqtt.stop()
+		keenmqtt.keen_client.add_events.assert_called_once_with({'a': [{'v': 1}]})
+		assert not keenmqtt.keen_client.add_event.called